@@ -1,4 +1,3 @@
-from pycomm3 import LogixDriver
 import psycopg2
 import json
 from datetime import datetime
@@ -7,6 +6,14 @@ import sys
 import os
 from datetime import timezone, timedelta
 
+# metrics.py is shared with the ingest scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '.Read_plc_data'))
+import metrics
+from gateway_client import plc_driver
+from tag_cache import CachedLogixDriver
+
+METRICS_PORT = 9103
+
 # ===== Database connection params =====
 DB_PARAMS = {
     'host': '192.168.1.149',
@@ -85,14 +92,17 @@ if "MC18" not in mc_18_tags:
 
 def read_tags(plc_ip, mc_tags):
     try:
-        with LogixDriver(plc_ip) as plc:
+        with plc_driver(plc_ip, direct=CachedLogixDriver) as plc:
             if not plc.connected:
                 print(f"Failed to connect to PLC at {plc_ip}")
+                metrics.PLC_READ_ERRORS.labels(plc_ip).inc()
                 return None
 
             plc.socket_timeout = 5.0
             tag_data = {}
+            started = time.perf_counter()
             response = plc.read(*mc_tags)
+            metrics.PLC_READ_SECONDS.labels(plc_ip).observe(time.perf_counter() - started)
 
             for tag in response:
                 tag_data[tag.tag] = tag.value
@@ -101,10 +111,13 @@ def read_tags(plc_ip, mc_tags):
 
     except Exception as e:
         print(f"Error reading from PLC {plc_ip}: {str(e)}")
+        metrics.PLC_READ_ERRORS.labels(plc_ip).inc()
         return None
 
 # Connect to DB
 db_connection = psycopg2.connect(**DB_PARAMS)
+metrics.DB_CONNECTS.labels('ok').inc()
+metrics.start_http_server(METRICS_PORT)
 
 # Define IST timezone (UTC+05:30)
 ist_timezone = timezone(timedelta(hours=5, minutes=30))
@@ -165,6 +178,7 @@ while True:
             "timestamp", mc17, mc18)
             VALUES (%s, %s, %s);"""
 
+        started = time.perf_counter()
         with db_connection.cursor() as cur:
             cur.execute(insert_query, (
                 plc_timestamp,
@@ -172,17 +186,22 @@ while True:
                 json.dumps(results['mc18']),
             ))
             db_connection.commit()
+            metrics.DB_QUERY_SECONDS.labels('loop3_checkpoints').observe(time.perf_counter() - started)
             print(f"Inserted row at {plc_timestamp}")
 
     except Exception as e:
         exc_type, exc_obj, exc_tb = sys.exc_info()
+        if isinstance(e, psycopg2.Error):
+            metrics.DB_ERRORS.labels('loop3_checkpoints').inc()
         fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
         print(f"Error at {fname} line {exc_tb.tb_lineno}: {str(e)}")
 
         try:
             if db_connection.closed:
                 db_connection = psycopg2.connect(**DB_PARAMS)
+                metrics.DB_CONNECTS.labels('ok').inc()
         except:
+            metrics.DB_CONNECTS.labels('error').inc()
             print("Failed to reconnect to DB")
 
     time.sleep(5)
@@ -1,4 +1,3 @@
-from pycomm3 import LogixDriver
 import psycopg2
 import json
 from datetime import datetime
@@ -6,6 +5,14 @@ import time
 import sys
 import os
 
+# metrics.py is shared with the ingest scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '.Read_plc_data'))
+import metrics
+from gateway_client import plc_driver
+from tag_cache import CachedLogixDriver
+
+METRICS_PORT = 9103
+
 # Define the PLC IP address and database connection details
 DB_PARAMS = {
     'host': '192.168.1.149',
@@ -22,15 +29,18 @@ mc_18_tags = ["Shift_1_Data", "Shift_2_Data", "Shift_3_Data", "Hopper_1_Level_Pe
 # Function to read and insert tags into PostgreSQL
 def read_tags(plc_ip, mc_tags):
     try:
-        with LogixDriver(plc_ip) as plc:
+        with plc_driver(plc_ip, direct=CachedLogixDriver) as plc:
             if not plc.connected:
                 print(f"Failed to connect to PLC at {plc_ip}")
+                metrics.PLC_READ_ERRORS.labels(plc_ip).inc()
                 return None
 
             plc.socket_timeout = 5.0  # 5 seconds timeout
             
             tag_data = {}
+            started = time.perf_counter()
             response = plc.read(*mc_tags)
+            metrics.PLC_READ_SECONDS.labels(plc_ip).observe(time.perf_counter() - started)
             for tags in response:
                 tag_data[tags.tag] = tags.value
                 print(f"\n {tags.tag}:{tags.value} ")
@@ -38,10 +48,13 @@ def read_tags(plc_ip, mc_tags):
             
     except Exception as e:
         print(f"Error reading from PLC {plc_ip}: {str(e)}")
+        metrics.PLC_READ_ERRORS.labels(plc_ip).inc()
         return None
 
 # Run the function for each tag list and insert into corresponding table
 db_connection = psycopg2.connect(**DB_PARAMS)
+metrics.DB_CONNECTS.labels('ok').inc()
+metrics.start_http_server(METRICS_PORT)
 
 while True:
     try:
@@ -65,6 +78,7 @@ while True:
             "timestamp", mc17, mc18)
             VALUES (%s, %s, %s);"""
 
+        started = time.perf_counter()
         with db_connection.cursor() as cur:
             cur.execute(insert_query, (
                 str(datetime.now()),
@@ -72,10 +86,13 @@ while True:
                 json.dumps(results['mc18']),
             ))
             db_connection.commit()
+            metrics.DB_QUERY_SECONDS.labels('loop3_checkpoints').observe(time.perf_counter() - started)
             print("Data inserted successfully")
 
     except Exception as e:
         exc_type, exc_obj, exc_tb = sys.exc_info()
+        if isinstance(e, psycopg2.Error):
+            metrics.DB_ERRORS.labels('loop3_checkpoints').inc()
         fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
         print(f"Error at {fname} line {exc_tb.tb_lineno}: {str(e)}")
 
@@ -83,7 +100,9 @@ while True:
         try:
             if db_connection.closed:
                 db_connection = psycopg2.connect(**DB_PARAMS)
+                metrics.DB_CONNECTS.labels('ok').inc()
         except:
+            metrics.DB_CONNECTS.labels('error').inc()
             print("Failed to reconnect to database")
 
     time.sleep(5)
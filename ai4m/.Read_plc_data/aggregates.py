@@ -0,0 +1,111 @@
+"""Streaming window aggregates for the mid-speed (5 s) tables.
+
+Every sample updates per-tag min/max/sum/last accumulators in place; nothing
+from the window is stored. When a sample falls into the next window, the
+closed window is returned as one row:
+
+    window start, sample_count, <tag>_min, <tag>_max, <tag>_mean, <tag>_last, ..., cycle_id
+
+Windows are aligned to multiples of the interval (00:00:00, 00:00:05, ...).
+
+Print the table definition for a tag file with:
+
+    python3 aggregates.py low_speed.json mc17_mid_agg
+
+Aggregates are opt-in: create the table first, then set low_speed_aggregate
+enabled in machines.json (aggregate_low_speed in read_mc17.py/read_mc18.py).
+"""
+import json
+import operator
+import sys
+
+AGGREGATES = ('min', 'max', 'mean', 'last')
+
+
+def aggregate_columns(tags):
+    """Column names of an aggregate table row"""
+    columns = ['"timestamp"', 'sample_count']
+    for tag in tags:
+        column = tag.lower().replace('mc_', '')
+        columns.extend(f'{column}_{aggregate}' for aggregate in AGGREGATES)
+    columns.append('cycle_id')
+    return columns
+
+
+def aggregate_table_ddl(table, tags):
+    columns = aggregate_columns(tags)
+    lines = ['    "timestamp" timestamp NOT NULL', '    sample_count integer']
+    lines += [f'    {column} double precision' for column in columns[2:-1]]
+    lines.append('    cycle_id integer')
+    return f"CREATE TABLE {table} (\n" + ",\n".join(lines) + "\n);"
+
+
+class WindowAggregator:
+    """Incremental min/max/mean/last/count per tag over fixed time windows"""
+
+    def __init__(self, tags, interval=5.0):
+        self.tags = list(tags)
+        self.interval = interval
+        self.window = None
+        self.count = 0
+        self.mins = None
+        self.maxs = None
+        self.sums = None
+        self.last = None
+        self.label = None
+        self.windows_closed = 0
+
+    def add(self, t, values, label=None):
+        """Add one sample (t in seconds, values ordered like tags).
+
+        Returns the closed window as (window_start, count, aggregates, label)
+        when this sample starts a new window, otherwise None. label is any
+        value to carry along with the window (its last one is kept), e.g. the
+        cycle id.
+        """
+        window = int(t // self.interval)
+        closed = None
+        if window != self.window:
+            if self.count:
+                closed = self._close()
+            self.window = window
+            self.count = 1
+            self.mins = list(values)
+            self.maxs = list(values)
+            self.sums = list(values)
+            self.last = values
+            self.label = label
+            return closed
+
+        self.count += 1
+        self.mins = list(map(min, self.mins, values))
+        self.maxs = list(map(max, self.maxs, values))
+        self.sums = list(map(operator.add, self.sums, values))
+        self.last = values
+        self.label = label
+        return None
+
+    def flush(self):
+        """Close the open window, e.g. on shutdown"""
+        if not self.count:
+            return None
+        closed = self._close()
+        self.window = None
+        return closed
+
+    def _close(self):
+        count = self.count
+        aggregates = []
+        for low, high, total, last in zip(self.mins, self.maxs, self.sums, self.last):
+            aggregates.extend((low, high, total / count, last))
+        self.count = 0
+        self.windows_closed += 1
+        return self.window * self.interval, count, tuple(aggregates), self.label
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: python3 aggregates.py <tags.json> <table>")
+        sys.exit(1)
+    with open(sys.argv[1], 'r') as f:
+        print(aggregate_table_ddl(sys.argv[2], json.load(f)['tags']))
@@ -0,0 +1,203 @@
+"""Non-blocking, rate-limited logging for the daemons.
+
+setup_logging() replaces the root handlers with a handler that only puts
+records on a bounded queue; a listener thread does the formatting, the file
+writes, the rotation and the compression. An acquisition thread therefore
+never waits on the disk, and if the listener falls behind, records are
+dropped and counted instead of blocking the poll loop.
+
+Every message type (the logging call site: file and line) has its own token
+bucket of rate records per second with a burst allowance. A PLC or database
+error repeated on every 30 ms poll is logged a few times, then once per
+second or so with the number of similar records suppressed since the last
+one. Success paths do not log per event at all; they count (see metrics.py)
+and log periodic summaries.
+
+The log file is rotated by size and rotated files are gzip-compressed
+(plc_reader.log.1.gz, ...), so the log can no longer fill the disk and needs
+no cleanup job.
+
+    "logging": {"file": "/var/log/plc_reader.log", "level": "INFO", "max_mb": 50,
+                "backups": 5, "compress": true, "rate": 1.0, "burst": 10,
+                "limits": {"ingest_daemon": {"rate": 5, "burst": 50}}}
+
+Without a file the records go to stderr, for systemd/journald.
+"""
+import atexit
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+
+import metrics
+
+LOG_RECORDS = metrics.counter('ai4m_log_records_total', 'Log records queued for output', ['level'])
+LOG_SUPPRESSED = metrics.counter('ai4m_log_suppressed_total', 'Log records dropped by rate limiting', ['level'])
+
+FORMAT = '%(asctime)s %(levelname)s %(threadName)s %(name)s: %(message)s'
+
+DEFAULTS = {
+    'file': None,
+    'level': 'INFO',
+    'max_mb': 50,
+    'backups': 5,
+    'compress': True,
+    'rate': 1.0,
+    'burst': 10,
+    'queue_size': 10000,
+    'limits': {},
+}
+
+_listeners = []  # (QueueListener, output handler) started by setup_logging
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per call site; the next record let through carries the suppressed count
+    in record.suppressed, which SuppressedFormatter renders.
+
+    CRITICAL records are never limited. limits maps a logger name to its own
+    {"rate": ..., "burst": ...}.
+    """
+
+    def __init__(self, rate=1.0, burst=10, limits=None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.limits = limits or {}
+        self.buckets = {}  # (pathname, lineno) -> [tokens, last refill, suppressed, rate, burst]
+        self.lock = threading.Lock()
+        self.suppressed = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.CRITICAL or not self.rate:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                limit = self.limits.get(record.name, {})
+                rate = limit.get('rate', self.rate)
+                burst = limit.get('burst', self.burst)
+                bucket = self.buckets[key] = [burst, now, 0, rate, burst]
+            tokens, last, suppressed, rate, burst = bucket
+            tokens = min(burst, tokens + (now - last) * rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] = suppressed + 1
+                self.suppressed += 1
+                LOG_SUPPRESSED.labels(record.levelname).inc()
+                return False
+            bucket[0] = tokens - 1
+            bucket[2] = 0
+        record.suppressed = suppressed
+        return True
+
+
+class SuppressedFormatter(logging.Formatter):
+    """Formatter that appends the number of similar records a RateLimitFilter suppressed"""
+
+    def formatMessage(self, record):
+        text = super().formatMessage(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            text = f"{text} ({suppressed} similar messages suppressed)"
+        return text
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full instead of reporting an error"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        metrics.QUEUE_DEPTH.labels('log').set_function(log_queue.qsize)
+        metrics.QUEUE_DROPPED.labels('log').set_function(lambda: self.dropped)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            LOG_RECORDS.labels(record.levelname).inc()
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'dropped': self.dropped,
+                'suppressed': sum(f.suppressed for f in self.filters if isinstance(f, RateLimitFilter))}
+
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """RotatingFileHandler whose rotated files are gzip-compressed (name.1.gz, name.2.gz, ...)"""
+
+    def __init__(self, filename, max_bytes, backups, compress=True):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        if compress:
+            self.namer = lambda name: name + '.gz'
+            self.rotator = self._compress
+
+    @staticmethod
+    def _compress(source, destination):
+        with open(source, 'rb') as f_in, gzip.open(destination, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+
+class _Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # The queue is bounded; wait for room rather than fail at shutdown
+        self.queue.put(self._sentinel, timeout=5)
+
+
+def output_handler(config):
+    """The file (or stderr) handler the listener thread writes to"""
+    path = config['file']
+    if path:
+        try:
+            return CompressingRotatingFileHandler(path, int(config['max_mb'] * 1024 * 1024), config['backups'],
+                                                  config['compress'])
+        except OSError as e:
+            print(f"Cannot open log file {path}: {e}. Logging to stderr.", file=sys.stderr)
+    return logging.StreamHandler(sys.stderr)
+
+
+def setup_logging(config=None):
+    """Route the root logger through the async queue; config is the "logging" section or None.
+    Returns the queue handler, whose stats() reports queued, dropped and suppressed records."""
+    config = dict(DEFAULTS, **(config or {}))
+    handler = output_handler(config)
+    handler.setFormatter(SuppressedFormatter(FORMAT))
+
+    queue_handler = AsyncQueueHandler(queue.Queue(maxsize=config['queue_size']))
+    queue_handler.addFilter(RateLimitFilter(config['rate'], config['burst'], config['limits']))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+        existing.close()
+    root.addHandler(queue_handler)
+    root.setLevel(config['level'])
+
+    listener = _Listener(queue_handler.queue, handler)
+    listener.start()
+    _listeners.append((listener, handler))
+    return queue_handler
+
+
+def stop():
+    """Write out the queued records and close the output; call before os._exit()"""
+    while _listeners:
+        listener, handler = _listeners.pop()
+        try:
+            listener.stop()
+        except queue.Full:
+            pass
+        handler.close()
+
+
+atexit.register(stop)
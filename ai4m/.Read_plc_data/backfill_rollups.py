@@ -0,0 +1,156 @@
+"""Build a machine's 1 s / 1 min / 1 h rollup tables from its raw tables.
+
+Every day is rebuilt in one transaction: its rows are deleted from the three
+rollup tables and recomputed by PostgreSQL with one GROUP BY per resolution
+over that day's raw partition, so a day can be rebuilt any number of times
+and only the aggregates cross the network. Days run in parallel, one worker
+process and connection each.
+
+High-speed tags come from the raw table. Low-speed tags come from the 5 s
+aggregate table when low_speed_aggregate is enabled (a window counts in the
+bucket its start falls into), otherwise from the snapshot table.
+
+The ingest daemon writes the current day itself, so the last day defaults to
+yesterday and today is never rebuilt.
+
+Usage: python3 backfill_rollups.py <machine> <first day> [last day] [workers] [machines.json]
+       python3 backfill_rollups.py mc17 2025-05-01 2025-06-13 4
+"""
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import psycopg2
+
+from rollups import RESOLUTIONS, rollup_columns, rollup_tables, rollup_tags
+
+logger = logging.getLogger(__name__)
+
+
+def tag_column(tag):
+    return tag.lower().replace('mc_', '')
+
+
+def load_machine(config_path, name):
+    """(database settings, machine entry with its tag lists loaded) from machines.json"""
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(config_path))
+    machines = [machine for machine in config['machines'] if machine['name'] == name]
+    if not machines:
+        raise SystemExit(f"No machine {name!r} in {config_path}")
+    machine = dict(machines[0])
+    for key in ('high_speed_tags', 'low_speed_tags'):
+        with open(os.path.join(base_dir, machine[key]), 'r') as f:
+            machine[key] = json.load(f)['tags']
+    return config['database'], machine
+
+
+def low_speed_source(machine, unit, tags):
+    """Subquery of the low-speed tags per bucket, from the aggregate or the snapshot table"""
+    aggregate = machine.get('low_speed_aggregate', {})
+    select = [f"date_trunc('{unit}', \"timestamp\") AS bucket"]
+    if aggregate.get('enabled'):
+        table = aggregate.get('table', f"{machine['low_speed_table']}_agg")
+        select.append('sum(sample_count) AS sample_count')
+        for tag in tags:
+            column = tag_column(tag)
+            select += [f'min({column}_min) AS {column}_min', f'max({column}_max) AS {column}_max',
+                       f'sum({column}_mean * sample_count) / nullif(sum(sample_count), 0) AS {column}_mean']
+    else:
+        table = machine['low_speed_table']
+        select.append('count(*) AS sample_count')
+        for tag in tags:
+            column = tag_column(tag)
+            select += [f'min({column}) AS {column}_min', f'max({column}) AS {column}_max',
+                       f'avg({column}) AS {column}_mean']
+    return (f"SELECT {', '.join(select)} FROM {table} "
+            f'WHERE "timestamp" >= %(start)s AND "timestamp" < %(end)s GROUP BY 1')
+
+
+def backfill_sql(machine, table, unit):
+    """INSERT ... SELECT computing one rollup table for the day in %(start)s..%(end)s"""
+    high_speed_tags = machine['high_speed_tags']
+    low_speed_tags = [tag for tag in machine['low_speed_tags'] if tag not in high_speed_tags]
+    high_select = [f"date_trunc('{unit}', \"timestamp\") AS bucket", 'count(*) AS sample_count']
+    for tag in high_speed_tags:
+        column = tag_column(tag)
+        high_select += [f'min({column}) AS {column}_min', f'max({column}) AS {column}_max',
+                        f'avg({column}) AS {column}_mean']
+    high_source = (f"SELECT {', '.join(high_select)} FROM {machine['high_speed_table']} "
+                   f'WHERE "timestamp" >= %(start)s AND "timestamp" < %(end)s GROUP BY 1')
+
+    values = ['bucket', 'coalesce(h.sample_count, l.sample_count)']
+    values += [f'h.{column}' for column in rollup_columns(high_speed_tags)[2:]]
+    values += [f'l.{column}' for column in rollup_columns(low_speed_tags)[2:]]
+    columns = rollup_columns(rollup_tags(high_speed_tags, low_speed_tags))
+    return (f"INSERT INTO {table} ({', '.join(columns)}) SELECT {', '.join(values)} "
+            f"FROM ({high_source}) h FULL JOIN ({low_speed_source(machine, unit, low_speed_tags)}) l USING (bucket)")
+
+
+def backfill_day(job):
+    """Rebuild the rollups of one day; runs in a worker process"""
+    db_settings, statements, day = job
+    started = time.monotonic()
+    window = {'start': day, 'end': day + datetime.timedelta(days=1)}
+    rows = {}
+    conn = psycopg2.connect(**db_settings)
+    try:
+        with conn, conn.cursor() as cursor:
+            for table, statement in statements:
+                cursor.execute(f'DELETE FROM {table} WHERE "timestamp" >= %(start)s AND "timestamp" < %(end)s',
+                               window)
+                cursor.execute(statement, window)
+                rows[table] = cursor.rowcount
+    finally:
+        conn.close()
+    return day, rows, time.monotonic() - started
+
+
+def backfill(machine_name, first_day, last_day=None, workers=4, config_path='machines.json'):
+    """Rebuild first_day..last_day (inclusive, at most yesterday) with workers processes"""
+    db_settings, machine = load_machine(config_path, machine_name)
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+    last_day = min(last_day or yesterday, yesterday)
+    days = [first_day + datetime.timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+    if not days:
+        logger.warning(f"{machine_name}: nothing to backfill before today")
+        return []
+    tables = dict(rollup_tables(machine['high_speed_table']), **machine.get('rollups', {}).get('tables', {}))
+    statements = [(tables[label], backfill_sql(machine, tables[label], unit)) for label, _, unit in RESOLUTIONS]
+    jobs = [(db_settings, statements, day) for day in days]
+
+    results = []
+    with multiprocessing.Pool(min(workers, len(days))) as pool:
+        for day, rows, elapsed in pool.imap_unordered(backfill_day, jobs):
+            logger.info(f"{machine_name} {day}: {rows} in {elapsed:.1f} s")
+            results.append((day, rows, elapsed))
+    return sorted(results)
+
+
+def main():
+    if len(sys.argv) < 3:
+        print(__doc__.strip().splitlines()[-2])
+        sys.exit(1)
+    try:
+        first_day = datetime.date.fromisoformat(sys.argv[2])
+        last_day = datetime.date.fromisoformat(sys.argv[3]) if len(sys.argv) > 3 else None
+        workers = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+    except ValueError as e:
+        print(f"Invalid argument: {e}")
+        sys.exit(1)
+    config_path = sys.argv[5] if len(sys.argv) > 5 else 'machines.json'
+
+    started = time.monotonic()
+    results = backfill(sys.argv[1], first_day, last_day, workers, config_path)
+    total = sum(sum(rows.values()) for _, rows, _ in results)
+    print(f"{sys.argv[1]}: {len(results)} days, {total} rollup rows in {time.monotonic() - started:.1f} s")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    main()
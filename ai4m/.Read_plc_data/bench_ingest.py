@@ -0,0 +1,288 @@
+"""End-to-end ingest benchmark against simulated PLCs.
+
+For each machine count, runs the ingest daemon's acquisition and DB writer
+threads against that many SimulatedLogixDrivers (see sim_plc.py) and reports:
+
+  samples/s      high-speed rows committed per second (target: machines / period)
+  p50/p99 ms     end-to-end latency, PLC sample time -> COPY committed
+  CPU/machine    process CPU per machine, in % of one core, excluding the simulator
+  lost           samples overwritten in the ring buffers plus skipped scheduler ticks
+
+Every machine count runs in its own process, so threads and CPU accounting do
+not leak between runs. The machines are copies of the first profile in
+machines.json. By default rows go to an in-process sink that accepts the COPY
+payloads; with 'postgres' they go to the database in machines.json, into
+bench_<table> copies of the machine tables that are dropped afterwards.
+
+Usage: python3 bench_ingest.py [seconds] [machine counts] [sink|postgres]
+       python3 bench_ingest.py 20 1,5,10,25,50 postgres
+"""
+import copy
+import datetime
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from rollups import rollup_tables
+
+DEFAULT_COUNTS = (1, 5, 10, 25, 50)
+WARMUP = 3.0
+
+# Column types the sink reports, so CopyWriter takes its binary COPY path like against Postgres
+SINK_TIMESTAMP_COLUMNS = ('timestamp', 'end_timestamp')
+
+
+class SinkCursor:
+    """Accepts the statements CopyWriter and the daemon issue and discards the rows"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.params = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.params = params
+
+    def fetchall(self):
+        # information_schema lookup from CopyWriter._resolve_encoders
+        table = self.params[0]
+        columns = self.connection.pool.columns.get(table, ())
+        return [(column, 'timestamp without time zone' if column in SINK_TIMESTAMP_COLUMNS
+                 else 'text' if column == 'tag' else 'double precision') for column in columns]
+
+    def fetchone(self):
+        return (None,)
+
+    def copy_expert(self, sql, payload):
+        self.connection.pool.bytes_copied += len(payload.getvalue())
+
+    def close(self):
+        pass
+
+
+class SinkConnection:
+    closed = 0
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def cursor(self):
+        return SinkCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class SinkPool:
+    """Stands in for psycopg2's ThreadedConnectionPool"""
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.bytes_copied = 0
+
+    def getconn(self):
+        return SinkConnection(self)
+
+    def putconn(self, conn, close=False):
+        pass
+
+    def closeall(self):
+        pass
+
+
+def now_micros():
+    """Local wall clock in the PLC clock convention (EpochMicros, no time zone)"""
+    return (datetime.datetime.now() - datetime.datetime(1970, 1, 1)) // datetime.timedelta(microseconds=1)
+
+
+def bench_config(config_path, count, work_dir, postgres):
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(config_path))
+    template = config['machines'][0]
+    machines = []
+    for i in range(count):
+        machine = copy.deepcopy(template)
+        name = f"sim{i + 1:03d}"
+        machine.update({
+            'name': name,
+            'ip': f"sim://{name}",
+            'enabled': True,
+            'fast_decode': False,
+            'kafka_key': name,
+            'simulate': {'latency': 0.002, 'jitter': 0.002, 'seed': i},
+            'shared_ring': {'enabled': False},
+            'high_speed_tags': os.path.join(base_dir, template['high_speed_tags']),
+            'low_speed_tags': os.path.join(base_dir, template['low_speed_tags']),
+        })
+        prefix = 'bench_' if postgres else ''
+        machine['high_speed_table'] = f"{prefix}{name}"
+        machine['low_speed_table'] = f"{prefix}{name}_mid"
+        for section, suffix in (('low_speed_aggregate', '_mid_agg'), ('cycle_features', '_cycles'),
+                                ('low_speed_compression', '_mid_sd')):
+            if section in machine:
+                machine[section]['table'] = f"{prefix}{name}{suffix}"
+        if 'rollups' in machine:
+            machine['rollups']['tables'] = rollup_tables(f"{prefix}{name}")
+        if 'rate_tags' in machine:
+            machine['rate_tags'].update(tags=os.path.join(base_dir, template['rate_tags']['tags']),
+                                        table=f"{prefix}{name}_tags")
+        machines.append(machine)
+    config['machines'] = machines
+    config['spool'] = dict(config.get('spool', {}), directory=os.path.join(work_dir, 'spool'))
+    config['cycle_state'] = {'path': os.path.join(work_dir, 'cycle_state.json')}
+    config['kafka'] = dict(config['kafka'], outbox=dict(config['kafka'].get('outbox', {}),
+                                                         directory=os.path.join(work_dir, 'kafka')))
+    config.pop('metrics', None)
+    path = os.path.join(work_dir, 'machines.json')
+    with open(path, 'w') as f:
+        json.dump(config, f)
+    return path, template
+
+
+def table_pairs(daemon, template):
+    """(bench table, production table it copies) for every writer"""
+    suffixes = {'_mid_agg': 'low_speed_aggregate', '_cycles': 'cycle_features', '_mid_sd': 'low_speed_compression',
+                '_tags': 'rate_tags', '_mid': None}
+    rollup_sources = dict(rollup_tables(template['high_speed_table']), **template.get('rollups', {}).get('tables', {}))
+    pairs = []
+    for machine in daemon.machines:
+        for writer in machine.writers:
+            source = template['high_speed_table']
+            for suffix, section in suffixes.items():
+                if writer.table.endswith(suffix):
+                    source = template[section]['table'] if section else template['low_speed_table']
+                    break
+            else:
+                for label, rollup_source in rollup_sources.items():
+                    if writer.table.endswith(f"_{label}"):
+                        source = rollup_source
+            pairs.append((writer.table, source))
+    return pairs
+
+
+def run_single(count, seconds, mode):
+    """Run one machine count and print a JSON result line"""
+    import ingest_daemon
+
+    postgres = mode == 'postgres'
+    with tempfile.TemporaryDirectory() as work_dir:
+        config_path, template = bench_config(os.environ.get('BENCH_CONFIG', 'machines.json'), count, work_dir,
+                                             postgres)
+        daemon = ingest_daemon.IngestDaemon(config_path)
+        pairs = table_pairs(daemon, template)
+        if postgres:
+            conn = daemon.db_pool.getconn()
+            with conn.cursor() as cursor:
+                for table, source in pairs:
+                    cursor.execute(f"CREATE TABLE IF NOT EXISTS {table} (LIKE {source} INCLUDING DEFAULTS)")
+            conn.commit()
+            daemon.db_pool.putconn(conn)
+        else:
+            columns = {writer.table: [column.strip('"') for column in writer.columns]
+                       for machine in daemon.machines for writer in machine.writers}
+            daemon.db_pool = SinkPool(columns)
+
+        latencies = []
+        measuring = threading.Event()
+        for machine in daemon.machines:
+            writer = machine.high_speed_writer
+            write_rows = writer.write_rows
+
+            def timed_write_rows(conn, rows, write_rows=write_rows):
+                write_rows(conn, rows)
+                if measuring.is_set():
+                    committed = now_micros()
+                    latencies.extend([(committed - row[0].us) / 1000.0 for row in rows])
+            writer.write_rows = timed_write_rows
+
+        threads = [threading.Thread(target=machine.acquire_plc_data, daemon=True) for machine in daemon.machines]
+        writer_count = min(daemon.db_writers, len(daemon.machines))
+        threads += [threading.Thread(target=daemon.write_to_db, args=(daemon.machines[i::writer_count],), daemon=True)
+                    for i in range(writer_count)]
+        threads.append(threading.Thread(target=daemon.replay_spool, daemon=True))
+        for thread in threads:
+            thread.start()
+
+        time.sleep(WARMUP)
+
+        def totals():
+            rows = sum(machine.high_speed_writer.rows_written for machine in daemon.machines)
+            lost = sum(machine.sample_buffer.overflow_count + machine.scheduler.skipped_ticks
+                       for machine in daemon.machines)
+            sim_cpu = sum(machine.plc.cpu_seconds for machine in daemon.machines if machine.plc)
+            return rows, lost, sim_cpu, time.process_time(), time.monotonic()
+
+        measuring.set()
+        rows0, lost0, sim0, cpu0, wall0 = totals()
+        time.sleep(seconds)
+        rows1, lost1, sim1, cpu1, wall1 = totals()
+        measuring.clear()
+        daemon.stopping.set()
+
+        if postgres:
+            conn = daemon.db_pool.getconn()
+            with conn.cursor() as cursor:
+                for table, _ in pairs:
+                    cursor.execute(f"DROP TABLE IF EXISTS {table}")
+            conn.commit()
+            daemon.db_pool.putconn(conn)
+
+    elapsed = wall1 - wall0
+    latencies.sort()
+    period = daemon.machines[0].profile.period
+    result = {
+        'machines': count,
+        'samples_per_sec': (rows1 - rows0) / elapsed,
+        'target_per_sec': count / period,
+        'p50_ms': latencies[len(latencies) // 2] if latencies else None,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] if latencies else None,
+        'cpu_per_machine_pct': ((cpu1 - cpu0) - (sim1 - sim0)) / elapsed / count * 100,
+        'lost': lost1 - lost0,
+    }
+    print(json.dumps(result))
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 20
+    counts = [int(c) for c in sys.argv[2].split(',')] if len(sys.argv) > 2 else DEFAULT_COUNTS
+    mode = sys.argv[3] if len(sys.argv) > 3 else 'sink'
+    if mode not in ('sink', 'postgres'):
+        print(f"Unknown mode {mode!r}, expected sink or postgres")
+        sys.exit(1)
+
+    print(f"{seconds:.0f} s per run after {WARMUP:.0f} s warm-up, {mode}")
+    print(f"{'machines':>8} {'samples/s':>10} {'target/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'CPU/machine':>12} {'lost':>6}")
+    for count in counts:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--single', str(count), str(seconds), mode],
+                                capture_output=True, text=True)
+        lines = output.stdout.strip().splitlines()
+        if output.returncode != 0 or not lines:
+            print(f"{count:>8} failed: {output.stderr.strip().splitlines()[-1:] or output.returncode}")
+            continue
+        r = json.loads(lines[-1])
+        p50 = f"{r['p50_ms']:8.1f}" if r['p50_ms'] is not None else f"{'-':>8}"
+        p99 = f"{r['p99_ms']:8.1f}" if r['p99_ms'] is not None else f"{'-':>8}"
+        print(f"{r['machines']:>8} {r['samples_per_sec']:>10.1f} {r['target_per_sec']:>9.1f} {p50} {p99} "
+              f"{r['cpu_per_machine_pct']:>11.1f}% {r['lost']:>6}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--single':
+        logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+        run_single(int(sys.argv[2]), float(sys.argv[3]), sys.argv[4])
+    else:
+        main()
@@ -0,0 +1,94 @@
+"""Microbenchmark: pycomm3 dict decoding vs UdtDecoder for one machine UDT sample.
+
+Builds a synthetic MC17-like UDT from the tag JSON files (REAL members plus DINT
+clock/counter members), encodes a sample with pycomm3's own StructTag and then
+times both per-sample paths the ingest uses:
+
+  dict    StructTag.decode -> datetime -> str() -> list comprehension row
+  struct  UdtDecoder.decode -> EpochMicros -> itemgetter row
+
+Usage: python3 bench_udt_decode.py [samples]
+"""
+import datetime
+import json
+import sys
+import timeit
+
+from pycomm3 import DINT, REAL, StructTag
+
+from udt_decoder import CLOCK_FIELDS, UdtDecoder, UdtLayout
+
+INT_MEMBERS = set(CLOCK_FIELDS) | {'MC_Status_Code', 'MC_Status', 'MC_Sachet_Count', 'MC_CLD_Count',
+                                   'MC_Eye_Mark_Count'}
+
+
+def load_tags(path):
+    with open(path, 'r') as f:
+        return json.load(f)['tags']
+
+
+def build_udt(member_names):
+    members = []
+    internal_tags = {}
+    offset = 0
+    for name in member_names:
+        type_class, type_name = (DINT, 'DINT') if name in INT_MEMBERS else (REAL, 'REAL')
+        members.append((type_class(name), offset))
+        internal_tags[name] = {'offset': offset, 'data_type_name': type_name, 'tag_type': 'atomic', 'array': 0}
+        offset += 4
+    struct_tag = StructTag(*members, bit_members={}, private_members=set(), struct_size=offset)
+    return struct_tag, internal_tags, offset
+
+
+def main():
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    high_speed_tags = load_tags('high_speed.json')
+    low_speed_tags = load_tags('low_speed.json')
+
+    # A realistic UDT also carries members we never store
+    member_names = list(CLOCK_FIELDS)
+    for tag in high_speed_tags + low_speed_tags + ['MC_Eye_Mark_Count'] + [f'MC_Spare_{i}' for i in range(10)]:
+        if tag not in member_names:
+            member_names.append(tag)
+    struct_tag, internal_tags, size = build_udt(member_names)
+
+    values = {name: float(i) for i, name in enumerate(member_names)}
+    values.update({'Year': 2025, 'Month': 6, 'Day': 14, 'Hour': 10, 'Min': 30, 'Sec': 15, 'Microsecond': 250000})
+    for name in INT_MEMBERS - set(CLOCK_FIELDS):
+        values[name] = 7
+    raw = bytes(struct_tag.encode(values))
+
+    layout = UdtLayout(high_speed_tags, low_speed_tags, extra_tags=('MC_Cam_Position', 'MC_Status_Code'))
+    decoder = UdtDecoder(layout, 'MC17', internal_tags, size)
+    cycle_id = 42
+
+    def dict_path():
+        data = struct_tag.decode(raw)
+        timestamp = datetime.datetime(
+            data['Year'], data['Month'], data['Day'],
+            data['Hour'], data['Min'], data['Sec'],
+            data['Microsecond']
+        )
+        return [str(timestamp)] + [data[tag] for tag in high_speed_tags] + [cycle_id]
+
+    def struct_path():
+        sample = decoder.decode(raw)
+        timestamp = layout.timestamp(sample)
+        return (timestamp,) + layout.high_speed(sample) + (cycle_id,)
+
+    # Both paths must produce the same row
+    old_row, new_row = dict_path(), struct_path()
+    assert old_row[0] == str(new_row[0]), (old_row[0], new_row[0])
+    assert list(old_row[1:]) == list(new_row[1:])
+
+    print(f"UDT with {len(member_names)} members ({size} bytes), {len(layout.names)} decoded, {samples} samples")
+    results = {}
+    for name, fn in (('dict', dict_path), ('struct', struct_path)):
+        seconds = min(timeit.repeat(fn, number=samples, repeat=3))
+        results[name] = seconds
+        print(f"{name:>7}: {seconds / samples * 1e6:8.2f} us/sample  {samples / seconds:12,.0f} samples/s")
+    print(f"speedup: {results['dict'] / results['struct']:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
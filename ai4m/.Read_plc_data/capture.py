@@ -0,0 +1,356 @@
+"""Compressed columnar capture files of decoded PLC samples.
+
+A capture holds the per-poll samples of one machine exactly as the decoder
+produced them (layout-ordered tuples, see udt_decoder.py) together with the
+host receive time, so replay_capture.py can feed them back through the cycle
+tracking and analytics offline.
+
+File layout (little endian):
+
+    b'AI4MCAP1', uint32 header length, JSON header (machine, udt_tag, names, ...)
+    block*:  b'BLK1', uint32 body length, uint32 rows, uint16 columns, uint32 CRC32 of body
+             body = columns x (codec byte, uint32 payload length), then the payloads
+
+Column 0 is the receive time in integer microseconds, then one column per
+layout member. Every column is zlib-compressed after a codec chosen per block:
+
+    q  int64, delta to the previous row (counters, status codes, clock fields)
+    f  float32 bits XOR the previous row (REAL members, which is most of the UDT)
+    d  float64 bits XOR the previous row (values float32 cannot hold exactly)
+    b  one byte per BOOL
+    j  JSON list, for anything else (None, strings)
+
+A block torn by a crash fails its length or CRC check; readers stop there
+and keep everything before it.
+"""
+import itertools
+import json
+import logging
+import operator
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'AI4MCAP1'
+BLOCK_MAGIC = b'BLK1'
+VERSION = 1
+CAPTURE_SUFFIX = '.cap'
+
+HEADER_LENGTH = struct.Struct('<I')
+BLOCK_HEADER = struct.Struct('<4sIIHI')
+COLUMN_ENTRY = struct.Struct('<cI')
+
+BIG_ENDIAN = sys.byteorder == 'big'
+
+
+class CaptureError(Exception):
+    pass
+
+
+def _pack(values, typecode):
+    packed = array(typecode, values)
+    if BIG_ENDIAN:
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _unpack(payload, typecode):
+    unpacked = array(typecode)
+    unpacked.frombytes(payload)
+    if BIG_ENDIAN:
+        unpacked.byteswap()
+    return unpacked
+
+
+def _xor_previous(words):
+    return [word ^ previous for word, previous in zip(words, itertools.chain((0,), words))]
+
+
+def _encode_column(values):
+    """(codec, uncompressed payload) for one column of a block"""
+    kinds = set(map(type, values))
+    try:
+        if kinds == {bool}:
+            return b'b', bytes(values)
+        if kinds <= {int, bool}:
+            return b'q', _pack([value - previous for value, previous in zip(values, itertools.chain((0,), values))], 'q')
+        if kinds <= {float, int}:
+            try:
+                single = array('f', values)
+            except OverflowError:
+                single = None
+            if single is not None and single.tolist() == list(values):
+                return b'f', _pack(_xor_previous(array('I', single.tobytes()).tolist()), 'I')
+            double = array('d', values)
+            return b'd', _pack(_xor_previous(array('Q', double.tobytes()).tolist()), 'Q')
+    except OverflowError:
+        pass
+    return b'j', json.dumps(list(values), default=str).encode('utf-8')
+
+
+def _decode_column(codec, payload):
+    if codec == b'b':
+        return [bool(value) for value in payload]
+    if codec == b'q':
+        return list(itertools.accumulate(_unpack(payload, 'q')))
+    if codec == b'f':
+        words = array('I', itertools.accumulate(_unpack(payload, 'I'), operator.xor))
+        return array('f', words.tobytes()).tolist()
+    if codec == b'd':
+        words = array('Q', itertools.accumulate(_unpack(payload, 'Q'), operator.xor))
+        return array('d', words.tobytes()).tolist()
+    if codec == b'j':
+        return json.loads(payload)
+    raise CaptureError(f"Unknown column codec {codec!r}")
+
+
+def encode_block(rows, level=6):
+    """One block from (received, sample) rows; received is time.time() seconds"""
+    received = [round(received * 1000000) for received, _ in rows]
+    columns = [received] + [list(column) for column in zip(*[sample for _, sample in rows])]
+    directory = []
+    payloads = []
+    for column in columns:
+        codec, payload = _encode_column(column)
+        payload = zlib.compress(payload, level)
+        directory.append(COLUMN_ENTRY.pack(codec, len(payload)))
+        payloads.append(payload)
+    body = b''.join(directory + payloads)
+    return BLOCK_HEADER.pack(BLOCK_MAGIC, len(body), len(rows), len(columns), zlib.crc32(body)) + body
+
+
+def decode_block(body, columns):
+    """Columns of a block body: [received seconds, member 1, member 2, ...]"""
+    offset = COLUMN_ENTRY.size * columns
+    decoded = []
+    for i in range(columns):
+        codec, length = COLUMN_ENTRY.unpack_from(body, i * COLUMN_ENTRY.size)
+        decoded.append(_decode_column(codec, zlib.decompress(body[offset:offset + length])))
+        offset += length
+    decoded[0] = [us / 1000000.0 for us in decoded[0]]
+    return decoded
+
+
+class CaptureWriter:
+    """Appends blocks to one capture file"""
+
+    def __init__(self, path, names, metadata=None, level=6):
+        self.path = path
+        self.names = list(names)
+        self.level = level
+        header = dict(metadata or {}, version=VERSION, names=self.names, created=time.time())
+        header = json.dumps(header).encode('utf-8')
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+        self.size = self.file.tell()
+        self.rows = 0
+
+    def write_block(self, rows):
+        if not rows:
+            return
+        block = encode_block(rows, self.level)
+        self.file.write(block)
+        self.file.flush()
+        self.size += len(block)
+        self.rows += len(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class CaptureReader:
+    """Iterates the samples of a capture file as (received, sample) pairs"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        if self.file.read(len(MAGIC)) != MAGIC:
+            self.file.close()
+            raise CaptureError(f"{path} is not a capture file")
+        length, = HEADER_LENGTH.unpack(self.file.read(HEADER_LENGTH.size))
+        self.metadata = json.loads(self.file.read(length))
+        self.names = self.metadata['names']
+        self.truncated = False
+
+    def blocks(self):
+        """Decoded blocks as column lists, in file order"""
+        while True:
+            header = self.file.read(BLOCK_HEADER.size)
+            if not header:
+                return
+            if len(header) < BLOCK_HEADER.size:
+                self._torn("block header")
+                return
+            magic, length, rows, columns, crc = BLOCK_HEADER.unpack(header)
+            if magic != BLOCK_MAGIC:
+                self._torn("block marker")
+                return
+            body = self.file.read(length)
+            if len(body) < length or zlib.crc32(body) != crc:
+                self._torn("block body")
+                return
+            yield decode_block(body, columns)
+
+    def _torn(self, part):
+        self.truncated = True
+        logger.warning(f"{self.path}: torn {part} at offset {self.file.tell()}, ignoring the rest of the file")
+
+    def __iter__(self):
+        for columns in self.blocks():
+            received = columns[0]
+            yield from zip(received, zip(*columns[1:]))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class CaptureRecorder:
+    """Records one machine's samples into rotating capture files without blocking acquisition.
+
+    add() only appends to the open block. Full blocks are handed to a
+    background thread that compresses and writes them; if it falls behind by
+    more than max_pending blocks, new blocks are dropped (and counted) rather
+    than stalling the poll loop. A new file is started every rotate_seconds,
+    and the oldest captures of the machine are deleted beyond max_bytes.
+    """
+
+    def __init__(self, directory, name, names, metadata=None, block_rows=2048, rotate_seconds=3600,
+                 max_bytes=4 * 1024 * 1024 * 1024, max_pending=8, level=6):
+        self.directory = directory
+        self.name = name
+        self.names = list(names)
+        self.metadata = dict(metadata or {}, machine=name)
+        self.block_rows = block_rows
+        self.rotate_seconds = rotate_seconds
+        self.max_bytes = max_bytes
+        self.level = level
+        self.rows = []
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.writer = None
+        self.opened = 0.0
+        self.thread = None
+        os.makedirs(directory, exist_ok=True)
+
+        # Metrics
+        self.blocks_written = 0
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.dropped_blocks = 0
+        self.dropped_rows = 0
+        self.write_errors = 0
+        metrics.QUEUE_DEPTH.labels(f"{name}_capture").set_function(self.pending.qsize)
+        metrics.QUEUE_DROPPED.labels(f"{name}_capture").set_function(lambda: self.dropped_rows)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True, name=f"Capture-{self.name}")
+        self.thread.start()
+
+    def add(self, received, sample):
+        """Record one decoded sample received at time.time() received (acquisition thread only)"""
+        self.rows.append((received, sample))
+        if len(self.rows) >= self.block_rows:
+            self._hand_off()
+
+    def _hand_off(self):
+        rows, self.rows = self.rows, []
+        try:
+            self.pending.put_nowait(rows)
+        except queue.Full:
+            self.dropped_blocks += 1
+            self.dropped_rows += len(rows)
+            if self.dropped_blocks == 1 or self.dropped_blocks % 100 == 0:
+                logger.warning(f"{self.name}: capture writer behind, dropped {self.dropped_rows} samples so far")
+
+    def _run(self):
+        while True:
+            rows = self.pending.get()
+            if rows is None:
+                return
+            try:
+                self._write(rows)
+            except OSError as e:
+                self.write_errors += 1
+                logger.error(f"{self.name}: capture write failed, {len(rows)} samples lost: {e}")
+                self._close_file()
+
+    def _write(self, rows):
+        if self.writer is None or time.time() - self.opened >= self.rotate_seconds:
+            self._rotate()
+        before = self.writer.size
+        self.writer.write_block(rows)
+        self.blocks_written += 1
+        self.rows_written += len(rows)
+        self.bytes_written += self.writer.size - before
+
+    def _rotate(self):
+        self._close_file()
+        self.opened = time.time()
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.opened))
+        path = os.path.join(self.directory, f"{self.name}-{stamp}{CAPTURE_SUFFIX}")
+        self.writer = CaptureWriter(path, self.names, self.metadata, self.level)
+        logger.info(f"{self.name}: capturing samples to {path}")
+        self._enforce_limit()
+
+    def _close_file(self):
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except OSError as e:
+                logger.error(f"{self.name}: error closing capture {self.writer.path}: {e}")
+            self.writer = None
+
+    def captures(self):
+        """This machine's capture files, oldest first"""
+        prefix = f"{self.name}-"
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                      if name.startswith(prefix) and name.endswith(CAPTURE_SUFFIX))
+
+    def _enforce_limit(self):
+        captures = [(path, os.path.getsize(path)) for path in self.captures()]
+        total = sum(size for _, size in captures)
+        for path, size in captures:
+            if total <= self.max_bytes or path == self.writer.path:
+                break
+            os.remove(path)
+            total -= size
+            logger.info(f"{self.name}: capture limit reached, deleted {path}")
+
+    def close(self):
+        """Write the open block and close the current file"""
+        if self.rows:
+            self._hand_off()
+        if self.thread is None:
+            while not self.pending.empty():
+                self._write(self.pending.get_nowait())
+        else:
+            self.pending.put(None)
+            self.thread.join(timeout=10)
+        self._close_file()
+
+    def stats(self):
+        return {
+            'file': self.writer.path if self.writer else None,
+            'blocks_written': self.blocks_written,
+            'rows_written': self.rows_written,
+            'bytes_written': self.bytes_written,
+            'bytes_per_sample': self.bytes_written / self.rows_written if self.rows_written else None,
+            'pending_blocks': self.pending.qsize(),
+            'dropped_rows': self.dropped_rows,
+            'write_errors': self.write_errors,
+        }
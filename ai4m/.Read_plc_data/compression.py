@@ -0,0 +1,254 @@
+"""Per-tag compression for slow channels (sealer temperatures, stroke length, ...).
+
+Instead of a full low-speed snapshot every interval, each tag is fed through a
+compressor and only the points it emits are stored, one (timestamp, tag, value)
+row per point. Two algorithms are available per tag:
+
+  deadband       emit when the value moves more than `deviation` away from the
+                 last emitted value. Reconstruct with a step (hold last value).
+  swinging_door  emit when no straight line from the last emitted point stays
+                 within +/- `deviation` of every sample since. Reconstruct with
+                 linear interpolation between emitted points.
+
+In both cases every input sample is within `deviation` of the reconstructed
+value at its timestamp (the newest samples once flush() has run), and a point
+is emitted at least every `max_interval` seconds so that a quiet channel still
+shows it is alive.
+
+Suggested table for the compressed points (one per low-speed table):
+
+    CREATE TABLE mc17_mid_sd (
+        "timestamp" timestamp NOT NULL,
+        tag text NOT NULL,
+        value double precision
+    );
+    CREATE INDEX ON mc17_mid_sd (tag, "timestamp");
+"""
+import bisect
+import fnmatch
+
+COMPRESSION_MODES = ('deadband', 'swinging_door')
+
+
+class DeadbandCompressor:
+    """Emits a sample when it leaves the +/- deviation band around the last emitted value"""
+
+    def __init__(self, deviation, max_interval=300.0):
+        self.deviation = deviation
+        self.max_interval = max_interval
+        self.last_time = None
+        self.last_value = None
+        self.held = None
+
+    def update(self, t, value, stamp=None):
+        """Feed one sample (t in seconds); returns the list of (stamp, value) points to store"""
+        stamp = t if stamp is None else stamp
+        if self.last_value is None or value is None \
+                or abs(value - self.last_value) > self.deviation \
+                or t - self.last_time >= self.max_interval:
+            self.last_time, self.last_value = t, value
+            self.held = None
+            return [(stamp, value)]
+        self.held = (stamp, value)
+        return []
+
+    def flush(self):
+        """Emit the newest unsent sample, e.g. on shutdown"""
+        held, self.held = self.held, None
+        return [held] if held else []
+
+
+class SwingingDoorCompressor:
+    """Swinging-door trending: keeps the longest segments that stay within +/- deviation.
+
+    When the doors close, the segment ends at the previous sample's time on a
+    line that fits every sample since the last emitted point, so the error
+    bound holds exactly (the emitted value may differ from the raw sample by
+    up to deviation).
+    """
+
+    def __init__(self, deviation, max_interval=300.0):
+        self.deviation = deviation
+        self.max_interval = max_interval
+        self.archived = None   # (t, value) of the last emitted point
+        self.held = None       # (t, stamp) of the newest sample not yet emitted
+        self.slope_max = None  # lower door: largest slope to (sample - deviation)
+        self.slope_min = None  # upper door: smallest slope to (sample + deviation)
+
+    def _archive(self, t, value):
+        self.archived = (t, value)
+        self.held = None
+        self.slope_max = float('-inf')
+        self.slope_min = float('inf')
+
+    def _close_segment(self):
+        """Emit the end of the current segment at the held sample"""
+        held_t, held_stamp = self.held
+        archived_t, archived_value = self.archived
+        value = archived_value + (self.slope_max + self.slope_min) / 2 * (held_t - archived_t)
+        self._archive(held_t, value)
+        return (held_stamp, value)
+
+    def update(self, t, value, stamp=None):
+        """Feed one sample (t in seconds); returns the list of (stamp, value) points to store"""
+        stamp = t if stamp is None else stamp
+        if self.archived is None or value is None or self.archived[1] is None:
+            self._archive(t, value)
+            return [(stamp, value)]
+
+        dt = t - self.archived[0]
+        if dt <= 0:
+            return []
+
+        emitted = []
+        if dt >= self.max_interval:
+            # Close the current segment and restart from this sample
+            if self.held:
+                emitted.append(self._close_segment())
+            self._archive(t, value)
+            emitted.append((stamp, value))
+            return emitted
+
+        archived_t, archived_value = self.archived
+        slope_max = max(self.slope_max, (value - self.deviation - archived_value) / dt)
+        slope_min = min(self.slope_min, (value + self.deviation - archived_value) / dt)
+        if slope_max > slope_min:
+            # The doors opened past parallel: the previous sample ends this segment
+            emitted.append(self._close_segment())
+            archived_t, archived_value = self.archived
+            dt = t - archived_t
+            slope_max = (value - self.deviation - archived_value) / dt
+            slope_min = (value + self.deviation - archived_value) / dt
+        self.slope_max, self.slope_min = slope_max, slope_min
+        self.held = (t, stamp)
+        return emitted
+
+    def flush(self):
+        """Emit the end of the open segment, e.g. on shutdown"""
+        if not self.held:
+            return []
+        return [self._close_segment()]
+
+
+def make_compressor(mode, deviation, max_interval):
+    if mode == 'deadband':
+        return DeadbandCompressor(deviation, max_interval)
+    if mode == 'swinging_door':
+        return SwingingDoorCompressor(deviation, max_interval)
+    raise ValueError(f"Unknown compression mode {mode!r}, expected one of {COMPRESSION_MODES}")
+
+
+class TagCompressor:
+    """One compressor per tag, configured from a machine profile's low_speed_compression block.
+
+    config = {
+        "mode": "swinging_door", "deviation": 0.5, "max_interval": 300,
+        "tags": {"*_Temp": {"deviation": 0.5}, "MC_Sachet_Count": {"mode": "deadband", "deviation": 0}}
+    }
+
+    Patterns under "tags" are fnmatch patterns, checked in order; the first
+    match overrides the defaults for that tag.
+    """
+
+    def __init__(self, tags, config):
+        defaults = {
+            'mode': config.get('mode', 'swinging_door'),
+            'deviation': config.get('deviation', 0.5),
+            'max_interval': config.get('max_interval', 300.0),
+        }
+        overrides = config.get('tags', {})
+        self.tags = list(tags)
+        self.settings = {}
+        self.compressors = []
+        for tag in self.tags:
+            settings = dict(defaults)
+            for pattern, override in overrides.items():
+                if fnmatch.fnmatchcase(tag, pattern):
+                    settings.update(override)
+                    break
+            self.settings[tag] = settings
+            self.compressors.append(make_compressor(settings['mode'], settings['deviation'], settings['max_interval']))
+        self.samples_in = 0
+        self.points_out = 0
+
+    def update(self, t, values, stamp=None):
+        """Feed one low-speed sample (values ordered like tags); returns (stamp, tag, value) rows"""
+        rows = []
+        for tag, compressor, value in zip(self.tags, self.compressors, values):
+            for point_stamp, point_value in compressor.update(t, value, stamp):
+                rows.append((point_stamp, tag, point_value))
+        self.samples_in += len(self.tags)
+        self.points_out += len(rows)
+        return rows
+
+    def flush(self):
+        rows = []
+        for tag, compressor in zip(self.tags, self.compressors):
+            for point_stamp, point_value in compressor.flush():
+                rows.append((point_stamp, tag, point_value))
+        self.points_out += len(rows)
+        return rows
+
+    def error_bounds(self):
+        """Maximum reconstruction error per tag"""
+        return {tag: settings['deviation'] for tag, settings in self.settings.items()}
+
+    def stats(self):
+        return {
+            'samples_in': self.samples_in,
+            'points_out': self.points_out,
+            'ratio': self.samples_in / self.points_out if self.points_out else 0.0,
+        }
+
+
+def reconstruct(points, times, mode='swinging_door', max_interval=None):
+    """Values of a compressed tag at the given times.
+
+    points are the stored (t, value) rows of one tag sorted by t; t may be
+    numbers or datetimes as long as points and times use the same kind.
+    swinging_door points are interpolated linearly, deadband points are held.
+    Times before the first point, or further than max_interval past the last
+    point, give None.
+    """
+    if mode not in COMPRESSION_MODES:
+        raise ValueError(f"Unknown compression mode {mode!r}, expected one of {COMPRESSION_MODES}")
+    point_times = [t for t, _ in points]
+    result = []
+    for t in times:
+        i = bisect.bisect_right(point_times, t) - 1
+        if i < 0:
+            result.append(None)
+            continue
+        t0, v0 = points[i]
+        if i + 1 == len(points):
+            stale = max_interval is not None and _seconds(t - t0) > max_interval
+            result.append(None if stale else v0)
+            continue
+        t1, v1 = points[i + 1]
+        if mode == 'deadband' or t == t0 or v0 is None or v1 is None:
+            result.append(v0)
+        else:
+            result.append(v0 + (v1 - v0) * (_seconds(t - t0) / _seconds(t1 - t0)))
+    return result
+
+
+def _seconds(delta):
+    return delta.total_seconds() if hasattr(delta, 'total_seconds') else delta
+
+
+def load_points(conn, table, tag, start, end):
+    """Stored points of one tag covering [start, end], including the points just outside
+    the range so that reconstruct() can interpolate up to its edges"""
+    query = f'''
+        (SELECT "timestamp", value FROM {table}
+          WHERE tag = %s AND "timestamp" < %s ORDER BY "timestamp" DESC LIMIT 1)
+        UNION ALL
+        (SELECT "timestamp", value FROM {table}
+          WHERE tag = %s AND "timestamp" >= %s AND "timestamp" <= %s ORDER BY "timestamp")
+        UNION ALL
+        (SELECT "timestamp", value FROM {table}
+          WHERE tag = %s AND "timestamp" > %s ORDER BY "timestamp" LIMIT 1)
+    '''
+    with conn.cursor() as cursor:
+        cursor.execute(query, (tag, start, tag, start, end, tag, end))
+        return sorted(cursor.fetchall())
@@ -0,0 +1,269 @@
+import datetime
+import io
+import logging
+import struct
+import time
+
+import psycopg2
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# PostgreSQL binary COPY framing
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('!h', -1)
+PG_EPOCH = datetime.datetime(2000, 1, 1)
+PG_EPOCH_OFFSET_MICROS = 946684800 * 1000000  # 2000-01-01 in Unix epoch microseconds
+
+DB_FLUSH_SECONDS = metrics.histogram('ai4m_db_flush_seconds', 'COPY and commit latency per batch', ['table'])
+DB_ROWS_WRITTEN = metrics.counter('ai4m_db_rows_written_total', 'Rows written with COPY', ['table'])
+DB_ROWS_DROPPED = metrics.counter('ai4m_db_rows_dropped_total', 'Rows dropped (buffer overflow or rejected)', ['table'])
+DB_FLUSH_ERRORS = metrics.counter('ai4m_db_flush_errors_total', 'Failed COPY batches', ['table'])
+
+# Column types we know how to encode in binary COPY format.
+# Anything else (numeric, timestamptz, ...) makes the writer fall back to text COPY.
+BINARY_ENCODERS = {
+    'smallint': lambda v: struct.pack('!h', int(v)),
+    'integer': lambda v: struct.pack('!i', int(v)),
+    'bigint': lambda v: struct.pack('!q', int(v)),
+    'real': lambda v: struct.pack('!f', float(v)),
+    'double precision': lambda v: struct.pack('!d', float(v)),
+    'boolean': lambda v: b'\x01' if v else b'\x00',
+    'text': lambda v: str(v).encode('utf-8'),
+    'character varying': lambda v: str(v).encode('utf-8'),
+    'timestamp without time zone': lambda v: struct.pack('!q', _timestamp_micros(v)),
+}
+
+
+def _timestamp_micros(value):
+    """Microseconds since the PostgreSQL epoch for a naive datetime, ISO string or EpochMicros"""
+    epoch_us = getattr(value, 'us', None)
+    if epoch_us is not None:
+        return epoch_us - PG_EPOCH_OFFSET_MICROS
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    return (value - PG_EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def _text_field(value):
+    """Encode one value for text COPY format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class CopyWriter:
+    """Buffers rows for one table and writes them with COPY ... FROM STDIN.
+
+    A flush happens when max_rows rows are buffered or when the oldest buffered
+    row is older than max_latency seconds, whichever comes first. Binary COPY is
+    used when every column type is known, otherwise text COPY.
+    """
+
+    def __init__(self, table, columns, max_rows=200, max_latency=1.0, max_pending=None,
+                 binary=True, stats_interval=60):
+        self.table = table
+        self.columns = list(columns)
+        self.max_rows = max_rows
+        self.max_latency = max_latency
+        self.max_pending = max_pending or max_rows * 50
+        self.binary = binary
+        self.stats_interval = stats_interval
+
+        self.rows = []
+        self.first_row_time = None
+        self.encoders = None  # resolved from information_schema on first flush
+
+        # Metrics
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.flush_count = 0
+        self.flush_errors = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+        self.started = time.monotonic()
+        self.window_start = self.started
+        self.window_rows = 0
+        self.rows_per_sec = 0.0
+        self.flush_metric = DB_FLUSH_SECONDS.labels(table)
+        self.rows_metric = DB_ROWS_WRITTEN.labels(table)
+        self.dropped_metric = DB_ROWS_DROPPED.labels(table)
+        self.errors_metric = DB_FLUSH_ERRORS.labels(table)
+
+    @property
+    def copy_columns(self):
+        return ', '.join(self.columns)
+
+    def add(self, row):
+        """Buffer one row (a sequence matching self.columns)"""
+        if self.first_row_time is None:
+            self.first_row_time = time.monotonic()
+        self.rows.append(row)
+        if len(self.rows) > self.max_pending:
+            overflow = len(self.rows) - self.max_pending
+            del self.rows[:overflow]
+            self.rows_dropped += overflow
+            self.dropped_metric.inc(overflow)
+            logger.warning(f"{self.table}: COPY buffer full, dropped {overflow} oldest rows")
+
+    def is_due(self):
+        """True when the size or latency threshold has been reached"""
+        if not self.rows:
+            return False
+        if len(self.rows) >= self.max_rows:
+            return True
+        return time.monotonic() - self.first_row_time >= self.max_latency
+
+    def flush_if_due(self, conn):
+        """Flush if a threshold has been reached. Returns the number of rows written."""
+        if self.is_due():
+            return self.flush(conn)
+        return 0
+
+    def flush(self, conn):
+        """Write all buffered rows in one COPY and commit.
+
+        On failure the rows stay buffered and the exception is re-raised so the
+        caller can reconnect; the next flush retries them.
+        """
+        if not self.rows:
+            return 0
+        rows = self.rows
+        try:
+            self.write_rows(conn, rows)
+        except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+            # A bad row would fail every retry; drop the batch rather than block the table
+            self.rows_dropped += len(rows)
+            self.dropped_metric.inc(len(rows))
+            self.rows = []
+            self.first_row_time = None
+            logger.error(f"{self.table}: dropped {len(rows)} rows rejected by COPY: {e}")
+            return 0
+        self.rows = []
+        self.first_row_time = None
+        return len(rows)
+
+    def take_rows(self):
+        """Remove and return the buffered rows, e.g. to hand them to the spool"""
+        rows = self.rows
+        self.rows = []
+        self.first_row_time = None
+        return rows
+
+    def write_rows(self, conn, rows):
+        """COPY the given rows and commit, bypassing the buffer.
+
+        Rolls back and re-raises on failure.
+        """
+        start = time.monotonic()
+        try:
+            with conn.cursor() as cursor:
+                if self.encoders is None:
+                    self.encoders = self._resolve_encoders(cursor)
+                payload = None
+                if self.encoders:
+                    try:
+                        payload = self._encode_binary(rows)
+                        sql = f"COPY {self.table} ({self.copy_columns}) FROM STDIN WITH (FORMAT binary)"
+                    except (struct.error, ValueError, TypeError) as e:
+                        logger.warning(f"{self.table}: binary encoding failed ({e}), switching to text COPY")
+                        self.encoders = []
+                if payload is None:
+                    payload = self._encode_text(rows)
+                    sql = f"COPY {self.table} ({self.copy_columns}) FROM STDIN"
+                cursor.copy_expert(sql, payload)
+            conn.commit()
+        except Exception:
+            self.flush_errors += 1
+            self.errors_metric.inc()
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            raise
+        self._record_flush(len(rows), time.monotonic() - start)
+
+    def _resolve_encoders(self, cursor):
+        """Look up column types and return binary encoders, or [] to use text COPY"""
+        if not self.binary:
+            return []
+        schema, _, table = self.table.rpartition('.')
+        cursor.execute(
+            "SELECT column_name, data_type FROM information_schema.columns "
+            "WHERE table_name = %s AND table_schema = COALESCE(NULLIF(%s, ''), current_schema())",
+            (table, schema)
+        )
+        types = {name: data_type for name, data_type in cursor.fetchall()}
+        encoders = []
+        for column in self.columns:
+            data_type = types.get(column.strip('"'))
+            if data_type not in BINARY_ENCODERS:
+                logger.info(f"{self.table}: column {column} has type {data_type}, using text COPY")
+                return []
+            encoders.append(BINARY_ENCODERS[data_type])
+        return encoders
+
+    def _encode_binary(self, rows):
+        buf = io.BytesIO()
+        buf.write(PGCOPY_HEADER)
+        field_count = struct.pack('!h', len(self.columns))
+        for row in rows:
+            buf.write(field_count)
+            for encode, value in zip(self.encoders, row):
+                if value is None:
+                    buf.write(b'\xff\xff\xff\xff')
+                else:
+                    data = encode(value)
+                    buf.write(struct.pack('!i', len(data)))
+                    buf.write(data)
+        buf.write(PGCOPY_TRAILER)
+        buf.seek(0)
+        return buf
+
+    def _encode_text(self, rows):
+        lines = ['\t'.join(_text_field(value) for value in row) for row in rows]
+        return io.StringIO('\n'.join(lines) + '\n')
+
+    def _record_flush(self, row_count, latency):
+        self.rows_written += row_count
+        self.flush_count += 1
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+        self.total_flush_latency += latency
+        self.flush_metric.observe(latency)
+        self.rows_metric.inc(row_count)
+        self.window_rows += row_count
+
+        now = time.monotonic()
+        elapsed = now - self.window_start
+        if elapsed >= self.stats_interval:
+            self.rows_per_sec = self.window_rows / elapsed
+            logger.info(
+                f"{self.table}: {self.rows_per_sec:.1f} rows/s, {self.flush_count} flushes, "
+                f"flush latency last {self.last_flush_latency * 1000:.1f} ms "
+                f"max {self.max_flush_latency * 1000:.1f} ms, dropped {self.rows_dropped}"
+            )
+            self.window_start = now
+            self.window_rows = 0
+
+    def stats(self):
+        """Snapshot of writer metrics"""
+        rows_per_sec = self.rows_per_sec
+        if not rows_per_sec and self.rows_written:
+            rows_per_sec = self.rows_written / max(time.monotonic() - self.started, 1e-6)
+        return {
+            'table': self.table,
+            'pending_rows': len(self.rows),
+            'rows_written': self.rows_written,
+            'rows_dropped': self.rows_dropped,
+            'rows_per_sec': rows_per_sec,
+            'flush_count': self.flush_count,
+            'flush_errors': self.flush_errors,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+            'avg_flush_latency': self.total_flush_latency / self.flush_count if self.flush_count else 0.0,
+        }
@@ -0,0 +1,207 @@
+"""Per-cycle feature extraction.
+
+The ingest already detects machine cycles (cam position wrapping by more than
+280 degrees). CycleFeatureExtractor updates a handful of accumulators on every
+sample and returns one summary row when a cycle ends, so analytics can query
+one row per cycle instead of re-reading and filtering the raw 30 ms rows.
+
+Features per cycle:
+
+  timestamp, end_timestamp, cycle_id, complete, duration_ms, sample_count,
+  sachet_start, sachet_delta, status_code,
+  <window>_peak, <window>_mean, <window>_samples   for every cam window
+  <tag>_peak                                        for every peak tag
+
+A cam window averages one tag over a cam position range, e.g. the horizontal
+sealing pressure between 150 and 190 degrees. Ranges with start > end wrap
+through 0. `complete` is false for the first cycle after start-up and for the
+cycle open at shutdown, which are only partly observed.
+
+Configured per machine profile:
+
+    "cycle_features": {
+      "enabled": true,
+      "table": "mc17_cycles",
+      "cam_windows": {
+        "hor_pressure": {"tag": "MC_Hor_Pressure", "cam": [150, 190]},
+        "ver_pressure": {"tag": "MC_Ver_Pressure", "cam": [150, 190]}
+      },
+      "peak_tags": ["MC_Hor_Sealer_Current", "MC_Ver_Sealer_Current"]
+    }
+
+Print the table definition with:
+
+    python3 cycle_features.py machines.json mc17
+
+Extraction is opt-in: create the table first, then set cycle_features
+enabled in machines.json (extract_cycles in read_mc17.py/read_mc18.py).
+"""
+import json
+import sys
+
+CAM_TAG = 'MC_Cam_Position'
+SACHET_TAG = 'MC_Sachet_Count'
+STATUS_TAG = 'MC_Status_Code'
+
+DEFAULT_CAM_WINDOWS = {
+    'hor_pressure': {'tag': 'MC_Hor_Pressure', 'cam': [150, 190]},
+    'ver_pressure': {'tag': 'MC_Ver_Pressure', 'cam': [150, 190]},
+}
+DEFAULT_PEAK_TAGS = [
+    'MC_Hor_Sealer_Current', 'MC_Ver_Sealer_Current', 'MC_Pulling_Servo_Current',
+    'MC_Fill_Piston_1_Current', 'MC_Fill_Piston_2_Current', 'MC_Web_Puller_Current',
+]
+
+BASE_COLUMNS = [
+    ('"timestamp"', 'timestamp NOT NULL'),
+    ('end_timestamp', 'timestamp'),
+    ('cycle_id', 'integer'),
+    ('complete', 'boolean'),
+    ('duration_ms', 'double precision'),
+    ('sample_count', 'integer'),
+    ('sachet_start', 'bigint'),
+    ('sachet_delta', 'bigint'),
+    ('status_code', 'integer'),
+]
+
+
+def _column(tag):
+    return tag.lower().replace('mc_', '')
+
+
+class CycleFeatureExtractor:
+    """Incremental per-cycle features for one machine.
+
+    Samples can be dicts keyed by tag name (index=None) or tuples, in which
+    case index maps tag names to tuple positions (UdtLayout.index).
+    """
+
+    def __init__(self, config, index=None):
+        windows = config.get('cam_windows', DEFAULT_CAM_WINDOWS)
+        peak_tags = config.get('peak_tags', DEFAULT_PEAK_TAGS)
+        key = (lambda tag: tag) if index is None else (lambda tag: index[tag])
+
+        self.cam_key = key(CAM_TAG)
+        self.sachet_key = key(SACHET_TAG)
+        self.status_key = key(STATUS_TAG)
+        self.windows = []
+        for name, window in windows.items():
+            low, high = window['cam']
+            self.windows.append((name, key(window['tag']), low, high, low > high))
+        self.peak_tags = list(peak_tags)
+        self.peak_keys = [key(tag) for tag in self.peak_tags]
+
+        self.columns = [name for name, _ in BASE_COLUMNS]
+        for name, _, _, _, _ in self.windows:
+            self.columns += [f'{name}_peak', f'{name}_mean', f'{name}_samples']
+        self.columns += [f'{_column(tag)}_peak' for tag in self.peak_tags]
+
+        self.cycle_id = None
+        self.complete = False
+        self.cycles_emitted = 0
+        self._reset()
+
+    @staticmethod
+    def required_tags(config):
+        """Tags a decoder must provide for this configuration"""
+        windows = config.get('cam_windows', DEFAULT_CAM_WINDOWS)
+        return [CAM_TAG, SACHET_TAG, STATUS_TAG] + [w['tag'] for w in windows.values()] + \
+            list(config.get('peak_tags', DEFAULT_PEAK_TAGS))
+
+    def _reset(self):
+        self.start = None
+        self.end = None
+        self.start_seconds = None
+        self.end_seconds = None
+        self.count = 0
+        self.sachet_start = None
+        self.sachet_last = None
+        self.status = None
+        self.window_peaks = [None] * len(self.windows)
+        self.window_sums = [0.0] * len(self.windows)
+        self.window_counts = [0] * len(self.windows)
+        self.peaks = [None] * len(self.peak_keys)
+
+    def update(self, cycle_id, timestamp, seconds, sample):
+        """Add one sample of cycle_id; returns the summary row of the previous cycle
+        when this sample starts a new one, otherwise None"""
+        row = None
+        if cycle_id != self.cycle_id:
+            if self.count:
+                # The cycle lasts until this sample, which also carries its last sachet increment
+                row = self._emit(self.complete, seconds, sample[self.sachet_key])
+            # The first cycle seen was joined part-way through
+            self.complete = self.cycle_id is not None
+            self.cycle_id = cycle_id
+
+        if self.count == 0:
+            self.start = timestamp
+            self.start_seconds = seconds
+            self.sachet_start = sample[self.sachet_key]
+        self.end = timestamp
+        self.end_seconds = seconds
+        self.count += 1
+        self.sachet_last = sample[self.sachet_key]
+        self.status = sample[self.status_key]
+
+        cam = sample[self.cam_key]
+        for i, (_, value_key, low, high, wraps) in enumerate(self.windows):
+            if (low <= cam or cam <= high) if wraps else (low <= cam <= high):
+                value = sample[value_key]
+                peak = self.window_peaks[i]
+                if peak is None or value > peak:
+                    self.window_peaks[i] = value
+                self.window_sums[i] += value
+                self.window_counts[i] += 1
+
+        peaks = self.peaks
+        for i, value_key in enumerate(self.peak_keys):
+            value = sample[value_key]
+            if peaks[i] is None or value > peaks[i]:
+                peaks[i] = value
+        return row
+
+    def flush(self):
+        """Summary row of the open cycle (marked incomplete), e.g. on shutdown"""
+        if not self.count:
+            return None
+        row = self._emit(False, self.end_seconds, self.sachet_last)
+        self.cycle_id = None
+        return row
+
+    def _emit(self, complete, end_seconds, sachet_end):
+        row = [
+            self.start, self.end, self.cycle_id, complete,
+            (end_seconds - self.start_seconds) * 1000.0, self.count,
+            self.sachet_start, sachet_end - self.sachet_start, self.status,
+        ]
+        for i in range(len(self.windows)):
+            count = self.window_counts[i]
+            row += [self.window_peaks[i], self.window_sums[i] / count if count else None, count]
+        row += self.peaks
+        self.cycles_emitted += 1
+        self._reset()
+        return tuple(row)
+
+
+def cycle_table_ddl(table, extractor):
+    types = dict(BASE_COLUMNS)
+    lines = []
+    for column in extractor.columns:
+        if column in types:
+            lines.append(f'    {column} {types[column]}')
+        elif column.endswith('_samples'):
+            lines.append(f'    {column} integer')
+        else:
+            lines.append(f'    {column} double precision')
+    return f"CREATE TABLE {table} (\n" + ",\n".join(lines) + "\n);"
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: python3 cycle_features.py <machines.json> <machine>")
+        sys.exit(1)
+    with open(sys.argv[1], 'r') as f:
+        machines = {machine['name']: machine for machine in json.load(f)['machines']}
+    features = machines[sys.argv[2]].get('cycle_features', {})
+    print(cycle_table_ddl(features.get('table', f"{sys.argv[2]}_cycles"), CycleFeatureExtractor(features)))
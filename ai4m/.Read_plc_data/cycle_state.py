@@ -0,0 +1,115 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CycleStateStore:
+    """Persisted cycle counters so a restart continues the day's cycle_id sequence.
+
+    update() only changes the in-memory state and wakes a background thread,
+    which writes the whole state file atomically (temp file, fsync, rename).
+    Bursts of updates are coalesced into one write. close() stops that thread
+    before the final write, and saves never overlap. The file is a small JSON
+    object keyed by machine name:
+
+        {"mc17": {"day": "2025-06-14", "cycle_id": 41237, "saved_at": 1749890000.1}}
+    """
+
+    def __init__(self, path, min_interval=0.05):
+        self.path = path
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # one writer of the temp file at a time
+        self.dirty = threading.Event()
+        self.thread = None
+        self.closed = False
+        self.writes = 0
+        self.write_errors = 0
+
+        started = time.perf_counter()
+        self.states = self._load()
+        self.load_ms = (time.perf_counter() - started) * 1000
+        if self.states:
+            logger.info(f"Loaded cycle state for {', '.join(self.states)} from {path} in {self.load_ms:.1f} ms")
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                states = json.load(f)
+            return states if isinstance(states, dict) else {}
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.error(f"Ignoring unreadable cycle state file {self.path}: {e}")
+            return {}
+
+    def resume(self, name, day):
+        """Next cycle_id for a machine on day (a date), or None if no checkpoint covers that day"""
+        with self.lock:
+            state = self.states.get(name)
+        if state and state.get('day') == day.isoformat():
+            return state['cycle_id'] + 1
+        return None
+
+    def update(self, name, day, cycle_id):
+        with self.lock:
+            self.states[name] = {'day': day.isoformat(), 'cycle_id': cycle_id, 'saved_at': time.time()}
+        self.dirty.set()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True, name="CycleStateWriter")
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            self.dirty.wait()
+            self.dirty.clear()
+            if self.closed:
+                return  # close() writes the final state
+            self.save()
+            time.sleep(self.min_interval)
+
+    def save(self):
+        # The snapshot is taken under save_lock too, so a later save never writes older state
+        with self.save_lock:
+            with self.lock:
+                payload = json.dumps(self.states)
+            tmp_path = self.path + '.tmp'
+            try:
+                with open(tmp_path, 'w') as f:
+                    f.write(payload)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+                self.writes += 1
+            except OSError as e:
+                self.write_errors += 1
+                logger.error(f"Failed to write cycle state to {self.path}: {e}")
+
+    def close(self):
+        """Stop the writer thread and write the latest state synchronously, e.g. on shutdown"""
+        self.closed = True
+        self.dirty.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.save()
+
+    def stats(self):
+        return {'writes': self.writes, 'write_errors': self.write_errors, 'load_ms': self.load_ms}
+
+
+def max_cycle_id(cursor, table, day):
+    """Highest spare1 (cycle_id) stored for day, using the timestamp index; 0 if none"""
+    start = datetime.datetime.combine(day, datetime.time())
+    cursor.execute(
+        f'SELECT max(spare1) FROM {table} WHERE "timestamp" >= %s AND "timestamp" < %s',
+        (start, start + datetime.timedelta(days=1))
+    )
+    row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else 0
@@ -0,0 +1,121 @@
+import collections
+import threading
+import time
+
+OVERFLOW_POLICIES = ('drop_oldest', 'block')
+
+
+class BoundedEventQueue:
+    """Bounded producer queue for Kafka messages.
+
+    Producers put() items; the sender thread blocks in get_batch() until items
+    arrive (no polling) and drains them in batches. When the queue is full
+    the overflow policy decides what happens:
+
+      drop_oldest  discard the oldest queued item (memory stays bounded)
+      block        wait until the sender makes room (back-pressure on the caller)
+
+    Items that failed to send go back to the head of the queue with requeue().
+    Latency is measured from put() to mark_sent(). The queue lives in memory
+    only; the ingest daemon drains it into the durable Kafka outbox (outbox.py).
+    """
+
+    def __init__(self, capacity=10000, policy='drop_oldest', latency_window=1000):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy!r}, expected one of {OVERFLOW_POLICIES}")
+        self.capacity = capacity
+        self.policy = policy
+        self.items = collections.deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+        # Metrics
+        self.high_water = 0
+        self.total_put = 0
+        self.dropped = 0
+        self.blocked_puts = 0
+        self.sent = 0
+        self.failed = 0
+        self.latencies_ms = collections.deque(maxlen=latency_window)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.items)
+
+    def put(self, item, timeout=None):
+        """Queue one item; returns False if it (or an older item) was dropped or it timed out"""
+        entry = (time.time(), item)
+        with self.lock:
+            self.total_put += 1
+            if len(self.items) >= self.capacity:
+                if self.policy == 'drop_oldest':
+                    self.items.popleft()
+                    self.dropped += 1
+                    self._append(entry)
+                    return False
+                self.blocked_puts += 1
+                if not self.not_full.wait_for(lambda: len(self.items) < self.capacity, timeout):
+                    self.dropped += 1
+                    return False
+            self._append(entry)
+            return True
+
+    def _append(self, entry):
+        self.items.append(entry)
+        if len(self.items) > self.high_water:
+            self.high_water = len(self.items)
+        self.not_empty.notify()
+
+    def get_batch(self, max_items, timeout=None):
+        """Remove up to max_items (enqueued, item) entries, waiting up to timeout for the first one"""
+        with self.lock:
+            if not self.items:
+                self.not_empty.wait_for(lambda: self.items, timeout)
+            count = min(max_items, len(self.items))
+            batch = [self.items.popleft() for _ in range(count)]
+            if count:
+                self.not_full.notify(count)
+            return batch
+
+    def requeue(self, entries):
+        """Put unsent entries back at the head, merged by enqueue time so that
+        failures reported one by one still end up in their original order"""
+        if not entries:
+            return
+        with self.lock:
+            newest = max(enqueued for enqueued, _ in entries)
+            head = []
+            while self.items and self.items[0][0] <= newest:
+                head.append(self.items.popleft())
+            self.items.extendleft(reversed(sorted(head + list(entries), key=lambda entry: entry[0])))
+            if self.policy == 'drop_oldest':
+                while len(self.items) > self.capacity:
+                    self.items.popleft()
+                    self.dropped += 1
+            self.not_empty.notify()
+
+    def mark_sent(self, enqueued):
+        self.sent += 1
+        self.latencies_ms.append((time.time() - enqueued) * 1000)
+
+    def mark_failed(self, count=1):
+        self.failed += count
+
+    def stats(self):
+        with self.lock:
+            depth = len(self.items)
+        latencies = sorted(self.latencies_ms)
+        return {
+            'depth': depth,
+            'capacity': self.capacity,
+            'policy': self.policy,
+            'high_water': self.high_water,
+            'total_put': self.total_put,
+            'dropped': self.dropped,
+            'blocked_puts': self.blocked_puts,
+            'sent': self.sent,
+            'failed': self.failed,
+            'latency_p50_ms': latencies[len(latencies) // 2] if latencies else None,
+            'latency_p99_ms': latencies[int(len(latencies) * 0.99)] if latencies else None,
+        }
@@ -0,0 +1,227 @@
+"""Client side of the PLC gateway (see plc_gateway.py).
+
+GatewayDriver stands in for pycomm3's LogixDriver in tools that read and
+write a few tags, so switching a script to the shared session is a one-line
+change:
+
+    from gateway_client import GatewayDriver
+    with GatewayDriver('141.141.141.128') as plc:      # was LogixDriver(...)
+        plc.read('HMI_Hor_Sealer_Strk_1').value
+        plc.write(('HMI_I_Start', True))
+
+read() and write() return Tag tuples like pycomm3 (tag, value, type, error).
+plc_driver() picks the gateway when it accepts a connection and falls back
+to a direct session otherwise, for tools that must keep working without it:
+
+    from gateway_client import plc_driver
+    with plc_driver('141.141.141.128') as plc:
+
+GatewayClient is the underlying connection; it also subscribes to tags:
+
+    client = GatewayClient()
+    client.subscribe('mc17', ['MC_Status_Code'], 0.5, lambda results, error: ...)
+
+Only the gateway talks to the PLC; this module needs nothing beyond the
+standard library.
+"""
+import collections
+import itertools
+import json
+import logging
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = '/run/ai4m/plc_gateway.sock'
+# Longer than the gateway's worst case (twice its 10 s request timeout), so a write
+# that already reached the PLC comes back as "may still have been executed"
+DEFAULT_TIMEOUT = 25.0
+
+
+class Tag(collections.namedtuple('Tag', 'tag value type error')):
+    """Same fields and truth value as pycomm3.Tag"""
+
+    def __bool__(self):
+        return self.value is not None and self.error is None
+
+
+class GatewayError(Exception):
+    pass
+
+
+def _tags(results):
+    return [Tag(result['tag'], result['value'], result['type'], result['error']) for result in results]
+
+
+class GatewayClient:
+    """One connection to the gateway; thread-safe, requests from several threads share it"""
+
+    def __init__(self, path=DEFAULT_SOCKET, timeout=DEFAULT_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.ids = itertools.count(1)
+        self.waiting = {}  # id -> [Event, answer]
+        self.callbacks = {}  # subscription id -> callback(results, error)
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.file = self.sock.makefile('rb')
+        self.closed = False
+        self.reader = threading.Thread(target=self._receive, daemon=True, name="GatewayClient")
+        self.reader.start()
+
+    def _receive(self):
+        while True:
+            try:
+                line = self.file.readline()
+            except (OSError, ValueError):
+                line = b''
+            if not line:
+                break
+            try:
+                message = json.loads(line)
+            except ValueError as e:
+                logger.error(f"Ignoring malformed message from the PLC gateway: {e}")
+                continue
+            if message.get('update'):
+                callback = self.callbacks.get(message['id'])
+                if callback is None:
+                    continue
+                results = _tags(message['results']) if 'results' in message else None
+                try:
+                    callback(results, message.get('error'))
+                except Exception as e:
+                    logger.error(f"Subscription callback failed: {e}")
+                continue
+            with self.lock:
+                waiter = self.waiting.get(message.get('id'))
+            if waiter:
+                waiter[1] = message
+                waiter[0].set()
+        self.closed = True
+        with self.lock:
+            for waiter in self.waiting.values():
+                waiter[0].set()
+
+    def request(self, message):
+        """Send one request and wait for its answer"""
+        if self.closed:
+            raise GatewayError("connection to the PLC gateway is closed")
+        request_id = next(self.ids)
+        waiter = [threading.Event(), None]
+        with self.lock:
+            self.waiting[request_id] = waiter
+            self.sock.sendall((json.dumps(dict(message, id=request_id)) + '\n').encode('utf-8'))
+        try:
+            if not waiter[0].wait(self.timeout) or waiter[1] is None:
+                raise GatewayError(f"no answer from the PLC gateway for {message['op']}")
+        finally:
+            with self.lock:
+                self.waiting.pop(request_id, None)
+        answer = waiter[1]
+        if 'error' in answer:
+            raise GatewayError(answer['error'])
+        return answer
+
+    def read(self, plc, tags):
+        return _tags(self.request({'op': 'read', 'plc': plc, 'tags': list(tags)})['results'])
+
+    def write(self, plc, pairs):
+        return _tags(self.request({'op': 'write', 'plc': plc, 'tags': [list(pair) for pair in pairs]})['results'])
+
+    def subscribe(self, plc, tags, interval, callback):
+        """Call callback(results, error) with the tags every interval seconds; returns the subscription id.
+        The callback runs on the client's receive thread and should return quickly."""
+        subscription = next(self.ids)
+        self.callbacks[subscription] = callback
+        message = {'op': 'subscribe', 'plc': plc, 'tags': list(tags), 'interval': interval, 'id': subscription}
+        with self.lock:
+            waiter = self.waiting[subscription] = [threading.Event(), None]
+            self.sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        waiter[0].wait(self.timeout)
+        with self.lock:
+            self.waiting.pop(subscription, None)
+        if waiter[1] is None or 'error' in waiter[1]:
+            self.callbacks.pop(subscription, None)
+            raise GatewayError(waiter[1]['error'] if waiter[1] else "no answer from the PLC gateway for subscribe")
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.request({'op': 'unsubscribe', 'subscription': subscription})
+        self.callbacks.pop(subscription, None)
+
+    def stats(self):
+        return self.request({'op': 'stats'})['stats']
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class GatewayDriver:
+    """LogixDriver look-alike for one PLC (machine name or IP address) through the gateway"""
+
+    def __init__(self, plc, path=DEFAULT_SOCKET, timeout=DEFAULT_TIMEOUT):
+        self.plc = plc
+        self.path = path
+        self.timeout = timeout
+        self.client = None
+
+    def open(self):
+        if self.client is None or self.client.closed:
+            self.client = GatewayClient(self.path, self.timeout)
+        return True
+
+    def close(self):
+        if self.client:
+            self.client.close()
+            self.client = None
+
+    @property
+    def connected(self):
+        return self.client is not None and not self.client.closed
+
+    def read(self, *tags):
+        """One Tag for a single tag, otherwise a list, like LogixDriver.read"""
+        self.open()
+        results = self.client.read(self.plc, tags)
+        return results[0] if len(tags) == 1 else results
+
+    def write(self, *tags_values):
+        """write(('tag', value), ...) or write('tag', value), like LogixDriver.write"""
+        if len(tags_values) == 2 and isinstance(tags_values[0], str):
+            tags_values = (tags_values,)
+        self.open()
+        results = self.client.write(self.plc, tags_values)
+        return results[0] if len(tags_values) == 1 else results
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def plc_driver(plc, path=DEFAULT_SOCKET, direct=None, timeout=DEFAULT_TIMEOUT):
+    """GatewayDriver when the gateway accepts a connection on path, otherwise direct(plc) (pycomm3's LogixDriver)"""
+    driver = GatewayDriver(plc, path, timeout)
+    try:
+        driver.open()
+        return driver
+    except OSError as e:
+        # No socket, or a stale one left behind by a gateway that crashed
+        logger.info(f"No PLC gateway at {path} ({e}), opening a direct session to {plc}")
+    if direct is None:
+        from pycomm3 import LogixDriver as direct
+    return direct(plc)
@@ -0,0 +1,963 @@
+"""Multi-machine ingest daemon.
+
+Replaces one read_plc_*/read_mc* process per machine with a single process
+driven by machine profiles in machines.json. Every machine gets its own PLC
+session and acquisition thread; the DB connection pool and the Kafka producer
+are shared by all of them. Kafka gets status-code change events and periodic
+heartbeats keyed by machine (see status_events.py), not one message per poll,
+through a durable outbox that redelivers unacknowledged events in order.
+
+Low-speed tags are written as 5 s min/max/mean/last/count windows (see
+aggregates.py) when low_speed_aggregate is enabled, otherwise as one snapshot
+per interval. With cycle_features enabled, one summary row per machine cycle
+is written as well (see cycle_features.py). Low-speed channels can also be
+stored compressed (deadband or swinging door per tag, see compression.py)
+instead of as full snapshots.
+
+The current cycle_id of every machine is checkpointed to cycle_state.json so a
+restart continues the day's cycle numbering (see cycle_state.py).
+
+When Postgres is unreachable or behind, row batches go to an on-disk spool
+(see spool.py) and are replayed in order once the database is back.
+
+Every PLC session, the database and Kafka are supervised independently (see
+supervisor.py): each reconnects with its own exponential backoff, so a fault in
+one never restarts the others. With tag_cache enabled, a reconnect takes the
+controller tag list and UDT templates from disk instead of uploading them again
+(see tag_cache.py).
+
+Read latency, sample periods, DB flushes, queue depths, Kafka deliveries and
+reconnects are served as Prometheus text on the metrics port (see metrics.py).
+Logging goes through a queue to a rotating, compressed log file with per-call
+site rate limiting (see async_log.py and the "logging" section).
+
+A machine with a "simulate" entry is read from a SimulatedLogixDriver instead
+of its PLC (see sim_plc.py), for load tests such as bench_ingest.py.
+
+With partitions enabled, the raw tables are kept as daily range partitions:
+upcoming days are created ahead and days past retention are dropped, detached
+or archived (see partitions.py).
+
+With rollups enabled, every high- and low-speed tag is also kept as 1 s, 1 min
+and 1 h min/max/mean/count buckets, each written when it closes (see
+rollups.py), so long-range queries do not have to scan the raw tables.
+
+With shared_ring enabled, the last seconds of decoded samples of every machine
+are also published to shared memory, where tools on the same host read the
+latest values without a database query or a PLC session of their own (see
+shared_ring.py).
+
+With rate_tags enabled, tags outside the UDT are read at their own rate class
+(100 ms, 5 s, ...) on the same PLC session, packed into as few multi-service
+requests as the connection size allows, and stored one row per value (see
+tag_scheduler.py).
+
+With capture enabled, every decoded sample is also recorded with its host
+receive time into compressed capture files (see capture.py), which
+replay_capture.py feeds back through the cycle tracking offline.
+
+Usage: python3 ingest_daemon.py [machines.json]
+"""
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+import psycopg2
+from psycopg2 import pool
+from pycomm3 import LogixDriver
+from kafka import KafkaProducer
+
+import async_log
+import metrics
+from aggregates import WindowAggregator, aggregate_columns
+from capture import CaptureRecorder
+from compression import TagCompressor
+from copy_writer import CopyWriter
+from cycle_features import CycleFeatureExtractor
+from cycle_state import CycleStateStore, max_cycle_id
+from event_queue import BoundedEventQueue
+from outbox import KafkaOutbox
+from partitions import PartitionManager
+from ring_buffer import SampleRingBuffer
+from rollups import RESOLUTIONS, RollupAggregator, rollup_columns, rollup_tables, rollup_tags
+from scheduler import FixedRateScheduler
+from shared_ring import SharedSampleRing
+from tag_scheduler import RateClassScheduler, flatten, load_rate_tags
+from sim_plc import SimulatedLogixDriver
+from spool import Spool
+from status_events import StatusEventTracker
+from supervisor import Supervisor
+from tag_cache import CachedLogixDriver, cache_options
+from udt_decoder import DictDecoder, EpochMicros, UdtDecoder, UdtLayout
+
+logger = logging.getLogger(__name__)
+
+
+def load_tags(path):
+    """Load the tag list from a high/low speed JSON file"""
+    with open(path, 'r') as f:
+        return json.load(f)['tags']
+
+
+def tag_column(tag):
+    """Column name for a UDT member, e.g. MC_Hor_Pressure -> hor_pressure"""
+    return tag.lower().replace('mc_', '')
+
+
+class MachineProfile:
+    """Static configuration of one machine, built from an entry in machines.json"""
+
+    def __init__(self, config, base_dir='.'):
+        self.name = config['name']
+        self.ip = config['ip']
+        self.udt_tag = config['udt_tag']
+        self.high_speed_table = config['high_speed_table']
+        self.low_speed_table = config['low_speed_table']
+        self.kafka_key = config.get('kafka_key', self.name)
+        self.heartbeat_interval = config.get('status_heartbeat_interval', 30)
+        self.low_speed_spare_columns = config.get('low_speed_spare_columns', 1)
+        self.period = config.get('period', 0.03)
+        self.low_speed_interval = config.get('low_speed_interval', 5)
+        self.buffer_capacity = config.get('buffer_capacity', 2000)
+        self.fast_decode = config.get('fast_decode', True)
+        self.simulate = config.get('simulate')
+        shared_ring = config.get('shared_ring', {})
+        self.shared_ring_enabled = shared_ring.get('enabled', False)
+        self.shared_ring_seconds = shared_ring.get('seconds', 60)
+        capture = config.get('capture', {})
+        self.capture_enabled = capture.get('enabled', False)
+        self.capture_directory = os.path.join(base_dir, capture.get('directory', 'captures'))
+        self.capture_block_rows = capture.get('block_rows', 2048)
+        self.capture_rotate_seconds = capture.get('rotate_minutes', 60) * 60
+        self.capture_max_bytes = capture.get('max_mb', 4096) * 1024 * 1024
+        aggregate = config.get('low_speed_aggregate', {})
+        self.aggregate_enabled = aggregate.get('enabled', False)
+        self.aggregate_table = aggregate.get('table', f"{self.low_speed_table}_agg")
+        self.cycle_features = config.get('cycle_features', {})
+        self.cycle_features_enabled = self.cycle_features.get('enabled', False)
+        self.cycle_table = self.cycle_features.get('table', f"{self.name}_cycles")
+        self.compression = config.get('low_speed_compression', {})
+        self.compression_enabled = self.compression.get('enabled', False)
+        self.compressed_table = self.compression.get('table', f"{self.low_speed_table}_sd")
+        self.compression_interval = self.compression.get('input_interval', 1.0)
+        self.keep_snapshots = self.compression.get('keep_snapshots', False)
+        self.high_speed_tags = load_tags(os.path.join(base_dir, config['high_speed_tags']))
+        self.low_speed_tags = load_tags(os.path.join(base_dir, config['low_speed_tags']))
+        rate_tags = config.get('rate_tags', {})
+        self.rate_tags_enabled = rate_tags.get('enabled', False)
+        self.rate_tags_table = rate_tags.get('table', f"{self.name}_tags")
+        self.rate_tags = load_rate_tags(os.path.join(base_dir, rate_tags['tags'])) if self.rate_tags_enabled else []
+        rollups = config.get('rollups', {})
+        self.rollups_enabled = rollups.get('enabled', False)
+        self.rollup_tables = dict(rollup_tables(self.high_speed_table), **rollups.get('tables', {}))
+        self.rollup_tags = rollup_tags(self.high_speed_tags, self.low_speed_tags)
+
+    @property
+    def high_speed_columns(self):
+        return ['"timestamp"'] + [tag_column(tag) for tag in self.high_speed_tags] + ['spare1']
+
+    @property
+    def low_speed_columns(self):
+        spares = [f'spare{i}' for i in range(1, self.low_speed_spare_columns + 1)]
+        return ['"timestamp"'] + [tag_column(tag) for tag in self.low_speed_tags] + spares
+
+    @property
+    def aggregate_columns(self):
+        return aggregate_columns(self.low_speed_tags)
+
+    @property
+    def rollup_columns(self):
+        return rollup_columns(self.rollup_tags)
+
+
+class MachineIngest:
+    """PLC session, acquisition loop and cycle tracking for one machine"""
+
+    def __init__(self, profile, daemon):
+        self.profile = profile
+        self.daemon = daemon
+        self.name = profile.name
+
+        self.plc = None
+        self.reconnect_requested = False
+        self.health = daemon.supervisor.component(f"plc:{self.name}", **daemon.backoff)
+        self.read_latency = metrics.PLC_READ_SECONDS.labels(self.name)
+        self.read_errors = metrics.PLC_READ_ERRORS.labels(self.name)
+        self.connects = metrics.PLC_CONNECTS.labels(self.name, 'ok')
+        self.connect_failures = metrics.PLC_CONNECTS.labels(self.name, 'error')
+        self.cycle_id = 1
+        self.last_cam_position = None
+        self.current_day = None
+        self.saved_cycle_id = None
+        self.last_message_time = time.time()
+        self.last_low_speed_insert = 0
+        self.sample_errors = 0
+        metrics.SAMPLE_ERRORS.labels(self.name).set_function(lambda: self.sample_errors)
+
+        extra_tags = ['MC_Cam_Position', 'MC_Status_Code']
+        if profile.cycle_features_enabled:
+            extra_tags += CycleFeatureExtractor.required_tags(profile.cycle_features)
+        self.layout = UdtLayout(profile.high_speed_tags, profile.low_speed_tags, extra_tags=extra_tags)
+        self.cam_index = self.layout.index['MC_Cam_Position']
+        self.status_index = self.layout.index['MC_Status_Code']
+        self.low_speed_spares = (None,) * (profile.low_speed_spare_columns - 1)
+        self.decoder = DictDecoder(self.layout, profile.udt_tag)
+
+        self.status_events = StatusEventTracker(profile.kafka_key, profile.heartbeat_interval)
+
+        self.sample_buffer = SampleRingBuffer(capacity=profile.buffer_capacity)
+        metrics.QUEUE_DEPTH.labels(f"{self.name}_samples").set_function(lambda: self.sample_buffer.size)
+        metrics.QUEUE_DROPPED.labels(f"{self.name}_samples").set_function(lambda: self.sample_buffer.overflow_count)
+        self.last_overflow_count = 0
+        self.scheduler = FixedRateScheduler(period=profile.period, policy='skip', name=profile.name)
+        self.high_speed_writer = CopyWriter(profile.high_speed_table, profile.high_speed_columns,
+                                            max_rows=100, max_latency=1.0)
+        self.low_speed_window = None
+        if profile.aggregate_enabled:
+            self.low_speed_window = WindowAggregator(profile.low_speed_tags, profile.low_speed_interval)
+            self.low_speed_writer = CopyWriter(profile.aggregate_table, profile.aggregate_columns,
+                                               max_rows=6, max_latency=10.0)
+        else:
+            self.low_speed_writer = CopyWriter(profile.low_speed_table, profile.low_speed_columns,
+                                               max_rows=6, max_latency=10.0)
+
+        self.cycle_extractor = None
+        self.cycle_writer = None
+        if profile.cycle_features_enabled:
+            self.cycle_extractor = CycleFeatureExtractor(profile.cycle_features, self.layout.index)
+            self.cycle_writer = CopyWriter(profile.cycle_table, self.cycle_extractor.columns,
+                                           max_rows=50, max_latency=10.0)
+
+        self.compressor = None
+        self.compressed_writer = None
+        self.last_compression_input = 0
+        if profile.compression_enabled:
+            self.compressor = TagCompressor(profile.low_speed_tags, profile.compression)
+            self.compressed_writer = CopyWriter(profile.compressed_table, ['"timestamp"', 'tag', 'value'],
+                                                max_rows=200, max_latency=10.0)
+            logger.info(f"{self.name}: compressing low-speed tags into {profile.compressed_table}, "
+                        f"max error per tag: {self.compressor.error_bounds()}")
+
+        self.rollup = None
+        self.rollup_writers = ()
+        if profile.rollups_enabled:
+            self.rollup = RollupAggregator(profile.rollup_tags, [seconds for _, seconds, _ in RESOLUTIONS])
+            self.rollup_values = self.layout.getter(profile.rollup_tags)
+            self.rollup_writers = tuple(
+                CopyWriter(profile.rollup_tables[label], profile.rollup_columns, max_rows=60, max_latency=2.0)
+                for label, _, _ in RESOLUTIONS
+            )
+
+        self.tag_scheduler = None
+        self.tag_writer = None
+        if profile.rate_tags_enabled:
+            self.tag_scheduler = RateClassScheduler(profile.rate_tags, name=self.name)
+            self.tag_buffer = SampleRingBuffer(capacity=profile.buffer_capacity)
+            metrics.QUEUE_DEPTH.labels(f"{self.name}_tags").set_function(lambda: self.tag_buffer.size)
+            self.tag_writer = CopyWriter(profile.rate_tags_table, ['"timestamp"', 'tag', 'value'],
+                                         max_rows=500, max_latency=2.0)
+            self.tag_errors = 0
+
+        self.shared_ring = None
+        if profile.shared_ring_enabled:
+            slots = max(1, int(profile.shared_ring_seconds / profile.period))
+            self.shared_ring = SharedSampleRing(self.name, self.layout.names, slots)
+
+        self.capture = None
+        if profile.capture_enabled:
+            self.capture = CaptureRecorder(
+                profile.capture_directory, self.name, self.layout.names,
+                metadata={'udt_tag': profile.udt_tag, 'period': profile.period},
+                block_rows=profile.capture_block_rows,
+                rotate_seconds=profile.capture_rotate_seconds,
+                max_bytes=profile.capture_max_bytes
+            )
+
+    @property
+    def writers(self):
+        writers = (self.high_speed_writer, self.low_speed_writer)
+        if self.cycle_writer:
+            writers += (self.cycle_writer,)
+        if self.compressed_writer:
+            writers += (self.compressed_writer,)
+        if self.tag_writer:
+            writers += (self.tag_writer,)
+        return writers + self.rollup_writers
+
+    def connect_plc(self):
+        """Connect to the PLC using LogixDriver with continuous retry until shutdown"""
+        while not self.daemon.stopping.is_set():
+            try:
+                self.close_plc()
+                if self.profile.simulate is not None:
+                    self.plc = SimulatedLogixDriver(self.profile.ip, udt_tag=self.profile.udt_tag,
+                                                    members=self.layout.names, **self.profile.simulate)
+                elif self.daemon.tag_cache is not None:
+                    self.plc = CachedLogixDriver(self.profile.ip, **self.daemon.tag_cache)
+                else:
+                    self.plc = LogixDriver(self.profile.ip)
+                self.plc.open()
+                self.reconnect_requested = False
+                self.decoder = self.build_decoder()
+                if self.tag_scheduler:
+                    self.tag_scheduler.configure(self.plc)
+                self.connects.inc()
+                logger.info(f"{self.name}: connected to PLC at {self.profile.ip} ({type(self.decoder).__name__})")
+                return
+            except Exception as e:
+                logger.error(f"{self.name}: failed to connect to PLC at {self.profile.ip}: {e}")
+                self.connect_failures.inc()
+                self.health.failed(e)
+
+    def build_decoder(self):
+        """Struct decoder from the uploaded UDT template, or the dict path if that is not possible"""
+        if self.profile.fast_decode:
+            try:
+                return UdtDecoder.from_plc(self.plc, self.profile.udt_tag, self.layout)
+            except (KeyError, ValueError) as e:
+                logger.warning(f"{self.name}: fast UDT decoding unavailable ({e}), using dict decoding")
+        return DictDecoder(self.layout, self.profile.udt_tag)
+
+    def close_plc(self):
+        try:
+            if self.plc:
+                self.plc.close()
+        except Exception as e:
+            logger.error(f"{self.name}: error closing PLC session: {e}")
+        self.plc = None
+
+    def read_plc_data(self):
+        """Read and decode the machine UDT from the PLC, reconnecting as needed; None on shutdown"""
+        while not self.daemon.stopping.is_set():
+            try:
+                if self.reconnect_requested or not self.plc or not self.plc.connected:
+                    self.connect_plc()
+                    if not self.plc:
+                        continue
+
+                started = time.perf_counter()
+                raw = self.decoder.read(self.plc)
+                self.read_latency.observe(time.perf_counter() - started)
+                if raw is None:
+                    self.read_errors.inc()
+                    if isinstance(self.decoder, UdtDecoder):
+                        logger.warning(f"{self.name}: raw UDT read failed, falling back to dict decoding")
+                        self.decoder = DictDecoder(self.layout, self.profile.udt_tag)
+                        continue
+                    logger.warning(f"{self.name}: no data read from PLC. Retrying.")
+                    self.health.degraded("no data read")
+                    time.sleep(1)
+                    continue
+
+                sample = self.decoder.decode(raw)
+                self.last_message_time = time.time()
+                # The session counts as recovered once it delivers data, not when it opens
+                self.health.healthy()
+                if self.shared_ring:
+                    self.shared_ring.publish(self.last_message_time, sample)
+                if self.capture:
+                    self.capture.add(self.last_message_time, sample)
+                return sample
+
+            except KeyError as e:
+                logger.error(f"{self.name}: tag {e} not found in PLC data.")
+                time.sleep(1)
+            except Exception as e:
+                logger.error(f"{self.name}: error reading from PLC: {e}. Attempting to reconnect.")
+                self.read_errors.inc()
+                self.reconnect_requested = True
+                self.health.failed(e)
+        return None
+
+    def track_status(self, sample, timestamp):
+        """Queue a Kafka event when the status code changes or a heartbeat is due (in PLC time).
+        Called from buffer_sample, on the DB writer thread that owns cycle_id."""
+        event = self.status_events.update(sample[self.status_index], timestamp, self.cycle_id, timestamp.seconds())
+        if event:
+            self.daemon.enqueue_status_event(self, event)
+
+    def acquire_plc_data(self):
+        """Poll the PLC on fixed deadlines and push decoded samples into the ring buffer until shutdown"""
+        while not self.daemon.stopping.is_set():
+            self.scheduler.wait()
+            sample = self.read_plc_data()
+            if sample is None:
+                break
+            self.sample_buffer.put(sample)
+            if self.tag_scheduler:
+                self.read_rate_tags(sample)
+
+    def read_rate_tags(self, sample):
+        """Read the rate-class tags that are due, stamped with the PLC time of the sample just read"""
+        try:
+            results = self.tag_scheduler.tick(self.plc)
+        except Exception as e:
+            logger.error(f"{self.name}: error reading rate-class tags: {e}. Attempting to reconnect.")
+            self.read_errors.inc()
+            self.reconnect_requested = True
+            return
+        if not results:
+            return
+        values = []
+        for tag, result in results:
+            if result.error is None:
+                values.append((tag, result.value))
+            else:
+                self.tag_errors += 1
+                logger.warning(f"{self.name}: reading {tag} failed: {result.error}")
+        self.tag_buffer.put((self.layout.timestamp(sample), values))
+
+    def buffer_tag_values(self, timestamp, values):
+        """One row per number in the tag values; structures and arrays are flattened"""
+        for tag, value in values:
+            for name, number in flatten(tag, value):
+                self.tag_writer.add((timestamp, name, number))
+
+    def buffer_sample(self, sample):
+        """Track the cycle for one decoded sample and buffer its rows for the COPY writers"""
+        timestamp = self.layout.timestamp(sample)
+
+        current_day = timestamp.day
+        if self.current_day is None:
+            self.current_day = current_day
+            self.cycle_id = self.resume_cycle_id(timestamp)
+        elif current_day != self.current_day:
+            self.cycle_id = 1
+            self.current_day = current_day
+
+        current_cam_position = sample[self.cam_index]
+        if self.last_cam_position is not None:
+            position_diff = abs(current_cam_position - self.last_cam_position)
+            if position_diff > 280:
+                self.cycle_id += 1
+        self.last_cam_position = current_cam_position
+        if self.cycle_id != self.saved_cycle_id:
+            self.daemon.cycle_state.update(self.name, timestamp.to_datetime().date(), self.cycle_id)
+            self.saved_cycle_id = self.cycle_id
+        self.track_status(sample, timestamp)
+
+        self.high_speed_writer.add((timestamp,) + self.layout.high_speed(sample) + (self.cycle_id,))
+
+        current_time = timestamp.seconds()
+        if self.rollup:
+            closed = self.rollup.add(current_time, self.rollup_values(sample))
+            if closed:
+                self.add_rollups(closed)
+
+        if self.cycle_extractor:
+            cycle_row = self.cycle_extractor.update(self.cycle_id, timestamp, current_time, sample)
+            if cycle_row:
+                self.cycle_writer.add(cycle_row)
+
+        if self.compressor:
+            if current_time - self.last_compression_input >= self.profile.compression_interval:
+                for row in self.compressor.update(current_time, self.layout.low_speed(sample), timestamp):
+                    self.compressed_writer.add(row)
+                self.last_compression_input = current_time
+            if not self.profile.keep_snapshots:
+                return
+
+        if self.low_speed_window:
+            closed = self.low_speed_window.add(current_time, self.layout.low_speed(sample), self.cycle_id)
+            if closed:
+                self.add_low_speed_window(closed)
+        elif current_time - self.last_low_speed_insert >= self.profile.low_speed_interval:
+            self.low_speed_writer.add((timestamp,) + self.layout.low_speed(sample) + (self.cycle_id,) + self.low_speed_spares)
+            self.last_low_speed_insert = current_time
+
+    def resume_cycle_id(self, timestamp):
+        """First cycle_id after a (re)start: continue from the checkpoint, or from the
+        highest cycle_id stored today if there is no checkpoint for today"""
+        day = timestamp.to_datetime().date()
+        cycle_id = self.daemon.cycle_state.resume(self.name, day)
+        if cycle_id is not None:
+            logger.info(f"{self.name}: resuming at cycle {cycle_id} from checkpoint")
+            return cycle_id
+        try:
+            cycle_id = self.daemon.max_cycle_id(self.profile.high_speed_table, day) + 1
+            logger.info(f"{self.name}: no checkpoint for {day}, resuming at cycle {cycle_id} from {self.profile.high_speed_table}")
+            return cycle_id
+        except Exception as e:
+            logger.error(f"{self.name}: could not look up today's last cycle ({e}), starting at cycle 1")
+            return 1
+
+    def add_low_speed_window(self, closed):
+        window_start, count, aggregates, cycle_id = closed
+        self.low_speed_writer.add((EpochMicros(round(window_start * 1000000)), count) + aggregates + (cycle_id,))
+
+    def add_rollups(self, closed):
+        for level, bucket_start, count, aggregates in closed:
+            self.rollup_writers[level].add((EpochMicros(round(bucket_start * 1000000)), count) + aggregates)
+
+    def close_windows(self):
+        """Emit the open cycle summary, aggregate window, rollup buckets and compression segments before shutdown"""
+        if self.cycle_extractor:
+            cycle_row = self.cycle_extractor.flush()
+            if cycle_row:
+                self.cycle_writer.add(cycle_row)
+        if self.low_speed_window:
+            closed = self.low_speed_window.flush()
+            if closed:
+                self.add_low_speed_window(closed)
+        if self.rollup:
+            self.add_rollups(self.rollup.flush())
+        if self.compressor:
+            for row in self.compressor.flush():
+                self.compressed_writer.add(row)
+
+    def stats(self):
+        return {
+            'machine': self.name,
+            'cycle_id': self.cycle_id,
+            'sample_errors': self.sample_errors,
+            'buffer': self.sample_buffer.stats(),
+            'scheduler': self.scheduler.stats(),
+            'writers': [writer.stats() for writer in self.writers],
+            'status_events': self.status_events.stats(),
+            'cycles_emitted': self.cycle_extractor.cycles_emitted if self.cycle_extractor else None,
+            'compression': self.compressor.stats() if self.compressor else None,
+            'rate_tags': dict(self.tag_scheduler.stats(), errors=self.tag_errors) if self.tag_scheduler else None,
+            'rollup_buckets': dict(zip([label for label, _, _ in RESOLUTIONS], self.rollup.buckets_closed))
+            if self.rollup else None,
+            'health': self.health.stats(),
+            'shared_ring': self.shared_ring.stats() if self.shared_ring else None,
+            'capture': self.capture.stats() if self.capture else None,
+        }
+
+
+class IngestDaemon:
+    """Polls every configured machine concurrently and shares the DB pool and Kafka producer"""
+
+    def __init__(self, config_path='machines.json'):
+        with open(config_path, 'r') as f:
+            config = json.load(f)
+        base_dir = os.path.dirname(os.path.abspath(config_path))
+
+        self.db_settings = config['database']
+        self.db_writers = config.get('db_pool', {}).get('writers', 2)
+        self.db_batch_size = 200
+        self.kafka_topic = config['kafka']['topic']
+        self.kafka_bootstrap_servers = config['kafka']['bootstrap_servers']
+        self.kafka_linger_ms = config['kafka'].get('linger_ms', 20)
+        self.kafka_batch_size = config['kafka'].get('batch_size', 16384)
+        self.kafka_compression = config['kafka'].get('compression_type')
+        kafka_queue = config['kafka'].get('queue', {})
+        kafka_outbox = config['kafka'].get('outbox', {})
+        self.kafka_send_batch = kafka_outbox.get('send_batch', 50)
+        self.kafka_block_timeout = kafka_queue.get('block_timeout', 1.0)
+        self.last_kafka_dropped = 0
+        self.timeout = 30
+
+        self.supervisor = Supervisor()
+        self.backoff = config.get('reconnect_backoff', {})
+        self.db_health = self.supervisor.component('db', **self.backoff)
+        self.kafka_health = self.supervisor.component('kafka', **self.backoff)
+        self.last_health_summary = None
+        self.metrics_port = config.get('metrics', {}).get('port')
+        self.tag_cache = cache_options(config, base_dir)
+        partition_config = config.get('partitions', {})
+        self.partition_manager = None
+        if partition_config.get('enabled'):
+            self.partition_manager = PartitionManager(config['database'], partition_config, base_dir)
+
+        self.machines = [
+            MachineIngest(MachineProfile(machine, base_dir), self)
+            for machine in config['machines'] if machine.get('enabled', True)
+        ]
+        if not self.machines:
+            logger.error(f"No enabled machines in {config_path}")
+            sys.exit(1)
+
+        spool_config = config.get('spool', {})
+        self.spool = Spool(
+            os.path.join(base_dir, spool_config.get('directory', 'spool')),
+            segment_bytes=spool_config.get('segment_mb', 16) * 1024 * 1024,
+            max_bytes=spool_config.get('max_mb', 2048) * 1024 * 1024,
+            fsync_interval=spool_config.get('fsync_interval', 0.5)
+        )
+        self.spool_replay_batch = spool_config.get('replay_batch', 50)
+        self.writers_by_table = {writer.table: writer for machine in self.machines for writer in machine.writers}
+
+        # minconn=0 so startup does not block on the database; connections open on demand.
+        # One connection per DB writer thread plus one for spool replay.
+        self.db_pool = pool.ThreadedConnectionPool(0, self.db_writers + 1, **self.db_settings)
+        self.producer = None
+        # Events pass through a small in-memory queue so the acquisition threads never wait
+        # on disk; the outbox writer persists them and the sender delivers them in order.
+        self.kafka_queue = BoundedEventQueue(
+            capacity=kafka_queue.get('capacity', 10000),
+            policy=kafka_queue.get('policy', 'drop_oldest')
+        )
+        self.kafka_outbox = KafkaOutbox(
+            os.path.join(base_dir, kafka_outbox.get('directory', 'spool/kafka')),
+            max_bytes=kafka_outbox.get('max_mb', 256) * 1024 * 1024,
+            fsync_interval=spool_config.get('fsync_interval', 0.5)
+        )
+        self.stopping = threading.Event()
+        self.events_closed = threading.Event()  # set once nothing enqueues status events any more
+        metrics.QUEUE_DEPTH.labels('kafka').set_function(lambda: len(self.kafka_queue.items))
+        metrics.QUEUE_DROPPED.labels('kafka').set_function(lambda: self.kafka_queue.dropped)
+        metrics.BACKLOG_BYTES.labels('db_spool').set_function(lambda: self.spool.total_bytes)
+        metrics.BACKLOG_BYTES.labels('kafka_outbox').set_function(lambda: self.kafka_outbox.log.total_bytes)
+        self.cycle_state = CycleStateStore(os.path.join(base_dir, config.get('cycle_state', {}).get('path', 'cycle_state.json')))
+
+    def max_cycle_id(self, table, day):
+        conn = self.db_pool.getconn()
+        broken = False
+        try:
+            with conn.cursor() as cursor:
+                return max_cycle_id(cursor, table, day)
+        except (psycopg2.InterfaceError, psycopg2.OperationalError):
+            broken = True
+            raise
+        finally:
+            if not broken:
+                conn.rollback()
+            self.db_pool.putconn(conn, close=broken or conn.closed != 0)
+
+    def enqueue_status_event(self, machine, event):
+        self.kafka_queue.put((machine.profile.kafka_key, event), timeout=self.kafka_block_timeout)
+
+    def spool_writers(self, writers):
+        """Move buffered rows to the on-disk spool"""
+        for writer in writers:
+            rows = writer.take_rows()
+            if rows:
+                self.spool.append(writer.table, rows)
+
+    def flush_machine(self, machine, force=False):
+        """Flush due writers of one machine on a pooled connection.
+
+        While the spool still holds unreplayed batches, new batches are spooled
+        too so that rows reach Postgres in order. If the flush fails on a
+        connection error the rows are spooled before the error is re-raised.
+        Any other database error (a missing table, say) only affects its own
+        writer: its rows stay buffered for the next flush, the failure is
+        counted in the writer's flush_errors, and the other tables are still
+        written.
+        """
+        writers = [writer for writer in machine.writers if force or writer.is_due()]
+        if not writers:
+            return
+        if self.spool.has_pending():
+            self.spool_writers(writers)
+            return
+        conn = None
+        broken = False
+        try:
+            conn = self.db_pool.getconn()
+            for writer in writers:
+                try:
+                    writer.flush(conn)
+                except (psycopg2.InterfaceError, psycopg2.OperationalError):
+                    raise
+                except psycopg2.Error as e:
+                    logger.error(f"{machine.name}: writing {writer.table} failed "
+                                 f"({writer.flush_errors} failures so far): {e}")
+            self.db_health.healthy()
+        except (psycopg2.InterfaceError, psycopg2.OperationalError):
+            broken = True
+            self.spool_writers(writers)
+            raise
+        finally:
+            if conn is not None:
+                self.db_pool.putconn(conn, close=broken or conn.closed != 0)
+
+    def replay_spool(self):
+        """Replay spooled batches into Postgres, in order, whenever the database is reachable.
+
+        A batch rejected by anything other than a connection error (bad rows, a
+        missing table) would fail every retry and keep all writers spooling, so
+        it is dropped and counted like a rejected COPY in CopyWriter.flush.
+        """
+        while not self.stopping.is_set():
+            records = self.spool.read_batch(self.spool_replay_batch)
+            if not records:
+                self.spool.replay_finished()
+                time.sleep(1)
+                continue
+            conn = None
+            broken = None
+            replayed = []
+            try:
+                conn = self.db_pool.getconn()
+                for position, table, rows in records:
+                    writer = self.writers_by_table.get(table)
+                    if writer is None:
+                        logger.error(f"Spool: no writer for table {table}, skipping {len(rows)} rows")
+                    else:
+                        try:
+                            writer.write_rows(conn, rows)
+                        except (psycopg2.InterfaceError, psycopg2.OperationalError):
+                            raise
+                        except psycopg2.Error as e:
+                            writer.rows_dropped += len(rows)
+                            writer.dropped_metric.inc(len(rows))
+                            logger.error(f"Spool: {table} rejected {len(rows)} rows, dropping them: {e}")
+                    replayed.append((position, len(rows)))
+            except (psycopg2.InterfaceError, psycopg2.OperationalError) as e:
+                broken = e
+                logger.warning(f"Spool replay waiting for database: {e}")
+            except Exception as e:
+                logger.error(f"Spool replay error: {e}")
+            finally:
+                if conn is not None:
+                    self.db_pool.putconn(conn, close=broken is not None or conn.closed != 0)
+            if replayed:
+                self.spool.ack(replayed[-1][0])
+                self.spool.record_replay(len(replayed), sum(count for _, count in replayed))
+            if broken is not None:
+                # Spool replay drives the database reconnects while the writers spool
+                self.db_health.failed(broken)
+            elif len(replayed) < len(records):
+                time.sleep(5)
+            else:
+                self.db_health.healthy()
+
+    def write_to_db(self, machines):
+        """Drain the ring buffers of the given machines and write them with COPY"""
+        while not self.stopping.is_set():
+            drained = 0
+            for machine in machines:
+                samples = machine.sample_buffer.get_batch(self.db_batch_size, timeout=0)
+                drained += len(samples)
+                for sample in samples:
+                    try:
+                        machine.buffer_sample(sample)
+                    except Exception as e:
+                        # One bad sample must not end the writer thread of the whole group
+                        machine.sample_errors += 1
+                        logger.error(f"{machine.name}: buffering a sample failed "
+                                     f"({machine.sample_errors} so far): {e!r}")
+                if machine.tag_scheduler:
+                    tag_values = machine.tag_buffer.get_batch(self.db_batch_size, timeout=0)
+                    drained += len(tag_values)
+                    for timestamp, values in tag_values:
+                        try:
+                            machine.buffer_tag_values(timestamp, values)
+                        except Exception as e:
+                            machine.sample_errors += 1
+                            logger.error(f"{machine.name}: buffering tag values failed "
+                                         f"({machine.sample_errors} so far): {e!r}")
+                try:
+                    self.flush_machine(machine)
+                except (psycopg2.InterfaceError, psycopg2.OperationalError) as e:
+                    # The rows were spooled; replay_spool retries the database with backoff
+                    logger.error(f"{machine.name}: database error: {e}. Spooling until it is back.")
+                    self.db_health.degraded(e)
+                except Exception as e:
+                    logger.error(f"{machine.name}: error writing data: {e}")
+            if not drained:
+                time.sleep(0.02)
+
+    def connect_kafka(self):
+        """Connect to Kafka with continuous retry until shutdown"""
+        while not self.stopping.is_set():
+            try:
+                if self.producer:
+                    self.producer.close()
+                self.producer = KafkaProducer(
+                    bootstrap_servers=self.kafka_bootstrap_servers,
+                    key_serializer=lambda k: k.encode('utf-8'),
+                    value_serializer=lambda v: json.dumps(v).encode('utf-8'),
+                    acks='all',
+                    retries=5,
+                    # Keyed by machine: one in-flight request keeps each machine's events in order
+                    max_in_flight_requests_per_connection=1,
+                    linger_ms=self.kafka_linger_ms,
+                    batch_size=self.kafka_batch_size,
+                    compression_type=self.kafka_compression,
+                    **self.kafka_idempotence()
+                )
+                logger.info(f"Connected to Kafka at {self.kafka_bootstrap_servers}")
+                return
+            except Exception as e:
+                logger.error(f"Failed to connect to Kafka: {e}")
+                self.kafka_health.failed(e)
+
+    @staticmethod
+    def kafka_idempotence():
+        """enable_idempotence where the installed kafka-python supports it; otherwise
+        consumers rely on the outbox sequence numbers to drop redelivered events"""
+        if 'enable_idempotence' in KafkaProducer.DEFAULT_CONFIG:
+            return {'enable_idempotence': True}
+        return {}
+
+    def write_outbox(self):
+        """Persist queued events to the outbox in batches, until the queue is empty after events_closed"""
+        while True:
+            batch = self.kafka_queue.get_batch(self.kafka_send_batch * 10, timeout=1.0)
+            if not batch:
+                if self.events_closed.is_set():
+                    return
+                continue
+            try:
+                self.kafka_outbox.append(batch)
+            except OSError as e:
+                logger.error(f"Kafka outbox write failed, dropping {len(batch)} events: {e}")
+                self.kafka_queue.mark_failed(len(batch))
+
+    def send_outbox(self):
+        """Deliver outbox records in order; a record is acknowledged once Kafka confirmed all its events.
+        Unacknowledged records stay in the outbox for the next start."""
+        while not self.stopping.is_set():
+            try:
+                if self.producer is None:
+                    self.connect_kafka()
+                    if self.producer is None:
+                        continue
+                records = self.kafka_outbox.read_batch(self.kafka_send_batch, timeout=1.0)
+                if not records:
+                    continue
+                sends = []
+                for _, _, rows in records:
+                    for key, seq, enqueued, event in rows:
+                        event['seq'] = seq
+                        future = self.producer.send(self.kafka_topic, key=key, value=event,
+                                                    headers=[('seq', str(seq).encode('utf-8'))])
+                        sends.append((future, enqueued))
+                metrics.KAFKA_SENT.inc(len(sends))
+                for future, enqueued in sends:
+                    future.get(timeout=30)
+                    self.kafka_queue.mark_sent(enqueued)
+                    metrics.KAFKA_ACKED.inc()
+                self.kafka_outbox.ack(records)
+                self.kafka_health.healthy()
+            except Exception as e:
+                # Nothing was acknowledged past the failure: the same events are sent again, in order
+                self.kafka_queue.mark_failed()
+                metrics.KAFKA_FAILED.inc()
+                logger.error(f"Kafka delivery failed: {e}. Reconnecting.")
+                self.kafka_health.failed(e)
+                self.connect_kafka()
+
+    def check_data_flow(self):
+        """Reconnect only the PLC sessions that stopped delivering data"""
+        while True:
+            for machine in self.machines:
+                if time.time() - machine.last_message_time > self.timeout:
+                    logger.warning(f"{machine.name}: no data received for {self.timeout} seconds. Reconnecting PLC...")
+                    machine.health.degraded(f"no data for {self.timeout} s")
+                    machine.reconnect_requested = True
+                    machine.last_message_time = time.time()
+                buffer_stats = machine.sample_buffer.stats()
+                if buffer_stats['overflow_count'] != machine.last_overflow_count:
+                    logger.warning(f"{machine.name}: sample buffer overflow: {buffer_stats}")
+                    machine.last_overflow_count = buffer_stats['overflow_count']
+            kafka_stats = self.kafka_queue.stats()
+            outbox_stats = self.kafka_outbox.stats()
+            if kafka_stats['dropped'] != self.last_kafka_dropped or outbox_stats['pending_bytes'] > 1024 * 1024:
+                logger.warning(f"Kafka backlog: queue {kafka_stats}, outbox {outbox_stats}")
+                self.last_kafka_dropped = kafka_stats['dropped']
+            summary = self.supervisor.summary()
+            if summary != self.last_health_summary:
+                logger.info(f"Health: {summary}")
+                self.last_health_summary = summary
+            time.sleep(5)
+
+    def maintain_partitions(self):
+        """Create upcoming daily partitions and apply retention every interval"""
+        while not self.stopping.is_set():
+            try:
+                self.partition_manager.run()
+            except Exception as e:
+                logger.error(f"Partition maintenance failed: {e}")
+            self.stopping.wait(self.partition_manager.interval)
+
+    def flush_all(self):
+        """Write (or spool) all buffered samples and rows before shutdown"""
+        for machine in self.machines:
+            for sample in machine.sample_buffer.get_batch(machine.sample_buffer.capacity, timeout=0):
+                machine.buffer_sample(sample)
+            if machine.tag_scheduler:
+                for timestamp, values in machine.tag_buffer.get_batch(machine.tag_buffer.capacity, timeout=0):
+                    machine.buffer_tag_values(timestamp, values)
+            machine.close_windows()
+            try:
+                self.flush_machine(machine, force=True)
+            except Exception as e:
+                logger.error(f"{machine.name}: error flushing buffered rows, spooled instead: {e}")
+            if machine.capture:
+                machine.capture.close()
+            if machine.shared_ring:
+                machine.shared_ring.close()
+        self.spool.close()
+        self.cycle_state.close()
+
+    @staticmethod
+    def join(threads):
+        """Wait for threads to finish, logging the ones that take long; no thread is abandoned"""
+        for thread in threads:
+            while True:
+                thread.join(timeout=5)
+                if not thread.is_alive():
+                    break
+                logger.warning(f"Shutdown: still waiting for {thread.name}")
+
+    def _handle_sigterm(self, signum, frame):
+        raise KeyboardInterrupt
+
+    def start(self):
+        logger.info(f"Starting ingest for {', '.join(machine.name for machine in self.machines)}")
+        acquire_threads = [
+            threading.Thread(target=machine.acquire_plc_data, daemon=True, name=f"Acquire-{machine.name}")
+            for machine in self.machines
+        ]
+        threads = list(acquire_threads)
+        writer_count = min(self.db_writers, len(self.machines))
+        db_threads = [
+            threading.Thread(target=self.write_to_db, args=(self.machines[i::writer_count],), daemon=True, name=f"DbWriter-{i}")
+            for i in range(writer_count)
+        ]
+        db_threads.append(threading.Thread(target=self.replay_spool, daemon=True, name="SpoolReplay"))
+        threads.extend(db_threads)
+        outbox_writer = threading.Thread(target=self.write_outbox, daemon=True, name="KafkaOutboxWriter")
+        outbox_sender = threading.Thread(target=self.send_outbox, daemon=True, name="KafkaProducerThread")
+        threads += [outbox_writer, outbox_sender]
+        threads.append(threading.Thread(target=self.check_data_flow, daemon=True, name="DataFlowThread"))
+        if self.partition_manager:
+            threads.append(threading.Thread(target=self.maintain_partitions, daemon=True, name="Partitions"))
+
+        self.cycle_state.start()
+        for machine in self.machines:
+            if machine.capture:
+                machine.capture.start()
+        if self.metrics_port:
+            metrics.start_http_server(self.metrics_port)
+        for thread in threads:
+            thread.start()
+
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            logger.info("Shutting down...")
+            self.stopping.set()
+            # Acquisition first, so nothing publishes to the buffers, captures or rings any more;
+            # then the writers, so flush_all is the only user of the COPY writers
+            self.join(acquire_threads)
+            self.join(db_threads)
+            self.flush_all()
+            for machine in self.machines:
+                machine.close_plc()
+            # The outbox writer drains what is left in the queue, then the outbox can close
+            self.events_closed.set()
+            self.join([outbox_writer, outbox_sender])
+            if self.producer:
+                self.producer.close()
+            self.kafka_outbox.close()
+            self.db_pool.closeall()
+            sys.exit(0)
+
+
+if __name__ == '__main__':
+    config_path = sys.argv[1] if len(sys.argv) > 1 else 'machines.json'
+    with open(config_path, 'r') as f:
+        async_log.setup_logging(json.load(f).get('logging'))
+    daemon = IngestDaemon(config_path)
+    daemon.start()
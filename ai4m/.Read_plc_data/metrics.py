@@ -0,0 +1,329 @@
+"""Lightweight process metrics with a Prometheus text endpoint.
+
+Counters, gauges and histograms are declared once at module level and
+recorded from any thread:
+
+    DECODE_SECONDS = metrics.histogram('ai4m_decode_seconds', 'UDT decode time', ['plc'])
+    decode_time = DECODE_SECONDS.labels('mc17')    # resolve the child once
+    decode_time.observe(0.0004)
+
+The metrics every daemon reports (PLC reads, queues, Kafka, NATS commands)
+are declared at the bottom of this module so they have the same names in
+every process.
+
+Recording takes no lock: every thread updates its own cell of a metric and
+the cells are only summed when /metrics is scraped, so the 30 ms acquisition
+loops never wait on the scraper or on each other. Gauges that mirror
+existing state (queue depths, backlog sizes) use set_function() and cost
+nothing until scraped.
+
+    metrics.start_http_server(9100)   # GET http://host:9100/metrics
+"""
+
+import bisect
+import logging
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from sub-millisecond CIP reads to multi-second stalls
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PERIOD_BUCKETS = (0.01, 0.02, 0.025, 0.03, 0.035, 0.04, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    value = float(value)
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _label_text(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Cells:
+    """Per-thread accumulators. A thread only ever writes its own cell, so no lock is needed;
+    creating a cell is a single dict.setdefault, which is atomic in CPython."""
+
+    def __init__(self, size):
+        self.size = size
+        self.cells = {}
+
+    def cell(self):
+        ident = threading.get_ident()
+        cell = self.cells.get(ident)
+        if cell is None:
+            cell = self.cells.setdefault(ident, [0] * self.size)
+        return cell
+
+    def totals(self):
+        totals = [0] * self.size
+        for cell in list(self.cells.values()):
+            for i, value in enumerate(cell):
+                totals[i] += value
+        return totals
+
+
+class _CounterChild:
+    def __init__(self):
+        self.cells = _Cells(1)
+        self.function = None
+
+    def inc(self, amount=1):
+        self.cells.cell()[0] += amount
+
+    def set_function(self, function):
+        """Report function() instead, for counters already kept elsewhere"""
+        self.function = function
+
+    def value(self):
+        return self.function() if self.function else self.cells.totals()[0]
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.current = 0
+        self.function = None
+
+    def set(self, value):
+        self.current = value
+
+    def set_function(self, function):
+        """Evaluate function() at scrape time instead of storing a value"""
+        self.function = function
+
+    def value(self):
+        return self.function() if self.function else self.current
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One count per bucket plus +Inf, then the sum of observations
+        self.cells = _Cells(len(buckets) + 2)
+
+    def observe(self, value):
+        cell = self.cells.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    """Context manager observing the elapsed time of its block"""
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            self.children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Child for one label combination; resolve it once outside hot loops"""
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    def _samples(self):
+        for values, child in list(self.children.items()):
+            try:
+                value = child.value()
+            except Exception as e:
+                logger.debug(f"{self.name}{values}: {e}")
+                continue
+            if value is not None:
+                yield self.name, _label_text(self.labelnames, values), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {_format_value(value)}" for name, labels, value in self._samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self.children[()].set(value)
+
+    def set_function(self, function):
+        self.children[()].set_function(function)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+    def time(self):
+        return self.children[()].time()
+
+    def _samples(self):
+        for values, child in list(self.children.items()):
+            totals = child.cells.totals()
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), totals):
+                cumulative += count
+                yield (f"{self.name}_bucket",
+                       _label_text(self.labelnames, values, [('le', _format_value(float(bound)))]), cumulative)
+            labels = _label_text(self.labelnames, values)
+            yield f"{self.name}_sum", labels, totals[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Registry:
+    """Named metrics of one process"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """Add metric, or return the one already registered under its name (modules may be
+        imported by several scripts that declare the same metric)"""
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"Metric {metric.name} already registered as a different type or labels")
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=(), registry=REGISTRY):
+    return registry.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=(), registry=REGISTRY):
+    return registry.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# Metrics shared by the daemons, so dashboards use the same names for every process
+PLC_READ_SECONDS = histogram('ai4m_plc_read_seconds', 'PLC read latency', ['plc'])
+PLC_READ_ERRORS = counter('ai4m_plc_read_errors_total', 'Failed or empty PLC reads', ['plc'])
+SAMPLE_ERRORS = counter('ai4m_sample_errors_total', 'Samples that failed to buffer for the database writers', ['plc'])
+PLC_WRITE_SECONDS = histogram('ai4m_plc_write_seconds', 'PLC write latency', ['plc'])
+PLC_CONNECTS = counter('ai4m_plc_connects_total', 'PLC session (re)connects', ['plc', 'result'])
+QUEUE_DEPTH = gauge('ai4m_queue_depth', 'Items waiting in an in-memory queue', ['queue'])
+QUEUE_DROPPED = counter('ai4m_queue_dropped_total', 'Items dropped by a full queue', ['queue'])
+BACKLOG_BYTES = gauge('ai4m_backlog_bytes', 'Unacknowledged bytes in an on-disk spool or outbox', ['backlog'])
+KAFKA_SENT = counter('ai4m_kafka_sent_total', 'Messages handed to the Kafka producer')
+KAFKA_ACKED = counter('ai4m_kafka_acked_total', 'Messages acknowledged by Kafka')
+KAFKA_FAILED = counter('ai4m_kafka_failed_total', 'Failed Kafka deliveries')
+DB_CONNECTS = counter('ai4m_db_connects_total', 'Database (re)connects', ['result'])
+DB_QUERY_SECONDS = histogram('ai4m_db_query_seconds', 'Latency of single-row inserts and queries', ['query'])
+DB_ERRORS = counter('ai4m_db_errors_total', 'Failed inserts and queries', ['query'])
+NATS_COMMAND_SECONDS = histogram('ai4m_nats_command_seconds', 'NATS command handling latency',
+                                 ['plc', 'command'])
+NATS_COMMAND_ERRORS = counter('ai4m_nats_command_errors_total', 'NATS commands answered with an error',
+                              ['plc', 'command'])
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, address='', registry=REGISTRY):
+    """Serve /metrics from a daemon thread. Returns the server, or None if the port
+    is unavailable; metrics are never a reason for a daemon not to start."""
+    handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+    try:
+        server = ThreadingHTTPServer((address, port), handler)
+    except OSError as e:
+        logger.error(f"Metrics endpoint not started on port {port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="MetricsServer").start()
+    logger.info(f"Serving metrics on :{port}/metrics")
+    return server
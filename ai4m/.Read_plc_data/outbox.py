@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import threading
+
+from spool import Spool
+
+logger = logging.getLogger(__name__)
+
+SEQUENCES_FILE = 'sequences.json'
+
+
+class KafkaOutbox:
+    """Durable, ordered outbox for Kafka events.
+
+    Every event is appended to an on-disk log (a Spool) before it is sent,
+    with a per-machine sequence number. The sender reads batches in log
+    order and acknowledges them only after Kafka confirmed every message, so
+    after a crash, restart or broker outage the unacknowledged tail is sent
+    again in the same order. Redelivered messages keep their sequence number,
+    so consumers can drop duplicates with (machine, seq).
+
+    The last acknowledged sequence number per machine is kept in
+    sequences.json; it is written before the log cursor moves, so sequence
+    numbers are never reused.
+    """
+
+    def __init__(self, directory, segment_bytes=4 * 1024 * 1024, max_bytes=256 * 1024 * 1024,
+                 fsync_interval=0.5):
+        self.directory = directory
+        self.log = Spool(directory, segment_bytes=segment_bytes, max_bytes=max_bytes,
+                         fsync_interval=fsync_interval)
+        self.lock = threading.Lock()
+        self.pending = threading.Condition(self.lock)
+        self.appended = 0
+        self.acked = 0
+
+        self.acked_sequences = self._load_sequences()
+        self.next_sequences = dict(self.acked_sequences)
+        # Unacknowledged records may hold higher sequence numbers than the last ack
+        for _, _, rows in self.log.read_batch(max_records=1 << 30):
+            for key, seq, _, _ in rows:
+                if seq > self.next_sequences.get(key, 0):
+                    self.next_sequences[key] = seq
+        if self.log.has_pending():
+            logger.info(f"Kafka outbox: replaying unacknowledged events from {directory}")
+
+    def _load_sequences(self):
+        try:
+            with open(os.path.join(self.directory, SEQUENCES_FILE), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.error(f"Kafka outbox: unreadable {SEQUENCES_FILE} ({e}), sequences restart from the log")
+            return {}
+
+    def _save_sequences(self):
+        path = os.path.join(self.directory, SEQUENCES_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.acked_sequences, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def append(self, entries):
+        """Append (enqueued, (key, event)) entries as one record, numbering them per key"""
+        if not entries:
+            return
+        with self.lock:
+            rows = []
+            for enqueued, (key, event) in entries:
+                seq = self.next_sequences.get(key, 0) + 1
+                self.next_sequences[key] = seq
+                rows.append([key, seq, enqueued, event])
+            self.log.append('kafka', rows)
+            self.appended += len(rows)
+            self.pending.notify_all()
+
+    def read_batch(self, max_records=50, timeout=None):
+        """Oldest unacknowledged records as (position, table, rows); rows are [key, seq, enqueued, event].
+        Waits up to timeout while the outbox is empty."""
+        with self.lock:
+            if not self.log.has_pending():
+                self.pending.wait(timeout)
+        return self.log.read_batch(max_records)
+
+    def ack(self, records):
+        """All events of records were confirmed by Kafka"""
+        if not records:
+            return
+        for _, _, rows in records:
+            for key, seq, _, _ in rows:
+                if seq > self.acked_sequences.get(key, 0):
+                    self.acked_sequences[key] = seq
+            self.acked += len(rows)
+        self._save_sequences()
+        self.log.ack(records[-1][0])
+
+    def close(self):
+        self.log.close()
+
+    def stats(self):
+        stats = self.log.stats()
+        return {
+            'appended': self.appended,
+            'acked': self.acked,
+            'pending_bytes': stats['pending_bytes'],
+            'dropped_segments': stats['dropped_segments'],
+            'sequences': dict(self.next_sequences),
+            'acked_sequences': dict(self.acked_sequences),
+        }
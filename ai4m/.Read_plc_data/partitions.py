@@ -0,0 +1,357 @@
+"""Daily range partitions with BRIN timestamp indexes and retention.
+
+The raw tables (mc17, mc18, their _mid, _mid_agg, _tags, _cycles and rollup
+tables, the S1/S2 *_short_data tables, loop3_checkpoints) are partitioned by day on their timestamp column. Inserts
+and COPY still target the parent table and PostgreSQL routes every row to its
+day, so the writers need no change; a query with a time range, or an
+ORDER BY timestamp DESC LIMIT n on a table with order_index, only touches the
+newest partitions however much history is kept.
+
+Every run of the manager:
+
+  - creates the partitions for today and the next days_ahead days, plus a
+    DEFAULT partition catching rows with an implausible PLC clock, so an
+    insert never fails for lack of a partition;
+  - removes partitions whose whole range is older than retention_days, by
+    dropping them ("drop"), detaching them into standalone tables ("detach"),
+    or writing them to <archive_directory>/<partition>.csv.gz and then
+    dropping them ("archive").
+
+Each partition inherits a BRIN index on the timestamp from the parent (a few
+pages per day, enough for range scans over append-only data), and tables with
+order_index also get a btree for newest-first LIMIT queries.
+
+An existing table is converted once with the "convert" command. The table
+becomes the first partition (<table>_legacy, all rows up to tomorrow) without
+a rewrite and without blocking inserts for longer than a rename; the BRIN
+index and the CHECK constraint that lets ATTACH skip its scan are built
+beforehand, concurrently with ingest.
+
+The ingest daemon runs the manager every interval_minutes when the
+"partitions" section of machines.json is enabled; otherwise run it from cron:
+
+Usage: python3 partitions.py [run|status|convert <table>] [machines.json]
+       python3 partitions.py convert mc17
+"""
+import datetime
+import gzip
+import json
+import logging
+import os
+import re
+import sys
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+PARTITION_SUFFIX = re.compile(r'_p(\d{8})$')
+UPPER_BOUND = re.compile(r"TO \('(\d{4}-\d{2}-\d{2})")
+
+# Never hold up the writers for long on a partition lock; the next run retries
+LOCK_TIMEOUT = '5s'
+
+
+class PartitionedTable:
+    """Retention and index settings of one table"""
+
+    def __init__(self, config, defaults):
+        self.name = config['table']
+        self.column = config.get('column', 'timestamp')
+        self.retention_days = config.get('retention_days', defaults.get('retention_days', 30))
+        self.action = config.get('action', defaults.get('action', 'drop'))
+        self.order_index = config.get('order_index', False)
+        self.database = config.get('database')
+        if self.action not in ('drop', 'detach', 'archive'):
+            raise ValueError(f"{self.name}: unknown retention action {self.action!r}")
+
+    @property
+    def quoted_column(self):
+        return f'"{self.column}"'
+
+    def partition_name(self, day):
+        return f"{self.name}_p{day:%Y%m%d}"
+
+
+class PartitionManager:
+    """Creates upcoming daily partitions and applies retention to the configured tables"""
+
+    def __init__(self, db_settings, config, base_dir='.'):
+        self.db_settings = db_settings
+        self.days_ahead = config.get('days_ahead', 3)
+        self.interval = config.get('interval_minutes', 60) * 60
+        self.archive_directory = os.path.join(base_dir, config.get('archive_directory', 'archive'))
+        defaults = {key: config[key] for key in ('retention_days', 'action') if key in config}
+        self.tables = [PartitionedTable(table, defaults) for table in config.get('tables', [])]
+        self.warned_unpartitioned = set()
+
+        # Metrics
+        self.runs = 0
+        self.created = 0
+        self.removed = 0
+        self.archived_bytes = 0
+        self.errors = 0
+
+    def connect(self, database=None):
+        settings = dict(self.db_settings)
+        if database:
+            settings.pop('dbname', None)
+            settings['database'] = database
+        conn = psycopg2.connect(**settings)
+        conn.autocommit = True
+        return conn
+
+    def run(self, today=None):
+        """Maintain every table once; errors are logged per table and retried next run"""
+        today = today or datetime.date.today()
+        self.runs += 1
+        connections = {}
+        try:
+            for table in self.tables:
+                try:
+                    conn = connections.get(table.database)
+                    if conn is None or conn.closed:
+                        conn = connections[table.database] = self.connect(table.database)
+                    self.maintain(conn, table, today)
+                except (psycopg2.Error, OSError) as e:
+                    # OSError: the archive could not be written (disk full, permissions)
+                    self.errors += 1
+                    logger.error(f"{table.name}: partition maintenance failed: {e}")
+        finally:
+            for conn in connections.values():
+                conn.close()
+
+    def maintain(self, conn, table, today):
+        with conn.cursor() as cursor:
+            if not is_partitioned(cursor, table.name):
+                if table.name not in self.warned_unpartitioned:
+                    if exists(cursor, table.name):
+                        logger.warning(f"{table.name} is not partitioned; run 'python3 partitions.py convert {table.name}'")
+                    else:
+                        logger.info(f"{table.name} does not exist (yet); skipped")
+                    self.warned_unpartitioned.add(table.name)
+                return
+            cursor.execute(f"SET lock_timeout = '{LOCK_TIMEOUT}'")
+            self.ensure_indexes(cursor, table)
+            existing = dict(partitions(cursor, table.name))
+            self.ensure_default(cursor, table, existing)
+            for offset in range(self.days_ahead + 1):
+                day = today + datetime.timedelta(days=offset)
+                if table.partition_name(day) not in existing and not covered(existing, day):
+                    self.create_partition(cursor, table, day)
+            cutoff = today - datetime.timedelta(days=table.retention_days)
+            for name, bound in sorted(existing.items()):
+                upper = upper_bound(bound)
+                if upper is not None and upper <= cutoff:
+                    self.expire(conn, cursor, table, name)
+
+    def ensure_indexes(self, cursor, table):
+        # Indexes on the partitioned parent are created on every partition, existing and new
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {table.name}_{table.column}_brin ON {table.name} "
+                       f"USING brin ({table.quoted_column})")
+        if table.order_index:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {table.name}_{table.column}_idx ON {table.name} "
+                           f"({table.quoted_column})")
+
+    def ensure_default(self, cursor, table, existing):
+        name = f"{table.name}_default"
+        if name not in existing:
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table.name} DEFAULT")
+            logger.info(f"{table.name}: created default partition {name}")
+            return
+        cursor.execute(f"SELECT count(*) FROM (SELECT 1 FROM {name} LIMIT 1000) AS stray")
+        stray = cursor.fetchone()[0]
+        if stray:
+            logger.warning(f"{table.name}: {stray}{'+' if stray == 1000 else ''} rows outside the daily partitions "
+                           f"in {name} (PLC clock?)")
+
+    def create_partition(self, cursor, table, day):
+        name = table.partition_name(day)
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table.name} "
+                       f"FOR VALUES FROM (%s) TO (%s)", (day.isoformat(), (day + datetime.timedelta(days=1)).isoformat()))
+        self.created += 1
+        logger.info(f"{table.name}: created partition {name}")
+
+    def expire(self, conn, cursor, table, name):
+        if table.action == 'archive':
+            path = self.archive(conn, name)
+            logger.info(f"{table.name}: archived {name} to {path}")
+        if table.action == 'detach':
+            cursor.execute(f"ALTER TABLE {table.name} DETACH PARTITION {name}")
+            logger.info(f"{table.name}: detached {name} (retention {table.retention_days} days)")
+        else:
+            cursor.execute(f"DROP TABLE {name}")
+            logger.info(f"{table.name}: dropped {name} (retention {table.retention_days} days)")
+        self.removed += 1
+
+    def archive(self, conn, name):
+        """COPY one partition into a gzip CSV, written under a temporary name first"""
+        os.makedirs(self.archive_directory, exist_ok=True)
+        path = os.path.join(self.archive_directory, f"{name}.csv.gz")
+        partial = path + '.partial'
+        try:
+            with gzip.open(partial, 'wb') as f, conn.cursor() as cursor:
+                cursor.copy_expert(f"COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)", f)
+            os.replace(partial, path)
+        except BaseException:
+            # The partition is kept; the next run writes the archive again from scratch
+            try:
+                os.remove(partial)
+            except OSError:
+                pass
+            raise
+        self.archived_bytes += os.path.getsize(path)
+        return path
+
+    def convert(self, table_name, today=None):
+        """Turn an existing table into a partitioned one with the old rows as its first partition"""
+        table = next((table for table in self.tables if table.name == table_name), None)
+        if table is None:
+            raise SystemExit(f"{table_name} is not in the partitions section")
+        today = today or datetime.date.today()
+        bound = (today + datetime.timedelta(days=1)).isoformat()
+        legacy = f"{table.name}_legacy"
+        column = table.quoted_column
+
+        conn = self.connect(table.database)
+        try:
+            with conn.cursor() as cursor:
+                if is_partitioned(cursor, table.name):
+                    logger.info(f"{table.name} is already partitioned")
+                    return
+                # Slow steps first, while ingest keeps writing to the table
+                logger.info(f"{table.name}: building BRIN index")
+                cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {legacy}_{table.column}_brin "
+                               f"ON {table.name} USING brin ({column})")
+                if table.order_index:
+                    logger.info(f"{table.name}: building btree index")
+                    cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {legacy}_{table.column}_idx "
+                                   f"ON {table.name} ({column})")
+                logger.info(f"{table.name}: validating rows before {bound}")
+                cursor.execute(f"ALTER TABLE {table.name} DROP CONSTRAINT IF EXISTS {legacy}_bound")
+                cursor.execute(f"ALTER TABLE {table.name} ADD CONSTRAINT {legacy}_bound "
+                               f"CHECK ({column} IS NOT NULL AND {column} < %s) NOT VALID", (bound,))
+                cursor.execute(f"ALTER TABLE {table.name} VALIDATE CONSTRAINT {legacy}_bound")
+
+                # The swap itself only takes metadata locks
+                conn.autocommit = False
+                cursor.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+                cursor.execute(f"ALTER TABLE {table.name} RENAME TO {legacy}")
+                cursor.execute(f"CREATE TABLE {table.name} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING STORAGE "
+                               f"INCLUDING COMMENTS) PARTITION BY RANGE ({column})")
+                cursor.execute(f"ALTER TABLE {table.name} ATTACH PARTITION {legacy} "
+                               f"FOR VALUES FROM (MINVALUE) TO (%s)", (bound,))
+                cursor.execute(f"CREATE INDEX {table.name}_{table.column}_brin ON ONLY {table.name} "
+                               f"USING brin ({column})")
+                cursor.execute(f"ALTER INDEX {table.name}_{table.column}_brin "
+                               f"ATTACH PARTITION {legacy}_{table.column}_brin")
+                if table.order_index:
+                    cursor.execute(f"CREATE INDEX {table.name}_{table.column}_idx ON ONLY {table.name} ({column})")
+                    cursor.execute(f"ALTER INDEX {table.name}_{table.column}_idx "
+                                   f"ATTACH PARTITION {legacy}_{table.column}_idx")
+                # Serial columns: keep their sequences when the legacy partition is dropped
+                cursor.execute("SELECT attname, pg_get_serial_sequence(%s, attname) FROM pg_attribute "
+                               "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped",
+                               (legacy, legacy))
+                for attname, sequence in cursor.fetchall():
+                    if sequence:
+                        cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {table.name}."{attname}"')
+                cursor.execute(f"ALTER TABLE {legacy} DROP CONSTRAINT {legacy}_bound")
+                conn.commit()
+                conn.autocommit = True
+            logger.info(f"{table.name}: partitioned, existing rows are in {legacy} until {bound}")
+            self.maintain(conn, table, today)
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def status(self):
+        """(table, partition, bound, rows estimate) of every configured table"""
+        connections = {}
+        rows = []
+        try:
+            for table in self.tables:
+                conn = connections.get(table.database) or connections.setdefault(table.database,
+                                                                                 self.connect(table.database))
+                with conn.cursor() as cursor:
+                    if not is_partitioned(cursor, table.name):
+                        rows.append((table.name, None, 'not partitioned', None))
+                        continue
+                    for name, bound in sorted(partitions(cursor, table.name)):
+                        cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", (name,))
+                        rows.append((table.name, name, bound, cursor.fetchone()[0]))
+        finally:
+            for conn in connections.values():
+                conn.close()
+        return rows
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'created': self.created,
+            'removed': self.removed,
+            'archived_bytes': self.archived_bytes,
+            'errors': self.errors,
+        }
+
+
+def exists(cursor, table):
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+    return cursor.fetchone()[0]
+
+
+def is_partitioned(cursor, table):
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))", (table,))
+    return cursor.fetchone()[0]
+
+
+def partitions(cursor, table):
+    """(name, bound expression) of the partitions attached to table"""
+    cursor.execute("SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+                   "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass", (table,))
+    return cursor.fetchall()
+
+
+def upper_bound(bound):
+    """Exclusive upper bound date of a FOR VALUES FROM (...) TO (...) expression; None for DEFAULT"""
+    match = UPPER_BOUND.search(bound or '')
+    return datetime.date.fromisoformat(match.group(1)) if match else None
+
+
+def covered(existing, day):
+    """True if a non-daily partition (the legacy one) already holds day"""
+    for name, bound in existing.items():
+        upper = upper_bound(bound)
+        if upper is not None and not PARTITION_SUFFIX.search(name) and day < upper:
+            return True
+    return False
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'run'
+    args = sys.argv[2:]
+    table_name = args.pop(0) if command == 'convert' and args else None
+    config_path = args[0] if args else 'machines.json'
+    if command not in ('run', 'status', 'convert') or (command == 'convert' and not table_name):
+        print(__doc__.strip().splitlines()[-2])
+        sys.exit(1)
+
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    manager = PartitionManager(config['database'], config.get('partitions', {}),
+                               os.path.dirname(os.path.abspath(config_path)))
+    if command == 'run':
+        manager.run()
+        print(manager.stats())
+    elif command == 'convert':
+        manager.convert(table_name)
+    else:
+        for table, name, bound, rows in manager.status():
+            print(f"{table:<20} {name or '-':<28} {rows if rows is not None else '-':>12}  {bound}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    main()
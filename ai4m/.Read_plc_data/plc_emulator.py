@@ -0,0 +1,824 @@
+"""EtherNet/IP + CIP PLC emulator for load tests of the PLC clients.
+
+Serves enough of a Logix controller for pycomm3's LogixDriver, so the ingest
+daemon, mc17_mc18_control.py, the S1/S2 sweep scripts and the legacy readers
+can run unmodified against it by changing only the PLC address:
+
+  RegisterSession, UnRegisterSession, ListIdentity
+  SendRRData: (Large) Forward Open/Close, Unconnected Send, identity object
+  SendUnitData: Read Tag, Read Tag Fragmented, Write Tag, Write Tag Fragmented,
+                Read Modify Write, Multiple Service Packet, Get Instance
+                Attribute List (tag list upload), template attributes and
+                template reads (UDT upload), program name, wall clock
+
+Every emulated PLC has the machine UDT (MC17, MC18, ...) built from the
+high/low-speed tag JSON files of its machines.json profile, with live values
+from a sim_plc.MachineModel, plus the HMI tags of develop/plc_tags.json:
+temperature zones as a structure with a SetValue member, HMI_I_* pushbuttons
+and *_NOTIFICATION tags as BOOL, everything else as REAL.
+
+Each request is answered after latency + uniform(0, jitter) seconds. By
+default a PLC handles one request at a time across all its sessions, like
+the controller's communication task, so concurrent clients queue behind each
+other; max_connections limits the CIP connections (Forward Opens) it accepts.
+
+PLCs listen on consecutive loopback addresses (127.0.1.1, 127.0.1.2, ...) on
+the standard port 44818, so a client only needs the address changed; on
+systems without the whole 127/8 routed to lo, use 127.0.0.1:<port> paths
+with a base port instead (e.g. 127.0.0.1:44818, 127.0.0.1:44819).
+
+Usage: python3 plc_emulator.py [count] [latency ms] [first address or 127.0.0.1:port] [machines.json]
+       python3 plc_emulator.py 10 2 127.0.1.1
+"""
+import ipaddress
+import json
+import logging
+import os
+import random
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from sim_plc import INT_MEMBERS, MachineModel
+from udt_decoder import CLOCK_FIELDS, STRUCT_CODES
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 44818
+PLC_TAGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'develop', 'plc_tags.json')
+
+# Encapsulation commands
+NOP = 0x00
+LIST_IDENTITY = 0x63
+REGISTER_SESSION = 0x65
+UNREGISTER_SESSION = 0x66
+SEND_RR_DATA = 0x6F
+SEND_UNIT_DATA = 0x70
+
+ENCAP_HEADER = struct.Struct('<HHII8sI')
+
+# CIP services
+GET_ATTRIBUTES_ALL = 0x01
+GET_ATTRIBUTE_LIST = 0x03
+MULTIPLE_SERVICE = 0x0A
+READ_TAG = 0x4C
+WRITE_TAG = 0x4D
+READ_MODIFY_WRITE = 0x4E
+FORWARD_CLOSE = 0x4E
+UNCONNECTED_SEND = 0x52
+READ_TAG_FRAGMENTED = 0x52
+WRITE_TAG_FRAGMENTED = 0x53
+FORWARD_OPEN = 0x54
+GET_INSTANCE_ATTRIBUTE_LIST = 0x55
+LARGE_FORWARD_OPEN = 0x5B
+
+# CIP classes
+IDENTITY_CLASS = 0x01
+MESSAGE_ROUTER_CLASS = 0x02
+CONNECTION_MANAGER_CLASS = 0x06
+PROGRAM_NAME_CLASS = 0x64
+SYMBOL_CLASS = 0x6B
+TEMPLATE_CLASS = 0x6C
+WALL_CLOCK_CLASS = 0x8B
+
+# General status codes
+SUCCESS = 0x00
+CONNECTION_FAILURE = 0x01
+PATH_SEGMENT_ERROR = 0x04
+PATH_DESTINATION_UNKNOWN = 0x05
+PARTIAL_TRANSFER = 0x06
+SERVICE_NOT_SUPPORTED = 0x08
+ATTRIBUTE_NOT_SUPPORTED = 0x14
+EMBEDDED_SERVICE_ERROR = 0x1E
+NOT_ENOUGH_DATA = 0x13
+INVALID_PARAMETER = 0x20
+
+# Extended status of a refused Forward Open: no more connections available
+OUT_OF_CONNECTIONS = 0x0113
+
+ATOMIC_CODES = {
+    'BOOL': 0xC1, 'SINT': 0xC2, 'INT': 0xC3, 'DINT': 0xC4, 'LINT': 0xC5,
+    'USINT': 0xC6, 'UINT': 0xC7, 'UDINT': 0xC8, 'ULINT': 0xC9, 'REAL': 0xCA, 'LREAL': 0xCB,
+    'BYTE': 0xD1, 'WORD': 0xD2, 'DWORD': 0xD3, 'LWORD': 0xD4,
+}
+STRUCT_REPLY = 0x02A0
+STRUCT_BIT = 0x8000
+BASE_TAG_BIT = 1 << 26
+FIRST_TEMPLATE_ID = 0x100
+
+# What ListIdentity and the identity object report
+VENDOR_ROCKWELL = 1
+PRODUCT_TYPE_PLC = 14
+PRODUCT_CODE = 0x9B
+REVISION = (32, 11)
+STATUS_RUN = b'\x60\x30'
+
+
+class CipError(Exception):
+    def __init__(self, status, extended=None, message=''):
+        super().__init__(message or f"CIP status 0x{status:02x}")
+        self.status = status
+        self.extended = extended
+
+
+def _pack_atomic(type_name, value):
+    if type_name == 'BOOL':
+        return b'\xff' if value else b'\x00'
+    return struct.pack('<' + STRUCT_CODES[type_name], value)
+
+
+def _unpack_atomic(type_name, data, offset=0):
+    if type_name == 'BOOL':
+        return data[offset] != 0
+    return struct.unpack_from('<' + STRUCT_CODES[type_name], data, offset)[0]
+
+
+def _atomic_size(type_name):
+    return 1 if type_name == 'BOOL' else struct.calcsize('<' + STRUCT_CODES[type_name])
+
+
+class Template:
+    """A UDT definition: atomic members at aligned offsets, and its uploadable template"""
+
+    def __init__(self, instance_id, name, members):
+        self.instance_id = instance_id
+        self.name = name
+        self.members = []
+        self.by_name = {}
+        offset = 0
+        for member, type_name in members:
+            size = _atomic_size(type_name)
+            offset = (offset + size - 1) // size * size
+            self.members.append((member, type_name, offset))
+            self.by_name[member] = (type_name, offset)
+            offset += size
+        self.structure_size = (offset + 3) // 4 * 4
+        self.handle = zlib.crc32(name.encode()) & 0xFFFF
+
+        info = b''.join(struct.pack('<HHI', 0, ATOMIC_CODES[type_name], offset)
+                        for _, type_name, offset in self.members)
+        names = f"{name};n".encode() + b'\x00' + b''.join(member.encode() + b'\x00' for member, _, _ in self.members)
+        self.data = info + names
+        # pycomm3 reads (object_definition_size * 4 - 21) bytes of template data
+        self.object_definition_size = (len(self.data) + 21 + 3) // 4
+
+    def encode(self, values):
+        data = bytearray(self.structure_size)
+        for member, type_name, offset in self.members:
+            packed = _pack_atomic(type_name, values.get(member, 0))
+            data[offset:offset + len(packed)] = packed
+        return bytes(data)
+
+    def decode(self, data):
+        return {member: _unpack_atomic(type_name, data, offset) for member, type_name, offset in self.members}
+
+
+class EmulatedTag:
+    """A controller-scoped tag: atomic (type_name) or a structure (template)"""
+
+    def __init__(self, instance_id, name, type_name=None, template=None, value=None):
+        self.instance_id = instance_id
+        self.name = name
+        self.type_name = type_name
+        self.template = template
+        self.value = value
+
+    @property
+    def symbol_type(self):
+        if self.template:
+            return STRUCT_BIT | self.template.instance_id
+        return ATOMIC_CODES[self.type_name]
+
+
+class EmulatedPLC:
+    """Tag database, CIP object model and request accounting of one emulated controller"""
+
+    def __init__(self, name, udt_tag, udt_members, hmi_tags=(), latency=0.002, jitter=0.001, serialize=True,
+                 max_connections=32, speed_ppm=120, seed=None):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.max_connections = max_connections
+        self.rng = random.Random(seed)
+        self.busy = threading.Lock() if serialize else None
+        self.lock = threading.Lock()
+        self.program_name = f"{udt_tag}_Emulated"
+        self.serial = zlib.crc32(name.encode())
+        self.connections = 0
+
+        self.templates = {}
+        self.tags = {}
+        self.by_instance = {}
+
+        self.udt_tag = udt_tag
+        self.model = MachineModel(udt_members, speed_ppm=speed_ppm, seed=seed)
+        udt = self._template(f"UDT_{udt_tag}", [(member, self._member_type(member)) for member in udt_members])
+        self._add_tag(udt_tag, template=udt)
+
+        temperature = None
+        for entry in hmi_tags:
+            tag = entry['tag']
+            if tag in self.tags:
+                continue
+            if entry.get('is_temperature'):
+                if temperature is None:
+                    temperature = self._template('TEMP_ZONE', [('SetValue', 'REAL'), ('ActValue', 'REAL'),
+                                                               ('Output', 'REAL')])
+                setpoint = self.rng.uniform(140, 160)
+                self._add_tag(tag, template=temperature,
+                              value={'SetValue': setpoint, 'ActValue': setpoint, 'Output': 35.0})
+            elif tag.startswith('HMI_I_') or tag.endswith('_NOTIFICATION'):
+                self._add_tag(tag, 'BOOL', value=False)
+            else:
+                self._add_tag(tag, 'REAL', value=round(self.rng.uniform(0, 100), 1))
+
+        # Metrics
+        self.requests = 0
+        self.services = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.refused_connections = 0
+        self.busy_seconds = 0.0
+
+    @staticmethod
+    def _member_type(member):
+        if member in CLOCK_FIELDS or member in INT_MEMBERS:
+            return 'DINT'
+        return 'REAL'
+
+    def _template(self, name, members):
+        template = Template(FIRST_TEMPLATE_ID + len(self.templates), name, members)
+        self.templates[template.instance_id] = template
+        return template
+
+    def _add_tag(self, name, type_name=None, template=None, value=None):
+        tag = EmulatedTag(len(self.tags) + 1, name, type_name, template, value)
+        self.tags[name] = tag
+        self.by_instance[tag.instance_id] = tag
+        return tag
+
+    # -------------------------------------------------------------- values
+
+    def struct_values(self, tag):
+        if tag.name == self.udt_tag:
+            return self.model.sample()
+        return tag.value
+
+    def read(self, tag, members):
+        """(type header, value bytes) of a tag or one of its members"""
+        if tag.template is None:
+            if members:
+                raise CipError(PATH_DESTINATION_UNKNOWN)
+            return struct.pack('<H', ATOMIC_CODES[tag.type_name]), _pack_atomic(tag.type_name, tag.value)
+        values = self.struct_values(tag)
+        if not members:
+            return struct.pack('<HH', STRUCT_REPLY, tag.template.handle), tag.template.encode(values)
+        member = tag.template.by_name.get(members[0])
+        if member is None or len(members) > 1:
+            raise CipError(PATH_DESTINATION_UNKNOWN)
+        type_name, _ = member
+        return struct.pack('<H', ATOMIC_CODES[type_name]), _pack_atomic(type_name, values[members[0]])
+
+    def write(self, tag, members, type_code, data, offset=0):
+        if tag.template is None:
+            if members or type_code != ATOMIC_CODES[tag.type_name]:
+                raise CipError(PATH_DESTINATION_UNKNOWN if members else INVALID_PARAMETER)
+            tag.value = _unpack_atomic(tag.type_name, data)
+            return
+        if not members:
+            if type_code != STRUCT_REPLY:
+                raise CipError(INVALID_PARAMETER)
+            current = bytearray(tag.template.encode(self.struct_values(tag)))
+            current[offset:offset + len(data)] = data
+            values = tag.template.decode(bytes(current))
+            if tag.name == self.udt_tag:
+                for member, value in values.items():
+                    self.model.set(member, value)
+            else:
+                tag.value = values
+            return
+        member = tag.template.by_name.get(members[0])
+        if member is None or len(members) > 1:
+            raise CipError(PATH_DESTINATION_UNKNOWN)
+        type_name, _ = member
+        if type_code != ATOMIC_CODES[type_name]:
+            raise CipError(INVALID_PARAMETER)
+        value = _unpack_atomic(type_name, data)
+        if tag.name == self.udt_tag:
+            self.model.set(members[0], value)
+        else:
+            tag.value[members[0]] = value
+
+    # ------------------------------------------------------------ requests
+
+    def respond(self, handle):
+        """Run handle() as one request: wait out the emulated latency, one request at a time if serialized"""
+        delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0.0)
+        if self.busy is None:
+            if delay > 0:
+                time.sleep(delay)
+            return handle()
+        with self.busy:
+            started = time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                return handle()
+            finally:
+                self.busy_seconds += time.perf_counter() - started
+
+    def count(self, service, size_in, size_out):
+        with self.lock:
+            self.requests += 1
+            self.services[service] = self.services.get(service, 0) + 1
+            self.bytes_in += size_in
+            self.bytes_out += size_out
+
+    def open_connection(self):
+        with self.lock:
+            if self.connections >= self.max_connections:
+                self.refused_connections += 1
+                raise CipError(CONNECTION_FAILURE, OUT_OF_CONNECTIONS, "out of connections")
+            self.connections += 1
+
+    def close_connection(self):
+        with self.lock:
+            self.connections = max(0, self.connections - 1)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'services': {f"0x{service:02x}": count for service, count in sorted(self.services.items())},
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'connections': self.connections,
+                'refused_connections': self.refused_connections,
+                'busy_seconds': self.busy_seconds,
+            }
+
+
+def parse_path(data, offset):
+    """Decode a padded EPATH with its word count at data[offset]; returns (segments, end offset).
+    Segments are (kind, value) with kind in class, instance, member, attribute, symbol, port."""
+    words = data[offset]
+    end = offset + 1 + words * 2
+    position = offset + 1
+    segments = []
+    logical = {0x20: 'class', 0x24: 'instance', 0x28: 'member', 0x2C: 'connection_point', 0x30: 'attribute'}
+    while position < end:
+        segment = data[position]
+        if segment == 0x91:
+            length = data[position + 1]
+            segments.append(('symbol', data[position + 2:position + 2 + length].decode('utf-8', 'replace')))
+            position += 2 + length + (length % 2)
+        elif segment & 0xE0 == 0x20:
+            kind = logical.get(segment & 0xFC)
+            size = segment & 0x03
+            if size == 0:
+                value = data[position + 1]
+                position += 2
+            elif size == 1:
+                value = struct.unpack_from('<H', data, position + 2)[0]
+                position += 4
+            elif size == 3:
+                value = struct.unpack_from('<I', data, position + 2)[0]
+                position += 6
+            else:
+                raise CipError(PATH_SEGMENT_ERROR)
+            segments.append((kind, value))
+        elif segment & 0xE0 == 0x00:
+            # Port segment (routing); links longer than one byte are not used by the clients
+            if segment & 0x10:
+                length = data[position + 1]
+                position += 2 + length + (length % 2)
+            else:
+                position += 2
+            segments.append(('port', segment & 0x0F))
+        else:
+            raise CipError(PATH_SEGMENT_ERROR)
+    return segments, end
+
+
+def reply(service, status=SUCCESS, data=b'', extended=None):
+    if extended is None:
+        return bytes((service | 0x80, 0, status, 0)) + data
+    return bytes((service | 0x80, 0, status, 1)) + struct.pack('<H', extended) + data
+
+
+class Session:
+    """State of one TCP client: its registered session and open CIP connections"""
+
+    def __init__(self, plc, server):
+        self.plc = plc
+        self.server = server
+        self.handle = None
+        self.connections = {}  # connection serial -> (our O->T id, client T->O id)
+        self.connection_size = 500
+
+    # ---------------------------------------------------------------- CIP
+
+    def message(self, data, connected):
+        """Route one CIP request (service, path, data) and return the reply"""
+        service = data[0]
+        try:
+            segments, end = parse_path(data, 1)
+        except (CipError, IndexError):
+            return reply(service, PATH_SEGMENT_ERROR)
+        body = data[end:]
+        try:
+            return self.dispatch(service, segments, body, connected)
+        except CipError as e:
+            return reply(service, e.status, extended=e.extended)
+        except (IndexError, struct.error):
+            return reply(service, NOT_ENOUGH_DATA)
+
+    def dispatch(self, service, segments, body, connected):
+        kinds = dict(segments[:2])
+        class_code = kinds.get('class')
+
+        if class_code == CONNECTION_MANAGER_CLASS:
+            if service in (FORWARD_OPEN, LARGE_FORWARD_OPEN):
+                return self.forward_open(service, body)
+            if service == FORWARD_CLOSE:
+                return self.forward_close(body)
+            if service == UNCONNECTED_SEND:
+                length = struct.unpack_from('<H', body, 2)[0]
+                return self.message(body[4:4 + length], connected=False)
+            raise CipError(SERVICE_NOT_SUPPORTED)
+        if class_code == IDENTITY_CLASS and service == GET_ATTRIBUTES_ALL:
+            return reply(service, data=self.identity())
+        if class_code == PROGRAM_NAME_CLASS and service == GET_ATTRIBUTES_ALL:
+            name = self.plc.program_name.encode()
+            return reply(service, data=struct.pack('<H', len(name)) + name)
+        if class_code == WALL_CLOCK_CLASS and service == GET_ATTRIBUTE_LIST:
+            micros = int((time.time() - time.timezone) * 1000000)
+            return reply(service, data=struct.pack('<HHHQ', 1, 0x0B, 0, micros))
+        if class_code == MESSAGE_ROUTER_CLASS and service == MULTIPLE_SERVICE:
+            return self.multiple_service(body, connected)
+        if class_code == TEMPLATE_CLASS:
+            template = self.plc.templates.get(kinds.get('instance'))
+            if template is None:
+                raise CipError(PATH_DESTINATION_UNKNOWN)
+            if service == GET_ATTRIBUTE_LIST:
+                return reply(service, data=self.template_attributes(template, body))
+            if service == READ_TAG:
+                return self.read_template(template, body)
+            raise CipError(SERVICE_NOT_SUPPORTED)
+        if class_code == SYMBOL_CLASS and service == GET_INSTANCE_ATTRIBUTE_LIST:
+            return self.instance_attribute_list(kinds.get('instance', 0), body)
+        if service in (READ_TAG, READ_TAG_FRAGMENTED, WRITE_TAG, WRITE_TAG_FRAGMENTED, READ_MODIFY_WRITE):
+            tag, members = self.resolve_tag(segments)
+            return self.tag_service(service, tag, members, body)
+        raise CipError(SERVICE_NOT_SUPPORTED)
+
+    def identity(self):
+        name = f"1769-L33ER/A {self.plc.name}".encode()[:32]
+        return struct.pack('<HHHBB2sI', VENDOR_ROCKWELL, PRODUCT_TYPE_PLC, PRODUCT_CODE, REVISION[0], REVISION[1],
+                           STATUS_RUN, self.plc.serial) + bytes((len(name),)) + name
+
+    def forward_open(self, service, body):
+        large = service == LARGE_FORWARD_OPEN
+        # priority, ticks, O->T id (ours to choose), T->O id, connection serial, vendor, originator serial
+        client_id, serial, vendor, originator = struct.unpack_from('<IHHI', body, 6)
+        # timeout multiplier, reserved, O->T RPI, then the O->T parameters holding the connection size
+        params = struct.unpack_from('<I' if large else '<H', body, 26)[0]
+        self.connection_size = params & (0xFFFF if large else 0x01FF)
+        self.plc.open_connection()
+        connection_id = random.getrandbits(32)
+        self.connections[(serial, vendor, originator)] = connection_id
+        data = struct.pack('<IIHHIIIBB', connection_id, client_id, serial, vendor, originator, 0x4020, 0x4020, 0, 0)
+        return reply(service, data=data)
+
+    def forward_close(self, body):
+        serial, vendor, originator = struct.unpack_from('<HHI', body, 2)
+        if self.connections.pop((serial, vendor, originator), None) is not None:
+            self.plc.close_connection()
+        return reply(FORWARD_CLOSE, data=struct.pack('<HHIBB', serial, vendor, originator, 0, 0))
+
+    def close(self):
+        for _ in self.connections:
+            self.plc.close_connection()
+        self.connections.clear()
+
+    def multiple_service(self, body, connected):
+        count = struct.unpack_from('<H', body, 0)[0]
+        offsets = list(struct.unpack_from(f'<{count}H', body, 2)) + [len(body)]
+        replies = []
+        status = SUCCESS
+        for i in range(count):
+            response = self.message(body[offsets[i]:offsets[i + 1]], connected)
+            if response[2] not in (SUCCESS, PARTIAL_TRANSFER):
+                status = EMBEDDED_SERVICE_ERROR
+            replies.append(response)
+        position = 2 + 2 * count
+        table = []
+        for response in replies:
+            table.append(struct.pack('<H', position))
+            position += len(response)
+        return reply(MULTIPLE_SERVICE, status, struct.pack('<H', count) + b''.join(table) + b''.join(replies))
+
+    def template_attributes(self, template, body):
+        count = struct.unpack_from('<H', body, 0)[0]
+        data = struct.pack('<H', count)
+        for attribute in struct.unpack_from(f'<{count}H', body, 2):
+            if attribute == 1:
+                data += struct.pack('<HHH', attribute, 0, template.handle)
+            elif attribute == 2:
+                data += struct.pack('<HHH', attribute, 0, len(template.members))
+            elif attribute == 4:
+                data += struct.pack('<HHI', attribute, 0, template.object_definition_size)
+            elif attribute == 5:
+                data += struct.pack('<HHI', attribute, 0, template.structure_size)
+            else:
+                raise CipError(ATTRIBUTE_NOT_SUPPORTED)
+        return data
+
+    def read_template(self, template, body):
+        offset, length = struct.unpack_from('<IH', body, 0)
+        limit = self.connection_size - 16
+        chunk = template.data[offset:offset + min(length, limit)]
+        done = offset + len(chunk) >= len(template.data) or len(chunk) >= length
+        return reply(READ_TAG, SUCCESS if done else PARTIAL_TRANSFER, chunk)
+
+    def instance_attribute_list(self, start, body):
+        count = struct.unpack_from('<H', body, 0)[0]
+        attributes = struct.unpack_from(f'<{count}H', body, 2)
+        limit = self.connection_size - 16
+        data = b''
+        for instance_id in sorted(self.plc.by_instance):
+            if instance_id < start:
+                continue
+            tag = self.plc.by_instance[instance_id]
+            entry = struct.pack('<I', instance_id)
+            for attribute in attributes:
+                if attribute == 1:
+                    name = tag.name.encode()
+                    entry += struct.pack('<H', len(name)) + name
+                elif attribute == 2:
+                    entry += struct.pack('<H', tag.symbol_type)
+                elif attribute in (3, 5):
+                    entry += struct.pack('<I', instance_id << 8)
+                elif attribute == 6:
+                    entry += struct.pack('<I', BASE_TAG_BIT)
+                elif attribute == 8:
+                    entry += struct.pack('<III', 0, 0, 0)
+                elif attribute == 10:
+                    entry += b'\x00'    # read/write
+                else:
+                    raise CipError(ATTRIBUTE_NOT_SUPPORTED)
+            if data and len(data) + len(entry) > limit:
+                return reply(GET_INSTANCE_ATTRIBUTE_LIST, PARTIAL_TRANSFER, data)
+            data += entry
+        return reply(GET_INSTANCE_ATTRIBUTE_LIST, SUCCESS, data)
+
+    def resolve_tag(self, segments):
+        """Tag and member names addressed by a symbol instance or symbolic path"""
+        tag = None
+        members = []
+        for kind, value in segments:
+            if kind == 'class':
+                if value != SYMBOL_CLASS or tag is not None:
+                    raise CipError(PATH_DESTINATION_UNKNOWN)
+                continue
+            if kind == 'member':
+                raise CipError(PATH_DESTINATION_UNKNOWN, message="arrays are not emulated")
+            if tag is not None and kind == 'symbol':
+                members.append(value)
+                continue
+            if kind == 'instance' and tag is None:
+                tag = self.plc.by_instance.get(value)
+            elif kind == 'symbol':
+                tag = self.plc.tags.get(value)
+            else:
+                raise CipError(PATH_SEGMENT_ERROR)
+            if tag is None:
+                raise CipError(PATH_DESTINATION_UNKNOWN)
+        if tag is None:
+            raise CipError(PATH_DESTINATION_UNKNOWN)
+        return tag, members
+
+    def tag_service(self, service, tag, members, body):
+        plc = self.plc
+        if service == READ_TAG:
+            header, value = plc.read(tag, members)
+            return reply(service, data=header + value)
+        if service == READ_TAG_FRAGMENTED:
+            offset = struct.unpack_from('<I', body, 2)[0]
+            header, value = plc.read(tag, members)
+            limit = self.connection_size - 16 - len(header)
+            chunk = value[offset:offset + limit]
+            status = SUCCESS if offset + len(chunk) >= len(value) else PARTIAL_TRANSFER
+            return reply(service, status, header + chunk)
+        if service in (WRITE_TAG, WRITE_TAG_FRAGMENTED):
+            type_code = struct.unpack_from('<H', body, 0)[0]
+            position = 4 if type_code == STRUCT_REPLY else 2
+            position += 2   # element count
+            offset = 0
+            if service == WRITE_TAG_FRAGMENTED:
+                offset = struct.unpack_from('<I', body, position)[0]
+                position += 4
+            plc.write(tag, members, type_code, body[position:], offset)
+            return reply(service)
+        if service == READ_MODIFY_WRITE:
+            size = struct.unpack_from('<H', body, 0)[0]
+            or_mask = int.from_bytes(body[2:2 + size], 'little')
+            and_mask = int.from_bytes(body[2 + size:2 + 2 * size], 'little')
+            header, value = plc.read(tag, members)
+            current = int.from_bytes(value, 'little')
+            updated = ((current | or_mask) & and_mask).to_bytes(len(value), 'little')
+            plc.write(tag, members, struct.unpack_from('<H', header)[0], updated)
+            return reply(service)
+        raise CipError(SERVICE_NOT_SUPPORTED)
+
+
+class EncapsulationHandler(socketserver.BaseRequestHandler):
+    """One client TCP connection: reads encapsulation packets and answers them in order"""
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.session = Session(self.server.plc, self.server)
+
+    def finish(self):
+        self.session.close()
+
+    def receive(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def handle(self):
+        plc = self.server.plc
+        while True:
+            try:
+                header = self.receive(ENCAP_HEADER.size)
+                if header is None:
+                    return
+                command, length, session, _, context, _ = ENCAP_HEADER.unpack(header)
+                payload = self.receive(length) if length else b''
+                if payload is None:
+                    return
+            except OSError:
+                return
+
+            if command == UNREGISTER_SESSION:
+                return
+            if command == NOP:
+                continue
+            if command == REGISTER_SESSION:
+                self.session.handle = random.getrandbits(31) or 1
+                response = self.packet(command, self.session.handle, context, payload[:4])
+            elif command == LIST_IDENTITY:
+                response = self.packet(command, session, context, self.list_identity())
+            elif command in (SEND_RR_DATA, SEND_UNIT_DATA):
+                service, response = plc.respond(lambda: self.send_data(command, session, context, payload))
+                plc.count(service, len(header) + len(payload), len(response))
+            else:
+                response = self.packet(command, session, context, b'', status=0x01)
+            try:
+                self.request.sendall(response)
+            except OSError:
+                return
+
+    @staticmethod
+    def packet(command, session, context, data, status=0):
+        return ENCAP_HEADER.pack(command, len(data), session, status, context, 0) + data
+
+    def list_identity(self):
+        address, port = self.server.server_address
+        name = f"1769-L33ER/A {self.server.plc.name}".encode()[:32]
+        identity = struct.pack('<H', 1) + struct.pack('>hH', 2, port) + ipaddress.IPv4Address(address).packed + bytes(8)
+        identity += struct.pack('<HHHBB2sI', VENDOR_ROCKWELL, PRODUCT_TYPE_PLC, PRODUCT_CODE, REVISION[0], REVISION[1],
+                                STATUS_RUN, self.server.plc.serial) + bytes((len(name),)) + name + b'\x03'
+        return struct.pack('<HHH', 1, 0x0C, len(identity)) + identity
+
+    def send_data(self, command, session, context, payload):
+        """(CIP service, reply packet) for a SendRRData or SendUnitData request"""
+        # Common packet format: interface handle, timeout, item count, items
+        count = struct.unpack_from('<H', payload, 6)[0]
+        position = 8
+        address = b''
+        data = b''
+        for _ in range(count):
+            item_type, item_length = struct.unpack_from('<HH', payload, position)
+            item = payload[position + 4:position + 4 + item_length]
+            position += 4 + item_length
+            if item_type in (0xA1, 0x00):
+                address = item
+            elif item_type in (0xB1, 0xB2):
+                data = item
+
+        if command == SEND_UNIT_DATA:
+            sequence, message = data[:2], data[2:]
+            response = self.session.message(message, connected=True)
+            items = (struct.pack('<HH', 0xA1, 4) + (address or bytes(4))
+                     + struct.pack('<HH', 0xB1, len(response) + 2) + sequence + response)
+        else:
+            response = self.session.message(data, connected=False)
+            items = struct.pack('<HH', 0x00, 0) + struct.pack('<HH', 0xB2, len(response)) + response
+        common = struct.pack('<IHH', 0, 0, 2) + items
+        service = message[0] if command == SEND_UNIT_DATA else data[0] if data else command
+        return service, self.packet(command, session, context, common)
+
+
+class EmulatorServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, plc):
+        self.plc = plc
+        super().__init__(address, EncapsulationHandler)
+
+
+def machine_profiles(config_path):
+    """(udt_tag, UDT member names) of every machine in machines.json, enabled or not"""
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(config_path))
+    profiles = []
+    for machine in config['machines']:
+        members = list(CLOCK_FIELDS) + ['MC_Cam_Position', 'MC_Status_Code', 'MC_Status']
+        for key in ('high_speed_tags', 'low_speed_tags'):
+            with open(os.path.join(base_dir, machine[key]), 'r') as f:
+                members += [tag for tag in json.load(f)['tags'] if tag not in members]
+        profiles.append((machine['udt_tag'], members))
+    return profiles
+
+
+def load_hmi_tags(path=PLC_TAGS_PATH):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        logger.warning(f"{path} not found, emulating the machine UDTs only")
+        return {}
+
+
+def addresses(first, count):
+    """count (host, port) pairs after first, which is an address or address:port"""
+    host, _, port = first.partition(':')
+    if port:
+        return [(host, int(port) + i) for i in range(count)]
+    start = ipaddress.IPv4Address(host)
+    return [(str(start + i), DEFAULT_PORT) for i in range(count)]
+
+
+def start_emulators(count=1, latency=0.002, first='127.0.1.1', config_path='machines.json', jitter=None,
+                    serialize=True, max_connections=32):
+    """Start count emulated PLCs, cycling through the machines.json profiles; returns the servers"""
+    profiles = machine_profiles(config_path)
+    hmi_tags = load_hmi_tags()
+    servers = []
+    for i, address in enumerate(addresses(first, count)):
+        udt_tag, members = profiles[i % len(profiles)]
+        plc = EmulatedPLC(f"plc{i + 1:03d}", udt_tag, members, hmi_tags.get(udt_tag, hmi_tags.get('MC17', ())),
+                          latency=latency, jitter=latency / 2 if jitter is None else jitter,
+                          serialize=serialize, max_connections=max_connections, seed=i)
+        server = EmulatorServer(address, plc)
+        threading.Thread(target=server.serve_forever, daemon=True, name=f"Emulator-{plc.name}").start()
+        servers.append(server)
+        logger.info(f"{plc.name}: {udt_tag} with {len(plc.tags)} tags on {address[0]}:{address[1]}")
+    return servers
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.002
+    first = sys.argv[3] if len(sys.argv) > 3 else '127.0.1.1'
+    config_path = sys.argv[4] if len(sys.argv) > 4 else 'machines.json'
+    try:
+        servers = start_emulators(count, latency, first, config_path)
+    except OSError as e:
+        logger.error(f"Cannot listen on {first}: {e}. Use 127.0.0.1:<port> where 127/8 is not routed to lo.")
+        sys.exit(1)
+    print(f"{count} emulated PLC(s), {latency * 1000:.1f} ms latency: "
+          + ', '.join(f"{host}:{port}" for host, port in (server.server_address for server in servers)))
+
+    last = {}
+    try:
+        while True:
+            time.sleep(10)
+            for server in servers:
+                plc = server.plc
+                stats = plc.stats()
+                requests = stats['requests'] - last.get(plc.name, 0)
+                last[plc.name] = stats['requests']
+                if requests:
+                    logger.info(f"{plc.name}: {requests / 10:.1f} requests/s, {stats['connections']} connections, "
+                                f"busy {stats['busy_seconds']:.1f} s, services {stats['services']}")
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    main()
@@ -0,0 +1,510 @@
+"""PLC session gateway: one CIP session per PLC, shared by every tool on the host.
+
+Tools that used to open their own LogixDriver (the loop3 checkpoints, the
+control and notification services, the tag readers, the S1/S2 sweeps) each
+paid a Forward Open and a tag list upload and took one of the controller's
+few CIP connections. The gateway holds a single session per PLC and serves
+all of them over a local Unix socket (see gateway_client.py):
+
+  - read requests waiting for a PLC at the same time are merged into one
+    plc.read() of the union of their tags, which pycomm3 packs into as few
+    multi-service packets as the connection size allows;
+  - writes are executed one at a time, in arrival order, and never overtake
+    or get merged with the reads queued around them;
+  - subscriptions are reads the gateway repeats every interval and pushes to
+    the client; they are merged with the other reads that are due.
+
+The protocol is one JSON object per line in each direction:
+
+    {"id": 1, "op": "read", "plc": "mc17", "tags": ["MC_Hor_Pressure", "HMI_Ver_Sealer_Strk_1"]}
+    {"id": 2, "op": "write", "plc": "141.141.141.128", "tags": [["HMI_I_Start", true]]}
+    {"id": 3, "op": "subscribe", "plc": "mc18", "tags": ["MC18.MC_Status_Code"], "interval": 0.5}
+    {"id": 4, "op": "unsubscribe", "subscription": 3}
+    {"id": 5, "op": "stats"}
+
+and every answer carries the id of its request: {"id": 1, "results": [{"tag":
+..., "value": ..., "type": ..., "error": ...}, ...]}, or {"id": 1, "error":
+"..."}. Subscription updates carry the id of the subscribe request and
+"update": true. A PLC is named by its machine name or its IP address. The PLCs are
+the machines in machines.json unless the "gateway" section lists "plcs".
+
+Usage: python3 plc_gateway.py [machines.json]
+"""
+import collections
+import json
+import logging
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+
+from pycomm3 import LogixDriver
+
+import async_log
+import metrics
+from supervisor import Supervisor
+from tag_cache import CachedLogixDriver, cache_options
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = '/run/ai4m/plc_gateway.sock'
+
+GATEWAY_REQUESTS = metrics.counter('ai4m_gateway_requests_total', 'Client requests handled by the PLC gateway',
+                                   ['plc', 'op'])
+GATEWAY_REQUEST_SECONDS = metrics.histogram('ai4m_gateway_request_seconds',
+                                            'Gateway request latency, queued to answered', ['plc', 'op'])
+GATEWAY_PLC_CALLS = metrics.counter('ai4m_gateway_plc_calls_total', 'plc.read()/plc.write() calls of the gateway',
+                                    ['plc', 'op'])
+
+
+class GatewayError(Exception):
+    pass
+
+
+def tag_result(tag):
+    """JSON form of a pycomm3 Tag"""
+    return {'tag': tag.tag, 'value': tag.value, 'type': tag.type, 'error': tag.error}
+
+
+class PendingRequest:
+    """A read or write waiting for its PLC session"""
+
+    def __init__(self, op, tags):
+        self.op = op
+        self.tags = tags
+        self.queued = time.monotonic()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+    def finish(self, results=None, error=None):
+        self.results = results
+        self.error = error
+        self.done.set()
+
+
+class Subscription:
+    """Tags read every interval and pushed to one client connection"""
+
+    def __init__(self, sid, tags, interval, send):
+        self.sid = sid
+        self.tags = tags
+        self.interval = interval
+        self.send = send
+        self.due = time.monotonic()
+
+
+class PlcSession:
+    """The gateway's only LogixDriver session to one PLC and the worker thread that uses it"""
+
+    def __init__(self, name, ip, supervisor, backoff, max_batch_tags=200, tag_cache=None, max_pending=1000):
+        self.name = name
+        self.ip = ip
+        self.max_batch_tags = max_batch_tags
+        self.max_pending = max_pending
+        self.tag_cache = tag_cache
+        self.plc = None
+        self.health = supervisor.component(f"gateway:{name}", **backoff)
+        self.pending = collections.deque()
+        self.subscriptions = {}
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopping = False
+        self.read_latency = metrics.PLC_READ_SECONDS.labels(f"gateway:{name}")
+        self.write_latency = metrics.PLC_WRITE_SECONDS.labels(f"gateway:{name}")
+        self.connects = metrics.PLC_CONNECTS.labels(f"gateway:{name}", 'ok')
+        self.connect_failures = metrics.PLC_CONNECTS.labels(f"gateway:{name}", 'error')
+        metrics.QUEUE_DEPTH.labels(f"gateway_{name}").set_function(lambda: len(self.pending))
+
+        # Metrics
+        self.read_requests = 0
+        self.write_requests = 0
+        self.subscription_reads = 0
+        self.read_calls = 0
+        self.write_calls = 0
+        self.tags_read = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True, name=f"Gateway-{self.name}")
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread:
+            self.thread.join(timeout=5)
+        self.close_plc()
+
+    def submit(self, op, tags, timeout=10.0):
+        """Queue a read (list of tags) or write (list of (tag, value)) and wait for its results"""
+        request = PendingRequest(op, tags)
+        with self.condition:
+            if len(self.pending) >= self.max_pending:
+                self.rejected += 1
+                raise GatewayError(f"{self.name}: {len(self.pending)} requests already queued for the PLC")
+            self.pending.append(request)
+            self.condition.notify()
+        if not request.done.wait(timeout):
+            with self.condition:
+                try:
+                    # Not started yet: drop it, so a write the client was told failed never reaches the PLC
+                    self.pending.remove(request)
+                    started = False
+                except ValueError:
+                    started = True
+            self.timed_out += 1
+            if not started:
+                raise GatewayError(f"{self.name}: no answer from the PLC within {timeout} s, request not sent")
+            # Already on the wire: its outcome is only known once the PLC answers or the session times out
+            if not request.done.wait(timeout):
+                raise GatewayError(f"{self.name}: no answer from the PLC within {2 * timeout} s, "
+                                   f"the {op} may still have been executed")
+        GATEWAY_REQUESTS.labels(self.name, op).inc()
+        GATEWAY_REQUEST_SECONDS.labels(self.name, op).observe(time.monotonic() - request.queued)
+        if request.error:
+            raise GatewayError(request.error)
+        return request.results
+
+    def subscribe(self, subscription):
+        with self.condition:
+            self.subscriptions[id(subscription)] = subscription
+            self.condition.notify()
+
+    def unsubscribe(self, subscription):
+        with self.condition:
+            self.subscriptions.pop(id(subscription), None)
+
+    def next_batch(self):
+        """The next write on its own, or every queued read plus the due subscriptions"""
+        with self.condition:
+            while not self.stopping:
+                now = time.monotonic()
+                due = [subscription for subscription in self.subscriptions.values() if subscription.due <= now]
+                if self.pending and self.pending[0].op == 'write':
+                    return self.pending.popleft(), []
+                if self.pending or due:
+                    reads = []
+                    while self.pending and self.pending[0].op == 'read':
+                        reads.append(self.pending.popleft())
+                    return reads, due
+                wake = min((subscription.due for subscription in self.subscriptions.values()), default=None)
+                self.condition.wait(None if wake is None else max(0.0, wake - now))
+            return None, None
+
+    def run(self):
+        while True:
+            requests, due = self.next_batch()
+            if requests is None:
+                return
+            if isinstance(requests, PendingRequest):
+                self.execute_write(requests)
+            else:
+                self.execute_reads(requests, due)
+
+    def connect(self):
+        """Open the session if needed; returns an error message when the PLC is unreachable"""
+        if self.plc is not None and self.plc.connected:
+            return None
+        try:
+            self.close_plc()
+            if self.tag_cache is not None:
+                self.plc = CachedLogixDriver(self.ip, **self.tag_cache)
+            else:
+                self.plc = LogixDriver(self.ip)
+            self.plc.open()
+            self.connects.inc()
+            self.health.healthy()
+            logger.info(f"{self.name}: gateway session open to {self.ip}")
+            return None
+        except Exception as e:
+            self.plc = None
+            self.connect_failures.inc()
+            logger.error(f"{self.name}: cannot connect to PLC at {self.ip}: {e}")
+            self.health.failed(e)
+            return f"PLC {self.name} unavailable: {e}"
+
+    def close_plc(self):
+        try:
+            if self.plc:
+                self.plc.close()
+        except Exception as e:
+            logger.error(f"{self.name}: error closing gateway session: {e}")
+        self.plc = None
+
+    def read_tags(self, tags):
+        """{tag: result} for a list of unique tags, in chunks of max_batch_tags"""
+        results = {}
+        for i in range(0, len(tags), self.max_batch_tags):
+            chunk = tags[i:i + self.max_batch_tags]
+            started = time.perf_counter()
+            values = self.plc.read(*chunk)
+            self.read_latency.observe(time.perf_counter() - started)
+            self.read_calls += 1
+            GATEWAY_PLC_CALLS.labels(self.name, 'read').inc()
+            if len(chunk) == 1:
+                values = [values]
+            results.update({tag: tag_result(value) for tag, value in zip(chunk, values)})
+        self.tags_read += len(tags)
+        return results
+
+    def execute_reads(self, requests, due):
+        tags = list(dict.fromkeys(tag for request in requests for tag in request.tags))
+        for subscription in due:
+            tags.extend(tag for tag in subscription.tags if tag not in tags)
+        self.read_requests += len(requests)
+        self.subscription_reads += len(due)
+
+        error = self.connect()
+        results = {}
+        if error is None:
+            try:
+                results = self.read_tags(tags)
+            except Exception as e:
+                error = f"read from {self.name} failed: {e}"
+                logger.error(error)
+                self.close_plc()
+                self.health.degraded(e)
+
+        for request in requests:
+            if error:
+                request.finish(error=error)
+            else:
+                request.finish([results[tag] for tag in request.tags])
+        now = time.monotonic()
+        for subscription in due:
+            subscription.due = max(subscription.due + subscription.interval, now)
+            if error:
+                message = {'id': subscription.sid, 'update': True, 'error': error}
+            else:
+                message = {'id': subscription.sid, 'update': True, 'time': time.time(),
+                           'results': [results[tag] for tag in subscription.tags]}
+            if not subscription.send(message):
+                self.unsubscribe(subscription)
+
+    def execute_write(self, request):
+        self.write_requests += 1
+        error = self.connect()
+        if error:
+            request.finish(error=error)
+            return
+        try:
+            started = time.perf_counter()
+            values = self.plc.write(*[tuple(pair) for pair in request.tags])
+            self.write_latency.observe(time.perf_counter() - started)
+            self.write_calls += 1
+            GATEWAY_PLC_CALLS.labels(self.name, 'write').inc()
+            if len(request.tags) == 1:
+                values = [values]
+            request.finish([tag_result(value) for value in values])
+        except Exception as e:
+            logger.error(f"write to {self.name} failed: {e}")
+            self.close_plc()
+            self.health.degraded(e)
+            request.finish(error=f"write to {self.name} failed: {e}")
+
+    def stats(self):
+        return {
+            'plc': self.name,
+            'ip': self.ip,
+            'connected': bool(self.plc and self.plc.connected),
+            'pending': len(self.pending),
+            'subscriptions': len(self.subscriptions),
+            'read_requests': self.read_requests,
+            'subscription_reads': self.subscription_reads,
+            'read_calls': self.read_calls,
+            'requests_per_read_call': (self.read_requests + self.subscription_reads) / self.read_calls
+            if self.read_calls else None,
+            'tags_read': self.tags_read,
+            'write_requests': self.write_requests,
+            'write_calls': self.write_calls,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'health': self.health.stats(),
+        }
+
+
+class GatewayHandler(socketserver.StreamRequestHandler):
+    """One client connection: JSON requests in, JSON answers and subscription updates out"""
+
+    def setup(self):
+        super().setup()
+        self.send_lock = threading.Lock()
+        self.subscriptions = []
+        self.closed = False
+
+    def finish(self):
+        self.closed = True
+        for session, subscription in self.subscriptions:
+            session.unsubscribe(subscription)
+        super().finish()
+
+    def send(self, message):
+        """Write one message; False once the client has gone"""
+        if self.closed:
+            return False
+        data = (json.dumps(message, default=str) + '\n').encode('utf-8')
+        try:
+            with self.send_lock:
+                self.wfile.write(data)
+                self.wfile.flush()
+            return True
+        except OSError:
+            self.closed = True
+            return False
+
+    def handle(self):
+        while True:
+            try:
+                line = self.rfile.readline()
+            except OSError:
+                return
+            if not line:
+                return
+            try:
+                message = json.loads(line)
+            except ValueError:
+                self.send({'id': None, 'error': 'invalid JSON'})
+                continue
+            if message.get('op') in ('read', 'write'):
+                # Reads and writes wait on the PLC; answer them from a thread so a slow PLC
+                # does not hold up this client's requests to another one
+                threading.Thread(target=self.answer, args=(message,), daemon=True).start()
+            else:
+                self.answer(message)
+
+    def answer(self, message):
+        request_id = message.get('id')
+        try:
+            self.send(dict(self.dispatch(message), id=request_id))
+        except GatewayError as e:
+            self.send({'id': request_id, 'error': str(e)})
+        except (KeyError, TypeError, ValueError) as e:
+            self.send({'id': request_id, 'error': f"bad request: {e!r}"})
+
+    def dispatch(self, message):
+        op = message['op']
+        if op == 'stats':
+            return {'stats': self.server.gateway.stats()}
+        if op == 'unsubscribe':
+            for session, subscription in list(self.subscriptions):
+                if subscription.sid == message['subscription']:
+                    session.unsubscribe(subscription)
+                    self.subscriptions.remove((session, subscription))
+            return {'ok': True}
+
+        session = self.server.gateway.session(message['plc'])
+        tags = message['tags']
+        if isinstance(tags, str):
+            tags = [tags]
+        if op == 'read':
+            return {'results': session.submit('read', list(tags), self.server.gateway.timeout)}
+        if op == 'write':
+            return {'results': session.submit('write', [tuple(pair) for pair in tags], self.server.gateway.timeout)}
+        if op == 'subscribe':
+            interval = max(float(message.get('interval', 1.0)), self.server.gateway.min_interval)
+            subscription = Subscription(message['id'], list(tags), interval, self.send)
+            self.subscriptions.append((session, subscription))
+            session.subscribe(subscription)
+            return {'subscribed': True, 'interval': interval}
+        raise ValueError(f"unknown op {op!r}")
+
+
+class GatewayServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class PlcGateway:
+    """The PLC sessions and the Unix socket server in front of them"""
+
+    def __init__(self, config_path='machines.json'):
+        with open(config_path, 'r') as f:
+            config = json.load(f)
+        gateway = config.get('gateway', {})
+        self.socket_path = gateway.get('socket', DEFAULT_SOCKET)
+        self.socket_mode = int(str(gateway.get('socket_mode', '660')), 8)
+        self.timeout = gateway.get('timeout', 10.0)
+        self.min_interval = gateway.get('min_interval', 0.05)
+        self.metrics_port = gateway.get('metrics_port')
+        plcs = gateway.get('plcs') or {machine['name']: machine['ip'] for machine in config['machines']}
+
+        tag_cache = cache_options(config, os.path.dirname(os.path.abspath(config_path)))
+
+        self.supervisor = Supervisor()
+        backoff = config.get('reconnect_backoff', {})
+        self.sessions = {name: PlcSession(name, ip, self.supervisor, backoff, gateway.get('max_batch_tags', 200),
+                                          tag_cache, gateway.get('max_pending', 1000))
+                         for name, ip in plcs.items()}
+        self.sessions_by_key = dict(self.sessions)
+        self.sessions_by_key.update({session.ip: session for session in self.sessions.values()})
+        self.server = None
+
+    def session(self, plc):
+        session = self.sessions_by_key.get(str(plc))
+        if session is None:
+            raise GatewayError(f"unknown PLC {plc!r}")
+        return session
+
+    def serve(self):
+        directory = os.path.dirname(self.socket_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.server = GatewayServer(self.socket_path, GatewayHandler)
+        self.server.gateway = self
+        os.chmod(self.socket_path, self.socket_mode)
+        for session in self.sessions.values():
+            session.start()
+        if self.metrics_port:
+            metrics.start_http_server(self.metrics_port)
+        logger.info(f"PLC gateway for {', '.join(f'{s.name} ({s.ip})' for s in self.sessions.values())} "
+                    f"listening on {self.socket_path}")
+        threading.Thread(target=self.server.serve_forever, daemon=True, name="GatewayServer").start()
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+        for session in self.sessions.values():
+            session.stop()
+
+    def stats(self):
+        return {name: session.stats() for name, session in self.sessions.items()}
+
+
+def _handle_sigterm(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main():
+    config_path = sys.argv[1] if len(sys.argv) > 1 else 'machines.json'
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    async_log.setup_logging(dict(config.get('logging', {}),
+                                 file=config.get('gateway', {}).get('log_file', '/var/log/plc_gateway.log')))
+    gateway = PlcGateway(config_path)
+    gateway.serve()
+    signal.signal(signal.SIGTERM, _handle_sigterm)
+    try:
+        while True:
+            time.sleep(60)
+            for stats in gateway.stats().values():
+                logger.info(f"{stats['plc']}: {stats['read_requests']} reads and {stats['subscription_reads']} "
+                            f"subscription updates in {stats['read_calls']} PLC reads, "
+                            f"{stats['write_requests']} writes, {stats['subscriptions']} subscriptions")
+    except KeyboardInterrupt:
+        logger.info("Shutting down...")
+        gateway.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,15 @@ import sys
 import logging
 from pycomm3 import LogixDriver
 import psycopg2
+import async_log
+import metrics
+from aggregates import WindowAggregator, aggregate_columns
+from copy_writer import CopyWriter
+from cycle_features import CycleFeatureExtractor
+from cycle_state import CycleStateStore, max_cycle_id
+from ring_buffer import SampleRingBuffer
+from scheduler import FixedRateScheduler
+from supervisor import Supervisor
 
 logger = logging.getLogger(__name__)
 
@@ -39,16 +48,21 @@ class CycleTracker:
 
         # Generate dynamic SQL queries
         high_speed_columns = ['"timestamp"'] + [tag.lower().replace('mc_', '') for tag in self.high_speed_tags] + ['spare1']
-        self.high_speed_query = f"""
-        INSERT INTO mc17 ({', '.join(high_speed_columns)})
-        VALUES ({', '.join(['%s'] * len(high_speed_columns))});
-        """
+        self.high_speed_writer = CopyWriter('mc17', high_speed_columns, max_rows=100, max_latency=1.0)
 
         low_speed_columns = ['"timestamp"'] + [tag.lower().replace('mc_', '') for tag in self.low_speed_tags] + ['spare1']
-        self.low_speed_query = f"""
-        INSERT INTO mc17_mid ({', '.join(low_speed_columns)})
-        VALUES ({', '.join(['%s'] * len(low_speed_columns))});
-        """
+        self.low_speed_writer = CopyWriter('mc17_mid', low_speed_columns, max_rows=6, max_latency=10.0)
+
+        # Optional 5 s min/max/mean/last/count per low-speed tag, next to the snapshots;
+        # create mc17_mid_agg before enabling it (see aggregates.py for the table)
+        self.aggregate_low_speed = False
+        self.aggregate_writer = CopyWriter('mc17_mid_agg', aggregate_columns(self.low_speed_tags), max_rows=6, max_latency=10.0)
+
+        # Optional summary row per machine cycle; create mc17_cycles before enabling it
+        # (see cycle_features.py for the table)
+        self.extract_cycles = False
+        self.cycle_features = CycleFeatureExtractor({})
+        self.cycle_writer = CopyWriter('mc17_cycles', self.cycle_features.columns, max_rows=50, max_latency=10.0)
 
         self.db_settings = {
             'host': '192.168.1.149',
@@ -59,42 +73,55 @@ class CycleTracker:
 
         # Application state
         self.plc = None
+        self.stopping = threading.Event()
         self.cycle_id = 1
         self.last_cam_position = None
         self.current_day = None
+        self.cycle_state = CycleStateStore('cycle_state_mc17.json')  # survives restarts
+        self.saved_cycle_id = None
         self.last_message_time = time.time()
         self.timeout = 30
+        self.sample_buffer = SampleRingBuffer(capacity=2000)  # ~60 s of 30 ms samples
+        self.db_batch_size = 200
+        self.scheduler = FixedRateScheduler(period=0.03, policy='skip', name='mc17')
+        self.last_overflow_count = 0
         self.last_low_speed_insert = 0
         self.low_speed_interval = 5  # 5 seconds for low-speed data
-        self.low_speed_data_buffer = None
+        self.low_speed_data_buffer = WindowAggregator(self.low_speed_tags, self.low_speed_interval)
+
+        # Each dependency reconnects on its own, with backoff
+        self.supervisor = Supervisor()
+        self.plc_health = self.supervisor.component('plc')
+        self.db_health = self.supervisor.component('db')
+        self.last_health_summary = None
+        self.metrics_port = 9127
+        self.read_latency = metrics.PLC_READ_SECONDS.labels('mc17')
+        self.read_errors = metrics.PLC_READ_ERRORS.labels('mc17')
+        metrics.QUEUE_DEPTH.labels('samples').set_function(lambda: self.sample_buffer.size)
+        metrics.QUEUE_DROPPED.labels('samples').set_function(lambda: self.sample_buffer.overflow_count)
 
         # Initialize connections
         self.connect_all()
 
     def connect_all(self):
-        """Establish all required connections with continuous retry"""
-        while True:
-            try:
-                self.connect_plc()
-                self.connect_db()
-                return
-            except Exception as e:
-                logger.error(f"Connection error: {e}. Retrying all connections in 5 seconds...")
-                time.sleep(5)
+        """Establish all required connections; each one retries on its own"""
+        self.connect_plc()
+        self.connect_db()
 
     def connect_db(self):
-        """Connect to PostgreSQL database with continuous retry"""
-        while True:
+        """Connect to PostgreSQL database with continuous retry until shutdown"""
+        while not self.stopping.is_set():
             try:
                 self.close_db_connection()
                 self.conn = psycopg2.connect(**self.db_settings)
                 self.conn.autocommit = False
                 self.cursor = self.conn.cursor()
-                print("Successfully connected to PostgreSQL database")
+                self.db_health.healthy()
+                logger.info("Successfully connected to PostgreSQL database")
                 return
             except Exception as e:
-                logger.error(f"Database connection error: {e}. Retrying in 5 seconds...")
-                time.sleep(5)
+                logger.error(f"Database connection error: {e}")
+                self.db_health.failed(e)
 
     def close_db_connection(self):
         """Safely close database connection"""
@@ -112,21 +139,24 @@ class CycleTracker:
         self.conn = None
 
     def connect_plc(self):
-        while True:
+        while not self.stopping.is_set():
             try:
                 if self.plc:
                     self.plc.close()
                 self.plc = LogixDriver(self.plc_ip)
                 self.plc.open()
-                print(f"Successfully connected to PLC at {self.plc_ip}")
+                metrics.PLC_CONNECTS.labels('mc17', 'ok').inc()
+                logger.info(f"Successfully connected to PLC at {self.plc_ip}")
                 return
             except Exception as e:
-                logger.error(f"Failed to connect to PLC at {self.plc_ip}: {e}. Retrying in 5 seconds...")
-                time.sleep(5)
+                logger.error(f"Failed to connect to PLC at {self.plc_ip}: {e}")
+                metrics.PLC_CONNECTS.labels('mc17', 'error').inc()
+                self.plc_health.failed(e)
 
     def reconnect(self):
-        """Reconnect to all services"""
-        self.connect_all()
+        """Reconnect the PLC session only; the database recovers on its own errors"""
+        self.plc_health.degraded(f"no data for {self.timeout} s")
+        self.connect_plc()
         self.last_message_time = time.time()
 
     def check_data_flow(self):
@@ -135,8 +165,38 @@ class CycleTracker:
             if time.time() - self.last_message_time > self.timeout:
                 logger.warning(f"No data received for {self.timeout} seconds. Reconnecting...")
                 self.reconnect()
+            buffer_stats = self.sample_buffer.stats()
+            if buffer_stats['overflow_count'] != self.last_overflow_count:
+                logger.warning(f"Sample buffer overflow: {buffer_stats}")
+                self.last_overflow_count = buffer_stats['overflow_count']
+            summary = self.supervisor.summary()
+            if summary != self.last_health_summary:
+                logger.info(f"Health: {summary}")
+                self.last_health_summary = summary
             time.sleep(5)
 
+    def flush_writers(self):
+        """Buffer the samples left in the ring buffer and write all buffered rows before shutdown"""
+        for data in self.sample_buffer.get_batch(self.sample_buffer.capacity, timeout=0):
+            try:
+                self.buffer_sample(data)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.error(f"Error processing data: {e}")
+        closed = self.low_speed_data_buffer.flush()
+        if closed:
+            self.add_low_speed_window(closed)
+        cycle_row = self.cycle_features.flush()
+        if cycle_row:
+            self.cycle_writer.add(cycle_row)
+        try:
+            if self.conn is not None and self.conn.closed == 0:
+                self.high_speed_writer.flush(self.conn)
+                self.low_speed_writer.flush(self.conn)
+                self.aggregate_writer.flush(self.conn)
+                self.cycle_writer.flush(self.conn)
+        except Exception as e:
+            logger.error(f"Error flushing buffered rows: {e}")
+
     def ensure_db_connection(self):
         """Ensure we have a valid database connection"""
         try:
@@ -150,94 +210,158 @@ class CycleTracker:
 
     def read_plc_data(self):
         """Read data from PLC"""
-        while True:
+        while not self.stopping.is_set():
             try:
                 if not self.plc or not self.plc.connected:
                     logger.warning("PLC not connected, reconnecting...")
                     self.connect_plc()
 
+                started = time.perf_counter()
                 tag_value = self.plc.read("MC17")
+                self.read_latency.observe(time.perf_counter() - started)
                 if not tag_value:
+                    self.read_errors.inc()
                     logger.warning("No data read from PLC. Retrying.")
                     time.sleep(1)
                     continue
 
                 data = tag_value.value
                 self.last_message_time = time.time()
+                self.plc_health.healthy()
                 return data
 
             except Exception as e:
                 logger.error(f"Error reading from PLC: {e}. Attempting to reconnect.")
+                self.read_errors.inc()
+                self.plc_health.failed(e)
                 self.connect_plc()
-                time.sleep(1)
 
-    def process_data_to_db(self):
-        """Process data and insert into PostgreSQL tables"""
-        while True:
+    def acquire_plc_data(self):
+        """Poll the PLC on fixed 30 ms deadlines and push samples into the ring buffer"""
+        while not self.stopping.is_set():
+            self.scheduler.wait()
             data = self.read_plc_data()
+            if data is not None:
+                self.sample_buffer.put(data)
+
+    def resume_cycle_id(self, day):
+        """Continue today's cycle numbering after a restart instead of starting again at 1"""
+        cycle_id = self.cycle_state.resume('mc17', day)
+        if cycle_id is not None:
+            return cycle_id
+        try:
+            self.ensure_db_connection()
+            cycle_id = max_cycle_id(self.cursor, 'mc17', day) + 1
+            self.conn.rollback()
+            return cycle_id
+        except Exception as e:
+            logger.error(f"Could not look up today's last cycle: {e}. Starting at cycle 1")
+            return 1
+
+    def buffer_sample(self, data):
+        """Track the cycle for one sample and buffer its rows for the COPY writers"""
+        timestamp = datetime.datetime(
+            data['Year'], data['Month'], data['Day'],
+            data['Hour'], data['Min'], data['Sec'],
+            data['Microsecond']
+        )
+
+        current_day = timestamp.date()
+        if self.current_day is None:
+            self.current_day = current_day
+            self.cycle_id = self.resume_cycle_id(current_day)
+        elif current_day != self.current_day:
+            self.cycle_id = 1
+            self.current_day = current_day
+
+        current_cam_position = data['MC_Cam_Position']
+        if self.last_cam_position is not None:
+            position_diff = abs(current_cam_position - self.last_cam_position)
+            if position_diff > 280:
+                self.cycle_id += 1
+        self.last_cam_position = current_cam_position
+        if self.cycle_id != self.saved_cycle_id:
+            self.cycle_state.update('mc17', current_day, self.cycle_id)
+            self.saved_cycle_id = self.cycle_id
+
+        high_speed_values = [timestamp] + [data[tag] for tag in self.high_speed_tags] + [self.cycle_id]
+        self.high_speed_writer.add(high_speed_values)
+
+        current_time = timestamp.timestamp()
+        if self.extract_cycles:
+            cycle_row = self.cycle_features.update(self.cycle_id, timestamp, current_time, data)
+            if cycle_row:
+                self.cycle_writer.add(cycle_row)
+
+        # Low-speed data (5s) to mc17_mid; sample time, so draining a backlog keeps the 5 s spacing
+        if current_time - self.last_low_speed_insert >= self.low_speed_interval:
+            low_speed_values = [timestamp] + [data[tag] for tag in self.low_speed_tags] + [self.cycle_id]
+            self.low_speed_writer.add(low_speed_values)
+            self.last_low_speed_insert = current_time
+
+        # Low-speed aggregates (5s windows) to mc17_mid_agg; windows follow sample time too
+        if self.aggregate_low_speed:
+            low_speed_values = [data[tag] for tag in self.low_speed_tags]
+            closed = self.low_speed_data_buffer.add(current_time, low_speed_values, self.cycle_id)
+            if closed:
+                self.add_low_speed_window(closed)
+
+    def add_low_speed_window(self, closed):
+        window_start, count, aggregates, cycle_id = closed
+        self.aggregate_writer.add((datetime.datetime.fromtimestamp(window_start), count) + aggregates + (cycle_id,))
+
+    def process_data_to_db(self):
+        """Drain the ring buffer and write samples to PostgreSQL"""
+        while not self.stopping.is_set():
+            samples = self.sample_buffer.get_batch(self.db_batch_size, timeout=0.5)
 
             try:
+                for data in samples:
+                    try:
+                        self.buffer_sample(data)
+                    except KeyError as e:
+                        logger.error(f"Key error: Tag {e} not found in PLC data.")
+
                 if not self.ensure_db_connection():
                     logger.error("Failed to establish database connection. Will retry.")
                     time.sleep(1)
                     continue
 
-                timestamp = datetime.datetime(
-                    data['Year'], data['Month'], data['Day'],
-                    data['Hour'], data['Min'], data['Sec'],
-                    data['Microsecond']
-                )
-
-                current_day = timestamp.date()
-                if self.current_day is None:
-                    self.current_day = current_day
-                elif current_day != self.current_day:
-                    self.cycle_id = 1
-                    self.current_day = current_day
-
-                current_cam_position = data['MC_Cam_Position']
-                if self.last_cam_position is not None:
-                    position_diff = abs(current_cam_position - self.last_cam_position)
-                    if position_diff > 280:
-                        self.cycle_id += 1
-                self.last_cam_position = current_cam_position
-
-                with self.conn.cursor() as cursor:
-                    high_speed_values = [str(timestamp)] + [data[tag] for tag in self.high_speed_tags] + [self.cycle_id]
-                    cursor.execute(self.high_speed_query, high_speed_values)
-                    self.conn.commit()
-
-                current_time = time.time()
-                self.low_speed_data_buffer = data
-                if current_time - self.last_low_speed_insert >= self.low_speed_interval:
-                    with self.conn.cursor() as cursor:
-                        low_speed_values = [str(timestamp)] + [data[tag] for tag in self.low_speed_tags] + [self.cycle_id]
-                        cursor.execute(self.low_speed_query, low_speed_values)
-                        self.conn.commit()
-                        self.last_low_speed_insert = current_time
+                self.high_speed_writer.flush_if_due(self.conn)
+                self.low_speed_writer.flush_if_due(self.conn)
+                self.aggregate_writer.flush_if_due(self.conn)
+                self.cycle_writer.flush_if_due(self.conn)
 
             except psycopg2.InterfaceError as e:
                 logger.error(f"Database interface error: {e}. Will reconnect.")
                 self.close_db_connection()
-                time.sleep(1)
+                self.db_health.failed(e)
             except psycopg2.OperationalError as e:
                 logger.error(f"Database operational error: {e}. Will reconnect.")
                 self.close_db_connection()
-                time.sleep(5)
-            except KeyError as e:
-                logger.error(f"Key error: Tag {e} not found in PLC data.")
-                time.sleep(1)
+                self.db_health.failed(e)
             except Exception as e:
                 logger.error(f"Error processing data: {e}")
 
-            time.sleep(0.03)
+    @staticmethod
+    def join(threads):
+        """Wait for threads to finish, logging the ones that take long; no thread is abandoned"""
+        for thread in threads:
+            while True:
+                thread.join(timeout=5)
+                if not thread.is_alive():
+                    break
+                logger.warning(f"Shutdown: still waiting for {thread.name}")
 
     def start(self):
         threads = [
+            threading.Thread(target=self.acquire_plc_data, daemon=True, name="PlcAcquisitionThread"),
             threading.Thread(target=self.process_data_to_db, daemon=True, name="ProcessDataThread"),
             threading.Thread(target=self.check_data_flow, daemon=True, name="DataFlowThread")
         ]
 
+        self.cycle_state.start()
+        metrics.start_http_server(self.metrics_port)
         for thread in threads:
             thread.start()
 
@@ -245,11 +369,18 @@ class CycleTracker:
             while True:
                 time.sleep(1)
         except KeyboardInterrupt:
+            logger.info("Shutting down...")
+            self.stopping.set()
+            # Acquisition first, then the DB thread, so flush_writers is the only user of self.conn
+            self.join(threads[:2])
+            self.flush_writers()
+            self.cycle_state.close()
             self.close_db_connection()
             if self.plc:
                 self.plc.close()
             sys.exit(0)
 
 if __name__ == '__main__':
+    async_log.setup_logging({'file': '/var/log/plc_reader_mc17.log'})
     tracker = CycleTracker()
     tracker.start()
@@ -5,8 +5,20 @@ import time
 import threading
 import sys
 import json
+import logging
 from kafka import KafkaProducer
 from kafka.errors import KafkaError
+import async_log
+import metrics
+from copy_writer import CopyWriter
+from cycle_state import CycleStateStore, max_cycle_id
+from event_queue import BoundedEventQueue
+from ring_buffer import SampleRingBuffer
+from scheduler import FixedRateScheduler
+from status_events import StatusEventTracker
+from supervisor import Supervisor
+
+logger = logging.getLogger(__name__)
 
 class CycleTracker:
     def __init__(self):
@@ -14,26 +26,26 @@ class CycleTracker:
         self.plc_ip = '141.141.141.138'  # MC18 IP
         
         # Database configuration
-        self.insert_query = """
-        INSERT INTO mc18(
-            "timestamp", ver_sealer_front_1_temp, ver_sealer_front_2_temp, ver_sealer_front_3_temp, ver_sealer_front_4_temp,
-            ver_sealer_front_5_temp, ver_sealer_front_6_temp, ver_sealer_front_7_temp, ver_sealer_front_8_temp,
-            ver_sealer_front_9_temp, ver_sealer_front_10_temp, ver_sealer_front_11_temp, ver_sealer_front_12_temp,
-            ver_sealer_front_13_temp, ver_sealer_rear_1_temp, ver_sealer_rear_2_temp, ver_sealer_rear_3_temp,
-            ver_sealer_rear_4_temp, ver_sealer_rear_5_temp, ver_sealer_rear_6_temp, ver_sealer_rear_7_temp,
-            ver_sealer_rear_8_temp, ver_sealer_rear_9_temp, ver_sealer_rear_10_temp, ver_sealer_rear_11_temp,
-            ver_sealer_rear_12_temp, ver_sealer_rear_13_temp, hor_sealer_rear_1_temp, hor_sealer_front_1_temp,
-            hor_sealer_rear_2_temp, hor_sealer_rear_3_temp, hor_sealer_rear_4_temp, hor_sealer_rear_5_temp,
-            hor_sealer_rear_6_temp, hor_sealer_rear_7_temp, hor_sealer_rear_8_temp, hor_sealer_rear_9_temp,
-            hopper_1_level, hopper_2_level, piston_stroke_length, hor_sealer_current, ver_sealer_current,
-            rot_valve_1_current, fill_piston_1_current, fill_piston_2_current, rot_valve_2_current, web_puller_current,
-            hor_sealer_position, ver_sealer_position, rot_valve_1_position, fill_piston_1_position, fill_piston_2_position,
-            rot_valve_2_position, web_puller_position, sachet_count, cld_count, status, status_code, cam_position,
-            pulling_servo_current, pulling_servo_position, hor_pressure, ver_pressure, eye_mark_count, spare1)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                    %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                    %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-        """
+        self.high_speed_columns = [
+            '"timestamp"', 'ver_sealer_front_1_temp', 'ver_sealer_front_2_temp', 'ver_sealer_front_3_temp',
+            'ver_sealer_front_4_temp', 'ver_sealer_front_5_temp', 'ver_sealer_front_6_temp',
+            'ver_sealer_front_7_temp', 'ver_sealer_front_8_temp', 'ver_sealer_front_9_temp',
+            'ver_sealer_front_10_temp', 'ver_sealer_front_11_temp', 'ver_sealer_front_12_temp',
+            'ver_sealer_front_13_temp', 'ver_sealer_rear_1_temp', 'ver_sealer_rear_2_temp', 'ver_sealer_rear_3_temp',
+            'ver_sealer_rear_4_temp', 'ver_sealer_rear_5_temp', 'ver_sealer_rear_6_temp', 'ver_sealer_rear_7_temp',
+            'ver_sealer_rear_8_temp', 'ver_sealer_rear_9_temp', 'ver_sealer_rear_10_temp', 'ver_sealer_rear_11_temp',
+            'ver_sealer_rear_12_temp', 'ver_sealer_rear_13_temp', 'hor_sealer_rear_1_temp',
+            'hor_sealer_front_1_temp', 'hor_sealer_rear_2_temp', 'hor_sealer_rear_3_temp', 'hor_sealer_rear_4_temp',
+            'hor_sealer_rear_5_temp', 'hor_sealer_rear_6_temp', 'hor_sealer_rear_7_temp', 'hor_sealer_rear_8_temp',
+            'hor_sealer_rear_9_temp', 'hopper_1_level', 'hopper_2_level', 'piston_stroke_length',
+            'hor_sealer_current', 'ver_sealer_current', 'rot_valve_1_current', 'fill_piston_1_current',
+            'fill_piston_2_current', 'rot_valve_2_current', 'web_puller_current', 'hor_sealer_position',
+            'ver_sealer_position', 'rot_valve_1_position', 'fill_piston_1_position', 'fill_piston_2_position',
+            'rot_valve_2_position', 'web_puller_position', 'sachet_count', 'cld_count', 'status', 'status_code',
+            'cam_position', 'pulling_servo_current', 'pulling_servo_position', 'hor_pressure', 'ver_pressure',
+            'eye_mark_count', 'spare1'
+        ]
+        self.high_speed_writer = CopyWriter('mc18', self.high_speed_columns, max_rows=100, max_latency=1.0)
         self.db_settings = {
             'host': '192.168.1.149',
             'database': 'hul',
@@ -47,43 +59,65 @@ class CycleTracker:
 
         # Application state
         self.plc = None
+        self.stopping = threading.Event()
         self.cycle_id = 1
         self.last_cam_position = None
         self.current_day = None
+        self.cycle_state = CycleStateStore('cycle_state_mc18.json')  # survives restarts
+        self.saved_cycle_id = None
         self.last_message_time = time.time()
         self.timeout = 30
+        self.sample_buffer = SampleRingBuffer(capacity=2000)  # ~60 s of 30 ms samples
+        self.db_batch_size = 200
+        self.scheduler = FixedRateScheduler(period=0.03, policy='skip', name='mc18')
+        self.last_overflow_count = 0
         self.producer = None
-        self.status_code_queue = []
-        self.queue_lock = threading.Lock()
+        self.status_code_queue = BoundedEventQueue(capacity=10000, policy='drop_oldest')
+        self.status_events = StatusEventTracker('mc18', heartbeat_interval=30)
+        self.kafka_reconnect = False
+        self.kafka_error = None
+
+        # Each dependency reconnects on its own, with backoff
+        self.supervisor = Supervisor()
+        self.plc_health = self.supervisor.component('plc')
+        self.db_health = self.supervisor.component('db')
+        self.kafka_health = self.supervisor.component('kafka')
+        self.last_health_summary = None
+        self.writers = (self.high_speed_writer,)
+        self.rows_summary_interval = 300
+        self.last_rows_summary = time.monotonic()
+        self.last_rows_written = {}
+        self.metrics_port = 9118
+        self.read_latency = metrics.PLC_READ_SECONDS.labels('mc18')
+        self.read_errors = metrics.PLC_READ_ERRORS.labels('mc18')
+        metrics.QUEUE_DEPTH.labels('samples').set_function(lambda: self.sample_buffer.size)
+        metrics.QUEUE_DROPPED.labels('samples').set_function(lambda: self.sample_buffer.overflow_count)
+        metrics.QUEUE_DEPTH.labels('kafka').set_function(lambda: len(self.status_code_queue.items))
+        metrics.QUEUE_DROPPED.labels('kafka').set_function(lambda: self.status_code_queue.dropped)
 
         # Initialize connections
         self.connect_all()
 
     def connect_all(self):
-        """Establish all required connections with continuous retry"""
-        while True:
-            try:
-                self.connect_plc()
-                self.connect_db()
-                self.connect_kafka()
-                return  # All connections successful
-            except Exception as e:
-                print(f"Connection error: {e}. Retrying all connections in 5 seconds...")
-                time.sleep(5)
+        """Establish all required connections; each one retries on its own"""
+        self.connect_plc()
+        self.connect_db()
+        self.connect_kafka()
 
     def connect_db(self):
-        """Connect to PostgreSQL database with continuous retry"""
-        while True:
+        """Connect to PostgreSQL database with continuous retry until shutdown"""
+        while not self.stopping.is_set():
             try:
                 self.close_db_connection()  # Clean up any existing connection
                 self.conn = psycopg2.connect(**self.db_settings)
                 self.conn.autocommit = False
                 self.cursor = self.conn.cursor()
-                #print("Successfully connected to PostgreSQL database")
+                self.db_health.healthy()
+                logger.info("Successfully connected to PostgreSQL database")
                 return
             except Exception as e:
-                print(f"Database connection error: {e}. Retrying in 5 seconds...")
-                time.sleep(5)
+                logger.error(f"Database connection error: {e}")
+                self.db_health.failed(e)
 
     def close_db_connection(self):
         """Safely close database connection"""
@@ -91,28 +125,30 @@ class CycleTracker:
             if hasattr(self, 'cursor') and self.cursor:
                 self.cursor.close()
         except Exception as e:
-            print(f"Error closing cursor: {e}")
+            logger.error(f"Error closing cursor: {e}")
         try:
             if hasattr(self, 'conn') and self.conn:
                 self.conn.close()
         except Exception as e:
-            print(f"Error closing connection: {e}")
+            logger.error(f"Error closing connection: {e}")
         self.cursor = None
         self.conn = None
 
     def connect_plc(self):
-        """Connect to the PLC using LogixDriver with continuous retry"""
-        while True:
+        """Connect to the PLC using LogixDriver with continuous retry until shutdown"""
+        while not self.stopping.is_set():
             try:
                 if self.plc:
                     self.plc.close()
                 self.plc = LogixDriver(self.plc_ip)
                 self.plc.open()
-                #print(f"Successfully connected to PLC at {self.plc_ip}")
+                metrics.PLC_CONNECTS.labels('mc18', 'ok').inc()
+                logger.info(f"Successfully connected to PLC at {self.plc_ip}")
                 return
             except Exception as e:
-                print(f"Failed to connect to PLC at {self.plc_ip}: {e}. Retrying in 5 seconds...")
-                time.sleep(5)
+                logger.error(f"Failed to connect to PLC at {self.plc_ip}: {e}")
+                metrics.PLC_CONNECTS.labels('mc18', 'error').inc()
+                self.plc_health.failed(e)
 
     def connect_kafka(self):
         """Connect to Kafka with continuous retry"""
@@ -125,200 +161,288 @@ class CycleTracker:
                     value_serializer=lambda v: json.dumps(v).encode('utf-8'),
                     retries=5
                 )
-                #print(f"Successfully connected to Kafka at {self.kafka_bootstrap_servers}")
+                logger.info(f"Successfully connected to Kafka at {self.kafka_bootstrap_servers}")
                 return
             except Exception as e:
-                print(f"Failed to connect to Kafka: {e}. Retrying in 5 seconds...")
-                time.sleep(5)
+                logger.error(f"Failed to connect to Kafka: {e}")
+                self.kafka_health.failed(e)
 
     def reconnect(self):
-        """Reconnect to all services"""
-        print("Attempting to reconnect to all services...")
-        self.connect_all()
+        """Reconnect the PLC session only; the database and Kafka recover on their own errors"""
+        self.plc_health.degraded(f"no data for {self.timeout} s")
+        self.connect_plc()
         self.last_message_time = time.time()
 
     def check_data_flow(self):
         """Check if data is received within the timeout period."""
         while True:
             if time.time() - self.last_message_time > self.timeout:
-                print(f"No data received for {self.timeout} seconds. Reconnecting...")
+                logger.warning(f"No data received for {self.timeout} seconds. Reconnecting...")
                 self.reconnect()
+            buffer_stats = self.sample_buffer.stats()
+            if buffer_stats['overflow_count'] != self.last_overflow_count:
+                logger.warning(f"Sample buffer overflow: {buffer_stats}")
+                self.last_overflow_count = buffer_stats['overflow_count']
+            summary = self.supervisor.summary()
+            if summary != self.last_health_summary:
+                logger.info(f"Health: {summary}")
+                self.last_health_summary = summary
+            if time.monotonic() - self.last_rows_summary >= self.rows_summary_interval:
+                self.log_rows_summary()
             time.sleep(5)
 
+    def log_rows_summary(self):
+        """One line with the rows written since the last summary, instead of a line per insert"""
+        written = {writer.table: writer.rows_written for writer in self.writers}
+        counts = ', '.join(f"{table} {rows - self.last_rows_written.get(table, 0)}" for table, rows in written.items())
+        logger.info(f"Rows written in the last {self.rows_summary_interval} s: {counts}")
+        self.last_rows_written = written
+        self.last_rows_summary = time.monotonic()
+
+    def flush_writers(self):
+        """Buffer the samples left in the ring buffer and write all buffered rows before shutdown"""
+        for data in self.sample_buffer.get_batch(self.sample_buffer.capacity, timeout=0):
+            try:
+                self.buffer_sample(data)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.error(f"Error processing data: {e}")
+        try:
+            if self.conn is not None and self.conn.closed == 0:
+                self.high_speed_writer.flush(self.conn)
+        except Exception as e:
+            logger.error(f"Error flushing buffered rows: {e}")
+
     def ensure_db_connection(self):
         """Ensure we have a valid database connection"""
         try:
             if self.conn is None or self.conn.closed != 0 or self.cursor is None or self.cursor.closed:
-                print("Database connection lost. Reconnecting...")
+                logger.warning("Database connection lost. Reconnecting...")
                 self.connect_db()
             return True
         except Exception as e:
-            print(f"Error checking database connection: {e}")
+            logger.error(f"Error checking database connection: {e}")
             return False
 
     def ensure_kafka_connection(self):
         """Ensure we have a valid Kafka connection"""
         try:
             if self.producer is None:
-                print("Kafka connection lost. Reconnecting...")
+                logger.warning("Kafka connection lost. Reconnecting...")
                 self.connect_kafka()
             return True
         except Exception as e:
-            print(f"Error checking Kafka connection: {e}")
+            logger.error(f"Error checking Kafka connection: {e}")
             return False
 
     def read_plc_data(self):
         """Read data from PLC and add status code to queue if available"""
-        while True:
+        while not self.stopping.is_set():
             try:
                 if not self.plc or not self.plc.connected:
-                    print("PLC not connected, reconnecting...")
+                    logger.warning("PLC not connected, reconnecting...")
                     self.connect_plc()
                 
+                started = time.perf_counter()
                 tag_value = self.plc.read("MC18")
+                self.read_latency.observe(time.perf_counter() - started)
                 if not tag_value:
-                    print("No data read from PLC. Retrying.")
+                    self.read_errors.inc()
+                    logger.warning("No data read from PLC. Retrying.")
                     time.sleep(1)
                     continue
                 
                 data = tag_value.value
                 self.last_message_time = time.time()
-
-                # Add status code to queue for Kafka producer
-                if 'MC_Status_Code' in data:
-                    with self.queue_lock:
-                        self.status_code_queue.append(data['MC_Status_Code'])
+                self.plc_health.healthy()
 
                 return data
 
             except Exception as e:
-                print(f"Error reading from PLC: {e}. Attempting to reconnect.")
+                logger.error(f"Error reading from PLC: {e}. Attempting to reconnect.")
+                self.read_errors.inc()
+                self.plc_health.failed(e)
                 self.connect_plc()
-                time.sleep(1)
 
-    def process_data_to_db(self):
-        """Process data and insert into PostgreSQL"""
-        while True:
+    def acquire_plc_data(self):
+        """Poll the PLC on fixed 30 ms deadlines and push samples into the ring buffer"""
+        while not self.stopping.is_set():
+            self.scheduler.wait()
             data = self.read_plc_data()
+            if data is not None:
+                self.sample_buffer.put(data)
+
+    def resume_cycle_id(self, day):
+        """Continue today's cycle numbering after a restart instead of starting again at 1"""
+        cycle_id = self.cycle_state.resume('mc18', day)
+        if cycle_id is not None:
+            return cycle_id
+        try:
+            self.ensure_db_connection()
+            cycle_id = max_cycle_id(self.cursor, 'mc18', day) + 1
+            self.conn.rollback()
+            return cycle_id
+        except Exception as e:
+            logger.error(f"Could not look up today's last cycle: {e}. Starting at cycle 1")
+            return 1
+
+    def buffer_sample(self, data):
+        """Track the cycle for one sample and buffer its rows for the COPY writers"""
+        timestamp = datetime.datetime(
+            data['Year'], data['Month'], data['Day'],
+            data['Hour'], data['Min'], data['Sec'],
+            data['Microsecond']
+        )
+        
+        current_day = timestamp.date()
+        if self.current_day is None:
+            self.current_day = current_day
+            self.cycle_id = self.resume_cycle_id(current_day)
+        elif current_day != self.current_day:
+            self.cycle_id = 1
+            self.current_day = current_day
+
+        current_cam_position = data['MC_Cam_Position']
+        if self.last_cam_position is not None:
+            position_diff = abs(current_cam_position - self.last_cam_position)
+            if position_diff > 280:
+                self.cycle_id += 1
+        self.last_cam_position = current_cam_position
+        if self.cycle_id != self.saved_cycle_id:
+            self.cycle_state.update('mc18', current_day, self.cycle_id)
+            self.saved_cycle_id = self.cycle_id
+
+        # Buffer the row; the writer flushes with COPY on size or latency threshold
+        self.high_speed_writer.add((
+            timestamp,
+            data['MC_Ver_Sealer_Front_1_Temp'], data['MC_Ver_Sealer_Front_2_Temp'],
+            data['MC_Ver_Sealer_Front_3_Temp'], data['MC_Ver_Sealer_Front_4_Temp'],
+            data['MC_Ver_Sealer_Front_5_Temp'], data['MC_Ver_Sealer_Front_6_Temp'],
+            data['MC_Ver_Sealer_Front_7_Temp'], data['MC_Ver_Sealer_Front_8_Temp'],
+            data['MC_Ver_Sealer_Front_9_Temp'], data['MC_Ver_Sealer_Front_10_Temp'],
+            data['MC_Ver_Sealer_Front_11_Temp'], data['MC_Ver_Sealer_Front_12_Temp'],
+            data['MC_Ver_Sealer_Front_13_Temp'], data['MC_Ver_Sealer_Rear_1_Temp'],
+            data['MC_Ver_Sealer_Rear_2_Temp'], data['MC_Ver_Sealer_Rear_3_Temp'],
+            data['MC_Ver_Sealer_Rear_4_Temp'], data['MC_Ver_Sealer_Rear_5_Temp'],
+            data['MC_Ver_Sealer_Rear_6_Temp'], data['MC_Ver_Sealer_Rear_7_Temp'],
+            data['MC_Ver_Sealer_Rear_8_Temp'], data['MC_Ver_Sealer_Rear_9_Temp'],
+            data['MC_Ver_Sealer_Rear_10_Temp'], data['MC_Ver_Sealer_Rear_11_Temp'],
+            data['MC_Ver_Sealer_Rear_12_Temp'], data['MC_Ver_Sealer_Rear_13_Temp'],
+            data['MC_Hor_Sealer_Rear_1_Temp'], data['MC_Hor_Sealer_Front_1_Temp'],
+            data['MC_Hor_Sealer_Rear_2_Temp'], data['MC_Hor_Sealer_Rear_3_Temp'],
+            data['MC_Hor_Sealer_Rear_4_Temp'], data['MC_Hor_Sealer_Rear_5_Temp'],
+            data['MC_Hor_Sealer_Rear_6_Temp'], data['MC_Hor_Sealer_Rear_7_Temp'],
+            data['MC_Hor_Sealer_Rear_8_Temp'], data['MC_Hor_Sealer_Rear_9_Temp'],
+            data['MC_Hopper_1_Level'], data['MC_Hopper_2_Level'],
+            data['MC_Piston_Stroke_Length'], data['MC_Hor_Sealer_Current'],
+            data['MC_Ver_Sealer_Current'], data['MC_Rot_Valve_1_Current'],
+            data['MC_Fill_Piston_1_Current'], data['MC_Fill_Piston_2_Current'],
+            data['MC_Rot_Valve_2_Current'], data['MC_Web_Puller_Current'],
+            data['MC_Hor_Sealer_Position'], data['MC_Ver_Sealer_Position'],
+            data['MC_Rot_Valve_1_Position'], data['MC_Fill_Piston_1_Position'],
+            data['MC_Fill_Piston_2_Position'], data['MC_Rot_Valve_2_Position'],
+            data['MC_Web_Puller_Position'], data['MC_Sachet_Count'],
+            data['MC_CLD_Count'], data['MC_Status'], data['MC_Status_Code'],
+            data['MC_Cam_Position'], data['MC_Pulling_Servo_Current'],
+            data['MC_Pulling_Servo_Position'], data['MC_Hor_Pressure'],
+            data['MC_Ver_Pressure'], data['MC_Eye_Mark_Count'],
+            self.cycle_id
+        ))
+
+        # Status changes and heartbeats for Kafka, not one message per poll
+        event = self.status_events.update(data['MC_Status_Code'], timestamp, self.cycle_id, timestamp.timestamp())
+        if event:
+            self.status_code_queue.put(event)
+
+    def process_data_to_db(self):
+        """Drain the ring buffer and write samples to PostgreSQL"""
+        while not self.stopping.is_set():
+            samples = self.sample_buffer.get_batch(self.db_batch_size, timeout=0.5)
 
             try:
+                for data in samples:
+                    try:
+                        self.buffer_sample(data)
+                    except (KeyError, TypeError, ValueError) as e:
+                        logger.error(f"Error processing data: {e}")
+
                 if not self.ensure_db_connection():
-                    print("Failed to establish database connection. Will retry.")
+                    logger.warning("Failed to establish database connection. Will retry.")
                     time.sleep(1)
                     continue
 
-                timestamp = datetime.datetime(
-                    data['Year'], data['Month'], data['Day'],
-                    data['Hour'], data['Min'], data['Sec'],
-                    data['Microsecond']
-                )
-                
-                current_day = timestamp.date()
-                if self.current_day is None:
-                    self.current_day = current_day
-                elif current_day != self.current_day:
-                    self.cycle_id = 1
-                    self.current_day = current_day
-
-                current_cam_position = data['MC_Cam_Position']
-                if self.last_cam_position is not None:
-                    position_diff = abs(current_cam_position - self.last_cam_position)
-                    if position_diff > 280:
-                        self.cycle_id += 1
-                self.last_cam_position = current_cam_position
-
-                # Execute with new cursor each time to avoid "cursor already closed" errors
-                with self.conn.cursor() as cursor:
-                    cursor.execute(self.insert_query, (
-                        str(timestamp),
-                        data['MC_Ver_Sealer_Front_1_Temp'], data['MC_Ver_Sealer_Front_2_Temp'],
-                        data['MC_Ver_Sealer_Front_3_Temp'], data['MC_Ver_Sealer_Front_4_Temp'],
-                        data['MC_Ver_Sealer_Front_5_Temp'], data['MC_Ver_Sealer_Front_6_Temp'],
-                        data['MC_Ver_Sealer_Front_7_Temp'], data['MC_Ver_Sealer_Front_8_Temp'],
-                        data['MC_Ver_Sealer_Front_9_Temp'], data['MC_Ver_Sealer_Front_10_Temp'],
-                        data['MC_Ver_Sealer_Front_11_Temp'], data['MC_Ver_Sealer_Front_12_Temp'],
-                        data['MC_Ver_Sealer_Front_13_Temp'], data['MC_Ver_Sealer_Rear_1_Temp'],
-                        data['MC_Ver_Sealer_Rear_2_Temp'], data['MC_Ver_Sealer_Rear_3_Temp'],
-                        data['MC_Ver_Sealer_Rear_4_Temp'], data['MC_Ver_Sealer_Rear_5_Temp'],
-                        data['MC_Ver_Sealer_Rear_6_Temp'], data['MC_Ver_Sealer_Rear_7_Temp'],
-                        data['MC_Ver_Sealer_Rear_8_Temp'], data['MC_Ver_Sealer_Rear_9_Temp'],
-                        data['MC_Ver_Sealer_Rear_10_Temp'], data['MC_Ver_Sealer_Rear_11_Temp'],
-                        data['MC_Ver_Sealer_Rear_12_Temp'], data['MC_Ver_Sealer_Rear_13_Temp'],
-                        data['MC_Hor_Sealer_Rear_1_Temp'], data['MC_Hor_Sealer_Front_1_Temp'],
-                        data['MC_Hor_Sealer_Rear_2_Temp'], data['MC_Hor_Sealer_Rear_3_Temp'],
-                        data['MC_Hor_Sealer_Rear_4_Temp'], data['MC_Hor_Sealer_Rear_5_Temp'],
-                        data['MC_Hor_Sealer_Rear_6_Temp'], data['MC_Hor_Sealer_Rear_7_Temp'],
-                        data['MC_Hor_Sealer_Rear_8_Temp'], data['MC_Hor_Sealer_Rear_9_Temp'],
-                        data['MC_Hopper_1_Level'], data['MC_Hopper_2_Level'],
-                        data['MC_Piston_Stroke_Length'], data['MC_Hor_Sealer_Current'],
-                        data['MC_Ver_Sealer_Current'], data['MC_Rot_Valve_1_Current'],
-                        data['MC_Fill_Piston_1_Current'], data['MC_Fill_Piston_2_Current'],
-                        data['MC_Rot_Valve_2_Current'], data['MC_Web_Puller_Current'],
-                        data['MC_Hor_Sealer_Position'], data['MC_Ver_Sealer_Position'],
-                        data['MC_Rot_Valve_1_Position'], data['MC_Fill_Piston_1_Position'],
-                        data['MC_Fill_Piston_2_Position'], data['MC_Rot_Valve_2_Position'],
-                        data['MC_Web_Puller_Position'], data['MC_Sachet_Count'],
-                        data['MC_CLD_Count'], data['MC_Status'], data['MC_Status_Code'],
-                        data['MC_Cam_Position'], data['MC_Pulling_Servo_Current'],
-                        data['MC_Pulling_Servo_Position'], data['MC_Hor_Pressure'],
-                        data['MC_Ver_Pressure'], data['MC_Eye_Mark_Count'],
-                        self.cycle_id
-                    ))
-                    self.conn.commit()
-                    #print("Data inserted sucessfully:",data)
+                self.high_speed_writer.flush_if_due(self.conn)
 
             except psycopg2.InterfaceError as e:
-                print(f"Database interface error: {e}. Will reconnect.")
+                logger.error(f"Database interface error: {e}. Will reconnect.")
                 self.close_db_connection()
-                time.sleep(1)
+                self.db_health.failed(e)
             except psycopg2.OperationalError as e:
-                print(f"Database operational error: {e}. Will reconnect.")
+                logger.error(f"Database operational error: {e}. Will reconnect.")
                 self.close_db_connection()
-                time.sleep(5)
+                self.db_health.failed(e)
             except Exception as e:
-                print(f"Error processing data: {e}")
-                #print(f"Data dump for debugging: {data}")
-            
-            time.sleep(0.03)
+                logger.error(f"Error processing data: {e}")
 
     def produce_kafka_messages(self):
         while True:
             try:
+                if self.kafka_reconnect:
+                    self.kafka_reconnect = False
+                    self.kafka_health.failed(self.kafka_error)
+                    self.connect_kafka()
                 if not self.ensure_kafka_connection():
                     continue
-                message = None
-                with self.queue_lock:
-                    if self.status_code_queue:
-                        message = {"mc18": self.status_code_queue.pop(0)}
-                if message:
+                # Blocks until status events arrive; no busy-waiting
+                batch = self.status_code_queue.get_batch(100, timeout=1.0)
+                for entry in batch:
+                    message = entry[1]  # has the old {"mc18": code} field too
                     try:
                         self.producer.send(
-                            self.kafka_topic, 
+                            self.kafka_topic,
                             value=message,
-                        ).add_errback(lambda e: self._handle_kafka_error(e, message))
+                        ).add_callback(self._handle_kafka_sent, entry).add_errback(self._handle_kafka_error, entry)
+                        metrics.KAFKA_SENT.inc()
                     except Exception as e:
-                        self._handle_kafka_error(e, message)
-                else:
-                    time.sleep(0.001)  # Minimal sleep
-
+                        self._handle_kafka_error(e, entry)
             except Exception as e:
-                print(f"Unexpected error: {e}")
+                logger.error(f"Unexpected error in Kafka producer: {e}")
                 time.sleep(1)
 
-    def _handle_kafka_error(self, error, message):
-        with self.queue_lock:
-            self.status_code_queue.insert(0, message['mc18'])
-            print(f"Message failed: {error}")
-            self.connect_kafka()  
+    def _handle_kafka_sent(self, metadata, entry):
+        metrics.KAFKA_ACKED.inc()
+        self.kafka_health.healthy()
+        self.status_code_queue.mark_sent(entry[0])
+
+    def _handle_kafka_error(self, error, entry):
+        # Back to the head of the bounded queue; the producer thread reconnects
+        self.status_code_queue.mark_failed()
+        metrics.KAFKA_FAILED.inc()
+        self.status_code_queue.requeue([entry])
+        self.kafka_error = error
+        if not self.kafka_reconnect:
+            logger.error(f"Kafka message failed: {error}")
+            self.kafka_reconnect = True
 
+    @staticmethod
+    def join(threads):
+        """Wait for threads to finish, logging the ones that take long; no thread is abandoned"""
+        for thread in threads:
+            while True:
+                thread.join(timeout=5)
+                if not thread.is_alive():
+                    break
+                logger.warning(f"Shutdown: still waiting for {thread.name}")
 
     def start(self):
         # Start all threads
         threads = [
-            threading.Thread(target=self.process_data_to_db, daemon=True),
-            threading.Thread(target=self.produce_kafka_messages, daemon=True),
-            threading.Thread(target=self.check_data_flow, daemon=True)
+            threading.Thread(target=self.acquire_plc_data, daemon=True, name="PlcAcquisitionThread"),
+            threading.Thread(target=self.process_data_to_db, daemon=True, name="ProcessDataThread"),
+            threading.Thread(target=self.produce_kafka_messages, daemon=True, name="KafkaProducerThread"),
+            threading.Thread(target=self.check_data_flow, daemon=True, name="DataFlowThread")
         ]
+        self.cycle_state.start()
+        metrics.start_http_server(self.metrics_port)
         
         for thread in threads:
             thread.start()
@@ -328,7 +452,12 @@ class CycleTracker:
             while True:
                 time.sleep(1)
         except KeyboardInterrupt:
-            print("Shutting down...")
+            logger.info("Shutting down...")
+            self.stopping.set()
+            # Acquisition first, then the DB thread, so flush_writers is the only user of self.conn
+            self.join(threads[:2])
+            self.flush_writers()
+            self.cycle_state.close()
             self.close_db_connection()
             if self.plc:
                 self.plc.close()
@@ -337,5 +466,7 @@ class CycleTracker:
             sys.exit(0)
 
 if __name__ == '__main__':
+    # Rotated, compressed and rate-limited instead of stdout redirected to /var/log/plc_reader.log
+    async_log.setup_logging({'file': '/var/log/plc_reader_18.log'})
     tracker = CycleTracker()
     tracker.start()
@@ -0,0 +1,196 @@
+"""Replay a capture file through the ingest daemon's cycle tracking offline.
+
+Samples recorded by the daemon (see capture.py) go through the same
+MachineIngest path as live polls: status events, cycle_id tracking, high- and
+low-speed rows, aggregate windows, cycle features and compression. The
+machine profile is the one in machines.json named in the capture, so a change
+to the analytics or its configuration can be checked against a real
+production trace, and the same capture always produces the same rows.
+
+Speed is 1 (real time, paced by the recorded receive times), any factor such
+as 10, or max. By default rows go to an in-process sink and only counts are
+reported; with 'postgres' they are written to replay_<table> copies of the
+machine tables in the machines.json database, emptied first.
+
+Usage: python3 replay_capture.py capture.cap [speed] [sink|postgres] [machines.json]
+       python3 replay_capture.py captures/mc17-20250614-080000.cap max
+"""
+import copy
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from bench_ingest import SinkPool
+from capture import CaptureReader
+
+logger = logging.getLogger(__name__)
+
+TABLE_SECTIONS = ('low_speed_aggregate', 'cycle_features', 'low_speed_compression')
+
+
+def replay_config(config_path, machine_name, work_dir, postgres):
+    """machines.json reduced to the captured machine, with state files in work_dir"""
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(config_path))
+    profiles = [machine for machine in config['machines'] if machine['name'] == machine_name]
+    if not profiles:
+        raise SystemExit(f"No machine {machine_name!r} in {config_path}")
+    machine = copy.deepcopy(profiles[0])
+    machine.update({
+        'enabled': True,
+        'high_speed_tags': os.path.join(base_dir, machine['high_speed_tags']),
+        'low_speed_tags': os.path.join(base_dir, machine['low_speed_tags']),
+        'capture': {'enabled': False},
+        'shared_ring': {'enabled': False},
+        'rate_tags': {'enabled': False},
+    })
+    machine.pop('simulate', None)
+    if postgres:
+        machine['high_speed_table'] = f"replay_{machine['high_speed_table']}"
+        machine['low_speed_table'] = f"replay_{machine['low_speed_table']}"
+        for section in TABLE_SECTIONS:
+            if section in machine and 'table' in machine[section]:
+                machine[section]['table'] = f"replay_{machine[section]['table']}"
+        tables = machine.get('rollups', {}).get('tables', {})
+        for label, table in tables.items():
+            tables[label] = f"replay_{table}"
+    config['machines'] = [machine]
+    config['spool'] = dict(config.get('spool', {}), directory=os.path.join(work_dir, 'spool'))
+    config['cycle_state'] = {'path': os.path.join(work_dir, 'cycle_state.json')}
+    config['kafka'] = dict(config['kafka'], outbox=dict(config['kafka'].get('outbox', {}),
+                                                         directory=os.path.join(work_dir, 'kafka')))
+    config.pop('metrics', None)
+    path = os.path.join(work_dir, 'machines.json')
+    with open(path, 'w') as f:
+        json.dump(config, f)
+    return path
+
+
+def prepare_tables(daemon, machine):
+    """Create replay_<table> like the production tables and empty them"""
+    conn = daemon.db_pool.getconn()
+    with conn.cursor() as cursor:
+        for writer in machine.writers:
+            source = writer.table[len('replay_'):]
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {writer.table} (LIKE {source} INCLUDING DEFAULTS)")
+            cursor.execute(f"TRUNCATE {writer.table}")
+    conn.commit()
+    daemon.db_pool.putconn(conn)
+
+
+def sample_mapper(capture_names, layout):
+    """Reorders captured samples into the current layout, which may have gained or lost tags"""
+    if list(capture_names) == layout.names:
+        return lambda sample: sample
+    positions = {name: i for i, name in enumerate(capture_names)}
+    missing = [name for name in layout.names if name not in positions]
+    if missing:
+        raise SystemExit(f"Capture lacks members the current profile needs: {', '.join(missing)}")
+    indices = [positions[name] for name in layout.names]
+    return lambda sample: tuple([sample[i] for i in indices])
+
+
+def replay(capture_path, speed=None, mode='sink', config_path='machines.json'):
+    """Feed a capture through MachineIngest; speed None replays as fast as possible"""
+    import ingest_daemon
+
+    postgres = mode == 'postgres'
+    events = []
+    with CaptureReader(capture_path) as reader, tempfile.TemporaryDirectory() as work_dir:
+        machine_name = reader.metadata['machine']
+        daemon = ingest_daemon.IngestDaemon(replay_config(config_path, machine_name, work_dir, postgres))
+        machine = daemon.machines[0]
+        if postgres:
+            prepare_tables(daemon, machine)
+        else:
+            daemon.db_pool = SinkPool({writer.table: [column.strip('"') for column in writer.columns]
+                                       for writer in machine.writers})
+        daemon.enqueue_status_event = lambda machine, event: events.append(event)
+        to_layout = sample_mapper(reader.names, machine.layout)
+
+        samples = 0
+        processing = 0.0
+        first_received = last_received = None
+        started = time.monotonic()
+        for received, sample in reader:
+            if first_received is None:
+                first_received = received
+            last_received = received
+            if speed:
+                delay = started + (received - first_received) / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            begin = time.perf_counter()
+            sample = to_layout(sample)
+            machine.buffer_sample(sample)
+            daemon.flush_machine(machine)
+            processing += time.perf_counter() - begin
+            samples += 1
+        machine.close_windows()
+        daemon.flush_machine(machine, force=True)
+        elapsed = time.monotonic() - started
+        daemon.cycle_state.close()
+        daemon.kafka_outbox.close()
+        daemon.spool.close()
+        truncated = reader.truncated
+
+    span = (last_received - first_received) if samples else 0.0
+    return {
+        'machine': machine_name,
+        'samples': samples,
+        'capture_seconds': span,
+        'replay_seconds': elapsed,
+        'speed': span / elapsed if elapsed else None,
+        'us_per_sample': processing / samples * 1000000 if samples else None,
+        'truncated': truncated,
+        'last_cycle_id': machine.cycle_id,
+        'cycles_emitted': machine.cycle_extractor.cycles_emitted if machine.cycle_extractor else None,
+        'status_changes': sum(1 for event in events if event['event'] == 'change'),
+        'heartbeats': sum(1 for event in events if event['event'] == 'heartbeat'),
+        'rows': {writer.table: writer.rows_written for writer in machine.writers},
+    }
+
+
+def parse_speed(text):
+    """'max' -> None, '10' or '10x' -> 10.0"""
+    text = text.lower().rstrip('x')
+    if text == 'max':
+        return None
+    speed = float(text)
+    if speed <= 0:
+        raise ValueError("speed must be positive")
+    return speed
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__.strip().splitlines()[-2])
+        sys.exit(1)
+    try:
+        speed = parse_speed(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    except ValueError as e:
+        print(f"Invalid speed {sys.argv[2]!r}: {e}")
+        sys.exit(1)
+    mode = sys.argv[3] if len(sys.argv) > 3 else 'sink'
+    if mode not in ('sink', 'postgres'):
+        print(f"Unknown mode {mode!r}, expected sink or postgres")
+        sys.exit(1)
+    config_path = sys.argv[4] if len(sys.argv) > 4 else 'machines.json'
+
+    result = replay(sys.argv[1], speed, mode, config_path)
+    print(f"{result['machine']}: {result['samples']} samples, {result['capture_seconds']:.1f} s of capture "
+          f"replayed in {result['replay_seconds']:.1f} s ({result['speed'] or 0:.1f}x), "
+          f"{result['us_per_sample'] or 0:.0f} us/sample" + (", capture truncated" if result['truncated'] else ""))
+    print(f"cycles: last cycle_id {result['last_cycle_id']}, {result['cycles_emitted']} feature rows; "
+          f"status: {result['status_changes']} changes, {result['heartbeats']} heartbeats")
+    for table, rows in result['rows'].items():
+        print(f"  {table:<24} {rows:>9} rows")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    main()
@@ -0,0 +1,75 @@
+import threading
+
+
+class SampleRingBuffer:
+    """Bounded, preallocated ring buffer between the PLC reader and DB consumers.
+
+    put() never blocks: when the buffer is full the oldest sample is overwritten
+    and counted as an overflow, so PLC acquisition keeps its cadence no matter
+    how far behind the consumers are.
+    """
+
+    def __init__(self, capacity=2000):
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.head = 0  # next slot to read
+        self.size = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+
+        # Metrics
+        self.high_water = 0
+        self.overflow_count = 0
+        self.total_put = 0
+        self.total_get = 0
+
+    def put(self, sample):
+        """Append a sample, overwriting the oldest one if full. Returns False on overflow."""
+        with self.lock:
+            tail = (self.head + self.size) % self.capacity
+            self.slots[tail] = sample
+            self.total_put += 1
+            overflowed = self.size == self.capacity
+            if overflowed:
+                self.head = (self.head + 1) % self.capacity
+                self.overflow_count += 1
+            else:
+                self.size += 1
+                if self.size > self.high_water:
+                    self.high_water = self.size
+            self.not_empty.notify()
+            return not overflowed
+
+    def get_batch(self, max_items, timeout=None):
+        """Remove and return up to max_items samples in order.
+
+        Blocks until at least one sample is available or timeout expires,
+        in which case an empty list is returned.
+        """
+        with self.lock:
+            if not self.size:
+                self.not_empty.wait(timeout)
+            count = min(max_items, self.size)
+            batch = []
+            for _ in range(count):
+                batch.append(self.slots[self.head])
+                self.slots[self.head] = None
+                self.head = (self.head + 1) % self.capacity
+            self.size -= count
+            self.total_get += count
+            return batch
+
+    def __len__(self):
+        return self.size
+
+    def stats(self):
+        """Snapshot of buffer metrics"""
+        with self.lock:
+            return {
+                'depth': self.size,
+                'capacity': self.capacity,
+                'high_water': self.high_water,
+                'overflow_count': self.overflow_count,
+                'total_put': self.total_put,
+                'total_get': self.total_get,
+            }
@@ -0,0 +1,175 @@
+"""Continuous 1 s / 1 min / 1 h rollups of every high- and low-speed tag.
+
+The ingest daemon keeps one open bucket per resolution and updates it in
+place: every sample goes into the 1 s bucket, a closed 1 s bucket is merged
+into the 1 min bucket and a closed 1 min bucket into the 1 h bucket, so the
+coarser levels cost one update per second and per minute instead of one per
+sample. Each bucket is written as soon as the next one starts:
+
+    bucket start, sample_count, <tag>_min, <tag>_max, <tag>_mean, ...
+
+Buckets are aligned like the aggregate windows (00:00:00, 00:00:01, ...).
+A bucket cut by a restart is written once by each run, so readers merge the
+rows of a bucket (rollup_select_sql does); backfill_rollups.py builds the
+tables for days before rollups were enabled.
+
+Charts and reports over more than a few minutes read the rollup table that
+gives them enough points (rollup_for_range) instead of the raw table. Print the
+table definitions for a machine with:
+
+    python3 rollups.py high_speed.json low_speed.json mc17
+"""
+import json
+import operator
+import sys
+
+# (table suffix, seconds, PostgreSQL date_trunc unit), finest first
+RESOLUTIONS = (('1s', 1, 'second'), ('1m', 60, 'minute'), ('1h', 3600, 'hour'))
+ROLLUP_AGGREGATES = ('min', 'max', 'mean')
+
+
+def rollup_tags(high_speed_tags, low_speed_tags):
+    """The tags a machine rolls up: high-speed tags, then the low-speed tags not already among them"""
+    tags = []
+    for tag in list(high_speed_tags) + list(low_speed_tags):
+        if tag not in tags:
+            tags.append(tag)
+    return tags
+
+
+def rollup_tables(prefix):
+    """Default table per resolution, e.g. mc17 -> {'1s': 'mc17_1s', '1m': 'mc17_1m', '1h': 'mc17_1h'}"""
+    return {label: f"{prefix}_{label}" for label, _, _ in RESOLUTIONS}
+
+
+def rollup_columns(tags):
+    """Column names of a rollup table row"""
+    columns = ['"timestamp"', 'sample_count']
+    for tag in tags:
+        column = tag.lower().replace('mc_', '')
+        columns.extend(f'{column}_{aggregate}' for aggregate in ROLLUP_AGGREGATES)
+    return columns
+
+
+def rollup_table_ddl(table, tags):
+    columns = rollup_columns(tags)
+    lines = ['    "timestamp" timestamp NOT NULL', '    sample_count integer']
+    lines += [f'    {column} double precision' for column in columns[2:]]
+    return (f"CREATE TABLE {table} (\n" + ",\n".join(lines) + "\n);\n"
+            f'CREATE INDEX ON {table} ("timestamp");')
+
+
+def rollup_select_sql(table, tags, unit=None):
+    """SELECT for the buckets of a rollup table in ["timestamp" >= %s, < %s), one row per bucket.
+
+    Rows of the same bucket are merged (means weighted by sample_count). With
+    a date_trunc unit coarser than the table, buckets are merged up to it.
+    """
+    bucket = '"timestamp"' if unit is None else f"date_trunc('{unit}', \"timestamp\")"
+    select = [f'{bucket} AS "timestamp"', 'sum(sample_count) AS sample_count']
+    for tag in tags:
+        column = tag.lower().replace('mc_', '')
+        select += [f'min({column}_min) AS {column}_min', f'max({column}_max) AS {column}_max',
+                   f'sum({column}_mean * sample_count) / nullif(sum(sample_count), 0) AS {column}_mean']
+    return (f"SELECT {', '.join(select)} FROM {table} "
+            f'WHERE "timestamp" >= %s AND "timestamp" < %s GROUP BY 1 ORDER BY 1')
+
+
+def rollup_for_range(tables, start, end, max_points=2000):
+    """(label, table) of the finest resolution that covers start..end (datetimes) in at most max_points buckets"""
+    span = (end - start).total_seconds()
+    for label, seconds, _ in RESOLUTIONS:
+        if span / seconds <= max_points:
+            return label, tables[label]
+    label = RESOLUTIONS[-1][0]
+    return label, tables[label]
+
+
+class RollupAggregator:
+    """Incremental min/max/mean/count per tag over nested time buckets (1 s, 1 min, 1 h)"""
+
+    def __init__(self, tags, resolutions=(1, 60, 3600)):
+        self.tags = list(tags)
+        self.resolutions = list(resolutions)
+        levels = len(self.resolutions)
+        self.buckets = [None] * levels
+        self.counts = [0] * levels
+        self.mins = [None] * levels
+        self.maxs = [None] * levels
+        self.sums = [None] * levels
+        self.buckets_closed = [0] * levels
+
+    def add(self, t, values):
+        """Add one sample (t in seconds, values ordered like tags).
+
+        Returns the buckets this sample closed as (level, bucket start,
+        count, aggregates) tuples, finest first; usually none. aggregates
+        holds min, max and mean of every tag in turn.
+        """
+        bucket = int(t // self.resolutions[0])
+        if bucket == self.buckets[0]:
+            self.counts[0] += 1
+            self.mins[0] = list(map(min, self.mins[0], values))
+            self.maxs[0] = list(map(max, self.maxs[0], values))
+            self.sums[0] = list(map(operator.add, self.sums[0], values))
+            return ()
+        closed = []
+        if self.counts[0]:
+            self._close(0, closed)
+        self.buckets[0] = bucket
+        self.counts[0] = 1
+        self.mins[0] = list(values)
+        self.maxs[0] = list(values)
+        self.sums[0] = list(values)
+        return closed
+
+    def flush(self):
+        """Close every open bucket, e.g. on shutdown"""
+        closed = []
+        for level in range(len(self.resolutions)):
+            if self.counts[level]:
+                self._close(level, closed)
+        self.buckets = [None] * len(self.resolutions)
+        return closed
+
+    def _close(self, level, closed):
+        """Emit the open bucket of level and merge it into the next coarser one"""
+        count = self.counts[level]
+        mins, maxs, sums = self.mins[level], self.maxs[level], self.sums[level]
+        start = self.buckets[level] * self.resolutions[level]
+        aggregates = []
+        for low, high, total in zip(mins, maxs, sums):
+            aggregates.extend((low, high, total / count))
+        closed.append((level, start, count, tuple(aggregates)))
+        self.counts[level] = 0
+        self.buckets_closed[level] += 1
+
+        upper = level + 1
+        if upper == len(self.resolutions):
+            return
+        bucket = int(start // self.resolutions[upper])
+        if bucket == self.buckets[upper] and self.counts[upper]:
+            self.counts[upper] += count
+            self.mins[upper] = list(map(min, self.mins[upper], mins))
+            self.maxs[upper] = list(map(max, self.maxs[upper], maxs))
+            self.sums[upper] = list(map(operator.add, self.sums[upper], sums))
+            return
+        if self.counts[upper]:
+            self._close(upper, closed)
+        self.buckets[upper] = bucket
+        self.counts[upper] = count
+        self.mins[upper] = mins
+        self.maxs[upper] = maxs
+        self.sums[upper] = sums
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        print("Usage: python3 rollups.py <high_speed.json> <low_speed.json> <table prefix>")
+        sys.exit(1)
+    with open(sys.argv[1], 'r') as f:
+        high_speed_tags = json.load(f)['tags']
+    with open(sys.argv[2], 'r') as f:
+        low_speed_tags = json.load(f)['tags']
+    tags = rollup_tags(high_speed_tags, low_speed_tags)
+    print("\n\n".join(rollup_table_ddl(table, tags) for table in rollup_tables(sys.argv[3]).values()))
@@ -0,0 +1,135 @@
+import collections
+import logging
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds in milliseconds
+HISTOGRAM_BUCKETS_MS = (1, 2, 5, 10, 20, 25, 30, 35, 40, 50, 75, 100, 250, 500, 1000)
+
+OVERRUN_POLICIES = ('skip', 'catch_up')
+
+SAMPLE_PERIOD_SECONDS = metrics.histogram('ai4m_sample_period_seconds', 'Achieved loop period',
+                                          ['loop'], buckets=metrics.PERIOD_BUCKETS)
+SCHEDULER_OVERRUNS = metrics.counter('ai4m_scheduler_overruns_total', 'Iterations that missed their deadline', ['loop'])
+SCHEDULER_SKIPPED = metrics.counter('ai4m_scheduler_skipped_ticks_total', 'Deadlines skipped after overruns', ['loop'])
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _histogram(values_ms):
+    counts = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+    for value in values_ms:
+        for i, bound in enumerate(HISTOGRAM_BUCKETS_MS):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+    labels = [f"le_{bound}ms" for bound in HISTOGRAM_BUCKETS_MS] + ['inf']
+    return dict(zip(labels, counts))
+
+
+class FixedRateScheduler:
+    """Fixed-rate loop pacing on absolute monotonic deadlines.
+
+    Call wait() once per iteration. Deadlines are start + n * period, so read
+    and processing time do not add to the period and there is no drift.
+    When an iteration overruns its slot the overrun policy decides what happens:
+
+    skip      drop the missed ticks and resume on the next future deadline
+    catch_up  run the missed ticks back to back while at most max_catch_up
+              periods behind, otherwise skip like above
+    """
+
+    def __init__(self, period=0.03, policy='skip', max_catch_up=10, window=2000, name='',
+                 log_interval=60):
+        if policy not in OVERRUN_POLICIES:
+            raise ValueError(f"Unknown overrun policy {policy!r}, expected one of {OVERRUN_POLICIES}")
+        self.period = period
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.name = name
+        self.log_interval = log_interval
+
+        self.next_deadline = None
+        self.last_tick = None
+        self.last_log = time.monotonic()
+
+        # Rolling windows of achieved period and wake-up jitter, in milliseconds
+        self.periods = collections.deque(maxlen=window)
+        self.jitters = collections.deque(maxlen=window)
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped_ticks = 0
+        self.period_metric = SAMPLE_PERIOD_SECONDS.labels(name)
+        self.overrun_metric = SCHEDULER_OVERRUNS.labels(name)
+        self.skipped_metric = SCHEDULER_SKIPPED.labels(name)
+
+    def wait(self):
+        """Sleep until the next deadline and record the achieved period and jitter"""
+        now = time.monotonic()
+        if self.next_deadline is None:
+            self.next_deadline = now
+        else:
+            self.next_deadline += self.period
+            lag = now - self.next_deadline
+            if lag > 0:
+                self.overruns += 1
+                self.overrun_metric.inc()
+                if lag >= self.period and not (self.policy == 'catch_up' and lag <= self.max_catch_up * self.period):
+                    missed = int(lag // self.period)
+                    self.skipped_ticks += missed
+                    self.skipped_metric.inc(missed)
+                    self.next_deadline += missed * self.period
+
+        delay = self.next_deadline - now
+        if delay > 0:
+            time.sleep(delay)
+
+        tick = time.monotonic()
+        self.jitters.append(max(0.0, tick - self.next_deadline) * 1000.0)
+        if self.last_tick is not None:
+            self.periods.append((tick - self.last_tick) * 1000.0)
+            self.period_metric.observe(tick - self.last_tick)
+        self.last_tick = tick
+        self.ticks += 1
+
+        if self.log_interval and tick - self.last_log >= self.log_interval:
+            self.last_log = tick
+            logger.info(f"Scheduler {self.name}: {self.summary()}")
+
+    def stats(self):
+        """Rolling period/jitter statistics plus a histogram of achieved periods"""
+        periods = sorted(self.periods)
+        jitters = sorted(self.jitters)
+        return {
+            'name': self.name,
+            'target_period_ms': self.period * 1000.0,
+            'policy': self.policy,
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'skipped_ticks': self.skipped_ticks,
+            'period_mean_ms': sum(periods) / len(periods) if periods else 0.0,
+            'period_p50_ms': _percentile(periods, 0.50),
+            'period_p99_ms': _percentile(periods, 0.99),
+            'period_max_ms': periods[-1] if periods else 0.0,
+            'jitter_p50_ms': _percentile(jitters, 0.50),
+            'jitter_p99_ms': _percentile(jitters, 0.99),
+            'jitter_max_ms': jitters[-1] if jitters else 0.0,
+            'period_histogram': _histogram(periods),
+        }
+
+    def summary(self):
+        """One-line summary for logs"""
+        s = self.stats()
+        return (f"period p50 {s['period_p50_ms']:.1f} ms p99 {s['period_p99_ms']:.1f} ms "
+                f"max {s['period_max_ms']:.1f} ms, jitter p99 {s['jitter_p99_ms']:.1f} ms, "
+                f"overruns {s['overruns']}, skipped {s['skipped_ticks']}")
@@ -0,0 +1,285 @@
+"""Latest decoded samples of a machine in shared memory, for tools on the same host.
+
+The ingest daemon publishes every decoded sample of a machine into a POSIX
+shared memory segment (/dev/shm/ai4m_<machine>) holding the last `seconds`
+worth of samples. A reader maps the segment and reads samples straight out of
+it: no database query, no PLC session, no copy through a socket.
+
+Segment layout (native byte order):
+
+    header   b'AI4MSHM1', version, columns, slots, names length   (uint32s)
+             at 32: uint64 count of samples published
+             at 40: uint32 closed flag, uint32 writer pid
+    names    JSON list of the member names, from offset 64
+    slots    slots x (uint64 sequence, float64 receive time, float64 per member)
+
+Every value is stored as a float64 (clock fields, counters and BOOLs are
+exact; anything else becomes NaN). Each slot is a seqlock: sample n sets its
+slot's sequence to 2n+1, writes the values, then sets it to 2n+2 and
+advances the published count. A reader copies a slot and keeps it only if
+the sequence was 2n+2 before and after, so it never sees a torn sample and
+the writer never waits for readers.
+
+    from shared_ring import SampleRingReader
+    ring = SampleRingReader('mc17')
+    ring.value('MC_Hor_Pressure')
+    seq, received, values = ring.latest()
+    for seq, received, values in ring.since(seq): ...
+
+Usage: python3 shared_ring.py <machine> [tag ...]
+       python3 shared_ring.py mc17 MC_Hor_Pressure MC_Status_Code
+"""
+import json
+import logging
+import math
+import os
+import struct
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'AI4MSHM1'
+VERSION = 1
+HEADER = struct.Struct('8sIIII')
+COUNT = struct.Struct('Q')
+COUNT_OFFSET = 32
+STATE = struct.Struct('II')
+STATE_OFFSET = 40
+NAMES_OFFSET = 64
+SEQUENCE = struct.Struct('Q')
+SHM_DIRECTORY = '/dev/shm'
+CHECK_INTERVAL = 1.0  # seconds between checks for a segment replaced behind the reader's back
+
+
+def segment_name(machine):
+    return f"ai4m_{machine}"
+
+
+def slot_struct(columns):
+    """Sequence, receive time and one float64 per member"""
+    return struct.Struct('Qd' + 'd' * columns)
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+class SharedSampleRing:
+    """Writer side: publishes one machine's samples into its shared memory segment"""
+
+    def __init__(self, machine, names, slots=2000):
+        self.machine = machine
+        self.names = list(names)
+        self.slots = slots
+        self.slot = slot_struct(len(self.names))
+        self.values = struct.Struct('d' + 'd' * len(self.names))
+        names = json.dumps(self.names).encode('utf-8')
+        self.slots_offset = NAMES_OFFSET + (len(names) + 7) // 8 * 8
+        size = self.slots_offset + slots * self.slot.size
+
+        name = segment_name(machine)
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a daemon that did not shut down cleanly: mark it closed so
+            # readers still mapping it re-attach instead of serving its last samples
+            stale = shared_memory.SharedMemory(name)
+            if stale.size >= NAMES_OFFSET and bytes(stale.buf[:len(MAGIC)]) == MAGIC:
+                STATE.pack_into(stale.buf, STATE_OFFSET, 1, os.getpid())
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        self.buf = self.shm.buf
+        HEADER.pack_into(self.buf, 0, MAGIC, VERSION, len(self.names), slots, len(names))
+        self.buf[NAMES_OFFSET:NAMES_OFFSET + len(names)] = names
+        STATE.pack_into(self.buf, STATE_OFFSET, 0, os.getpid())
+        COUNT.pack_into(self.buf, COUNT_OFFSET, 0)
+
+        # Metrics
+        self.published = 0
+        self.converted = 0
+
+    def publish(self, received, sample):
+        """Store one decoded sample (acquisition thread only)"""
+        n = self.published
+        offset = self.slots_offset + (n % self.slots) * self.slot.size
+        SEQUENCE.pack_into(self.buf, offset, 2 * n + 1)
+        try:
+            self.values.pack_into(self.buf, offset + SEQUENCE.size, received, *sample)
+        except struct.error:
+            self.converted += 1
+            self.values.pack_into(self.buf, offset + SEQUENCE.size, received, *map(_float, sample))
+        SEQUENCE.pack_into(self.buf, offset, 2 * n + 2)
+        self.published = n + 1
+        COUNT.pack_into(self.buf, COUNT_OFFSET, n + 1)
+
+    def close(self):
+        """Mark the segment closed for readers and remove it"""
+        STATE.pack_into(self.buf, STATE_OFFSET, 1, os.getpid())
+        self.buf = None
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        return {
+            'segment': self.shm.name,
+            'bytes': self.shm.size,
+            'slots': self.slots,
+            'published': self.published,
+            'converted': self.converted,
+        }
+
+
+class SampleRingReader:
+    """Reader side: maps a machine's segment and returns samples as (seq, received, values)"""
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.shm = None
+        self.buf = None
+        self.inode = None
+        self.checked = 0.0
+        self._attach()
+
+    def _attach(self):
+        shm = shared_memory.SharedMemory(segment_name(self.machine))
+        # The daemon owns the segment; keep the resource tracker from unlinking it when this process exits
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        magic, version, columns, slots, names_length = HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            shm.close()
+            raise ValueError(f"{shm.name} is not a version {VERSION} sample ring")
+        self.names = json.loads(bytes(shm.buf[NAMES_OFFSET:NAMES_OFFSET + names_length]))
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.slots = slots
+        self.slot = slot_struct(columns)
+        self.slots_offset = NAMES_OFFSET + (names_length + 7) // 8 * 8
+        self.close()
+        self.shm = shm
+        self.buf = shm.buf
+        self.inode = os.fstat(shm._fd).st_ino
+        self.checked = time.monotonic()
+
+    def _replaced(self):
+        """True if the segment name now points at another segment (a writer that never marked ours closed)"""
+        now = time.monotonic()
+        if now - self.checked < CHECK_INTERVAL:
+            return False
+        self.checked = now
+        try:
+            return os.stat(os.path.join(SHM_DIRECTORY, self.shm.name)).st_ino != self.inode
+        except FileNotFoundError:
+            return False
+
+    def _check_writer(self):
+        """Re-attach once the daemon restarted and created a new segment"""
+        closed, _ = STATE.unpack_from(self.buf, STATE_OFFSET)
+        if closed or self._replaced():
+            try:
+                self._attach()
+            except FileNotFoundError:
+                pass  # Not back yet; keep serving the last samples
+
+    def read(self, n):
+        """Sample n, or None if its slot has been overwritten or is being written"""
+        offset = self.slots_offset + (n % self.slots) * self.slot.size
+        sequence, received, *values = self.slot.unpack_from(self.buf, offset)
+        if sequence != 2 * n + 2 or SEQUENCE.unpack_from(self.buf, offset)[0] != sequence:
+            return None
+        return n, received, tuple(values)
+
+    def count(self):
+        """Number of samples published by the current writer"""
+        self._check_writer()
+        return COUNT.unpack_from(self.buf, COUNT_OFFSET)[0]
+
+    def latest(self):
+        """The newest sample, or None if nothing has been published yet"""
+        for _ in range(100):
+            published = self.count()
+            if not published:
+                return None
+            sample = self.read(published - 1)
+            if sample is not None:
+                return sample
+        return None
+
+    def since(self, seq):
+        """Samples after seq (-1 for everything still in the ring), oldest first. A
+        gap in the sequence numbers means the reader fell more than the ring behind."""
+        published = self.count()
+        if seq >= published:
+            seq = -1  # The daemon restarted and numbers from 0 again
+        first = max(seq + 1, published - self.slots, 0)
+        samples = []
+        for n in range(first, published):
+            sample = self.read(n)
+            if sample is not None:
+                samples.append(sample)
+        return samples
+
+    def wait(self, seq, timeout=1.0, poll=0.005):
+        """Samples after seq, waiting up to timeout seconds for at least one"""
+        deadline = time.monotonic() + timeout
+        while True:
+            samples = self.since(seq)
+            if samples or time.monotonic() >= deadline:
+                return samples
+            time.sleep(poll)
+
+    def value(self, name):
+        """Newest value of one member"""
+        sample = self.latest()
+        return sample[2][self.index[name]] if sample else None
+
+    def values(self, names=None):
+        """Newest values as a dict, of all members or of names"""
+        sample = self.latest()
+        if sample is None:
+            return None
+        return {name: sample[2][self.index[name]] for name in (names or self.names)}
+
+    def close(self):
+        if self.shm is not None:
+            self.buf = None
+            self.shm.close()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__.strip().splitlines()[-2])
+        sys.exit(1)
+    try:
+        ring = SampleRingReader(sys.argv[1])
+    except FileNotFoundError:
+        print(f"No sample ring for {sys.argv[1]}; is the ingest daemon running with shared_ring enabled?")
+        sys.exit(1)
+    with ring:
+        sample = ring.latest()
+        if sample is None:
+            print(f"{sys.argv[1]}: no samples yet")
+            return
+        seq, received, _ = sample
+        print(f"{sys.argv[1]}: sample {seq}, received {time.time() - received:.3f} s ago")
+        for name, value in ring.values(sys.argv[2:] or None).items():
+            print(f"  {name:<32} {value}")
+
+
+if __name__ == '__main__':
+    main()
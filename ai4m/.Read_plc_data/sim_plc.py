@@ -0,0 +1,251 @@
+"""Simulated PLCs for load tests without MC17/MC18 hardware.
+
+SimulatedLogixDriver has the parts of pycomm3's LogixDriver the readers use
+(open/close/connected, read/write of the machine UDT or single members,
+generic_message, context manager) and answers from a MachineModel instead of
+a controller. The model produces MC17/MC18-like UDT dicts: the PLC clock,
+a cam position advancing at the machine speed and wrapping at 360, sachet and
+CLD counters, status codes with occasional stops, cam-synchronous currents,
+positions and sealing pressures, and slowly drifting sealer temperatures.
+
+Read latency, jitter, failed reads, dropped sessions and failed connects can
+be injected. Models are kept per address, so a reconnect continues the same
+machine state. A machine in machines.json uses the simulator when it has a
+"simulate" entry, e.g. {"latency": 0.003, "failure_rate": 0.001}.
+"""
+import datetime
+import math
+import random
+import threading
+import time
+
+from pycomm3 import CommError, Tag
+
+from udt_decoder import CLOCK_FIELDS
+
+# Codes the model reports while stopped (0 = running)
+STOP_CODES = (2, 3, 5, 7, 11, 18, 22, 31)
+
+INT_MEMBERS = {'MC_Status_Code', 'MC_Status', 'MC_Sachet_Count', 'MC_CLD_Count', 'MC_Eye_Mark_Count'}
+
+
+class MachineModel:
+    """Synthetic form-fill-seal machine state, advanced in wall-clock time"""
+
+    def __init__(self, members, speed_ppm=120, stop_rate=1 / 600, stop_seconds=(5, 60), seed=None):
+        self.members = list(members)
+        self.speed_ppm = speed_ppm
+        self.stop_rate = stop_rate          # stops per running second
+        self.stop_seconds = stop_seconds
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+        self.cam = self.rng.uniform(0, 360)
+        self.sachet_count = self.rng.randrange(100000)
+        self.cld_count = self.sachet_count // 12
+        self.status_code = 0
+        self.stopped_until = 0.0
+        self.last_time = None
+        self.overrides = {}
+        self.phases = {name: self.rng.uniform(0, 360) for name in self.members}
+        self.temperatures = {name: self.rng.uniform(140, 160) for name in self.members if name.endswith('_Temp')}
+        self.levels = {name: self.rng.uniform(40, 80) for name in self.members if name.endswith('_Level')}
+        self.generators = [(name, self._generator(name)) for name in self.members if name not in CLOCK_FIELDS]
+
+    def _generator(self, name):
+        if name in self.overrides:
+            return lambda: self.overrides[name]
+        if name == 'MC_Cam_Position':
+            return lambda: self.cam
+        if name == 'MC_Status_Code':
+            return lambda: self.status_code
+        if name == 'MC_Status':
+            return lambda: int(self.status_code == 0)
+        if name in ('MC_Sachet_Count', 'MC_Eye_Mark_Count'):
+            return lambda: self.sachet_count
+        if name == 'MC_CLD_Count':
+            return lambda: self.cld_count
+        if name.endswith('_Temp'):
+            return lambda: round(self.temperatures[name] + self.rng.gauss(0, 0.2), 2)
+        if name.endswith('_Level'):
+            return lambda: self.levels[name]
+        if 'Pressure' in name:
+            # Sealing jaws close between 150 and 190 degrees
+            centre = 170 if 'Hor' in name else 165
+            return lambda: (0.3 + 4.5 * math.exp(-((self.cam - centre) / 12) ** 2) if self.status_code == 0 else 0.3) \
+                + self.rng.gauss(0, 0.05)
+        phase = math.radians(self.phases[name])
+        if 'Current' in name:
+            return lambda: (2.0 + 1.5 * math.sin(math.radians(self.cam) + phase) if self.status_code == 0 else 0.1) \
+                + self.rng.gauss(0, 0.05)
+        if 'Position' in name:
+            return lambda: (self.cam + self.phases[name]) % 360
+        if 'Stroke' in name:
+            return lambda: 62.5
+        return lambda: 0.0
+
+    def set(self, name, value):
+        """Pin a member to a written value"""
+        with self.lock:
+            self.overrides[name] = value
+            self.generators = [(member, self._generator(member)) for member in self.members if member not in CLOCK_FIELDS]
+
+    def _advance(self, now):
+        if self.last_time is None:
+            self.last_time = now
+        elapsed = max(0.0, now - self.last_time)
+        self.last_time = now
+        if self.status_code:
+            if now >= self.stopped_until:
+                self.status_code = 0
+            return
+        if self.rng.random() < self.stop_rate * elapsed:
+            self.status_code = self.rng.choice(STOP_CODES)
+            self.stopped_until = now + self.rng.uniform(*self.stop_seconds)
+            return
+        self.cam += elapsed * self.speed_ppm / 60.0 * 360.0
+        if self.cam >= 360.0:
+            cycles = int(self.cam // 360.0)
+            self.cam -= cycles * 360.0
+            self.sachet_count += cycles
+            self.cld_count = self.sachet_count // 12
+        for name in self.levels:
+            self.levels[name] = min(95.0, max(5.0, self.levels[name] + self.rng.gauss(0, 0.02)))
+        for name in self.temperatures:
+            self.temperatures[name] += (150.0 - self.temperatures[name]) * 0.001 + self.rng.gauss(0, 0.01)
+
+    def sample(self, now=None):
+        """UDT dict at wall-clock time now (the PLC clock is local time, like the controllers)"""
+        now = time.time() if now is None else now
+        with self.lock:
+            self._advance(now)
+            clock = datetime.datetime.fromtimestamp(now)
+            values = {
+                'Year': clock.year, 'Month': clock.month, 'Day': clock.day,
+                'Hour': clock.hour, 'Min': clock.minute, 'Sec': clock.second, 'Microsecond': clock.microsecond,
+            }
+            for name, generate in self.generators:
+                values[name] = generate()
+        return values
+
+
+class SimulatedLogixDriver:
+    """Drop-in stand-in for pycomm3.LogixDriver backed by a MachineModel"""
+
+    models = {}
+    models_lock = threading.Lock()
+
+    def __init__(self, path, udt_tag='MC17', members=None, latency=0.002, jitter=0.001, failure_rate=0.0,
+                 disconnect_rate=0.0, connect_failure_rate=0.0, speed_ppm=120, seed=None, **kwargs):
+        self.path = path
+        self.udt_tag = udt_tag
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.disconnect_rate = disconnect_rate
+        self.connect_failure_rate = connect_failure_rate
+        self.rng = random.Random(seed)
+        self.socket_timeout = kwargs.get('socket_timeout', 5.0)
+        self._connected = False
+        if members is None:
+            members = list(CLOCK_FIELDS) + ['MC_Cam_Position', 'MC_Status_Code', 'MC_Status', 'MC_Sachet_Count']
+        with self.models_lock:
+            self.model = self.models.get(path)
+            if self.model is None:
+                self.model = self.models[path] = MachineModel(members, speed_ppm=speed_ppm, seed=seed)
+
+        # Metrics
+        self.reads = 0
+        self.failed_reads = 0
+        self.disconnects = 0
+        self.cpu_seconds = 0.0  # spent generating samples, so benchmarks can subtract it
+
+    @property
+    def connected(self):
+        return self._connected
+
+    @property
+    def tags(self):
+        # No template upload: UdtDecoder.from_plc raises KeyError and callers use dict decoding
+        return {}
+
+    @property
+    def info(self):
+        return {'product_name': 'Simulated Logix Controller', 'ip_address': self.path}
+
+    def open(self):
+        self._round_trip()
+        if self.rng.random() < self.connect_failure_rate:
+            raise CommError(f"Simulated connect failure to {self.path}")
+        self._connected = True
+        return True
+
+    def close(self):
+        self._connected = False
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _round_trip(self):
+        delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _request(self):
+        if not self._connected:
+            raise CommError("Not connected")
+        self._round_trip()
+        if self.disconnect_rate and self.rng.random() < self.disconnect_rate:
+            self._connected = False
+            self.disconnects += 1
+            raise CommError(f"Simulated connection reset by {self.path}")
+
+    def _value(self, tag):
+        if tag == self.udt_tag:
+            started = time.thread_time()
+            value = self.model.sample()
+            self.cpu_seconds += time.thread_time() - started
+            return Tag(tag, value, self.udt_tag, None)
+        member = tag[len(self.udt_tag) + 1:] if tag.startswith(self.udt_tag + '.') else tag
+        if member in self.model.members:
+            value = self.model.sample()[member]
+            return Tag(tag, value, 'DINT' if member in INT_MEMBERS else 'REAL', None)
+        if member in self.model.overrides:
+            return Tag(tag, self.model.overrides[member], None, None)
+        return Tag(tag, None, None, 'Tag doesn\'t exist')
+
+    def read(self, *tags):
+        self._request()
+        results = []
+        for tag in tags:
+            self.reads += 1
+            if self.failure_rate and self.rng.random() < self.failure_rate:
+                self.failed_reads += 1
+                results.append(Tag(tag, None, None, 'Simulated read failure'))
+            else:
+                results.append(self._value(tag))
+        return results[0] if len(results) == 1 else results
+
+    def write(self, *tags_values):
+        if len(tags_values) == 2 and isinstance(tags_values[0], str):
+            tags_values = (tuple(tags_values),)
+        self._request()
+        results = []
+        for tag, value in tags_values:
+            member = tag[len(self.udt_tag) + 1:] if tag.startswith(self.udt_tag + '.') else tag
+            self.model.set(member, value)
+            results.append(Tag(tag, value, None, None))
+        return results[0] if len(results) == 1 else results
+
+    def generic_message(self, **kwargs):
+        self._request()
+        return Tag(kwargs.get('name', 'generic'), None, None, 'Service not supported by the simulator')
+
+    def stats(self):
+        return {'reads': self.reads, 'failed_reads': self.failed_reads, 'disconnects': self.disconnects,
+                'cpu_seconds': self.cpu_seconds}
@@ -0,0 +1,276 @@
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Record framing: payload length, CRC32 of the payload, payload (JSON)
+RECORD_HEADER = struct.Struct('!II')
+SEGMENT_SUFFIX = '.seg'
+CURSOR_FILE = 'cursor.json'
+
+
+def _segment_name(number):
+    return f"{number:012d}{SEGMENT_SUFFIX}"
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Spool:
+    """Crash-safe, append-only on-disk spool of row batches.
+
+    Batches are written as checksummed records into numbered segment files.
+    Writes are fsync'd in batches (at most every fsync_interval seconds, and on
+    rotate/close), so a power loss can lose at most that window; a torn record
+    at the end of a segment is detected by its length/CRC and ignored.
+
+    Replay is in append order. The read position is kept in cursor.json, which
+    is replaced atomically after every acknowledged batch, so replay resumes
+    where it stopped after a restart. Fully replayed segments are deleted.
+    When the spool exceeds max_bytes the oldest segment is dropped.
+    """
+
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, max_bytes=2 * 1024 * 1024 * 1024,
+                 fsync_interval=0.5):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # Metrics
+        self.records_written = 0
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.records_replayed = 0
+        self.rows_replayed = 0
+        self.corrupt_records = 0
+        self.dropped_segments = 0
+        self.replay_started = None
+        self.replay_base_rows = 0
+        self.replay_rows_per_sec = 0.0
+
+        self.cursor_segment, self.cursor_offset = self._load_cursor()
+        segments = self._segments()
+        if segments and self.cursor_segment < segments[0]:
+            self.cursor_segment, self.cursor_offset = segments[0], 0
+        # Never append to a segment that may end in a torn record: start a fresh one
+        self.active_segment = (segments[-1] + 1) if segments else max(self.cursor_segment, 1)
+        self.active_file = None
+        self.active_size = 0
+        self.last_fsync = time.monotonic()
+        self.total_bytes = sum(self._segment_size(n) for n in segments)
+
+    # ------------------------------------------------------------------ files
+
+    def _segments(self):
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                try:
+                    numbers.append(int(name[:-len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(numbers)
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, _segment_name(number))
+
+    def _segment_size(self, number):
+        try:
+            return os.path.getsize(self._segment_path(number))
+        except OSError:
+            return 0
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE), 'r') as f:
+                cursor = json.load(f)
+            return cursor['segment'], cursor['offset']
+        except (FileNotFoundError, ValueError, KeyError):
+            return 0, 0
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'segment': self.cursor_segment, 'offset': self.cursor_offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        _fsync_dir(self.directory)
+
+    def _open_active(self):
+        self.active_file = open(self._segment_path(self.active_segment), 'ab')
+        self.active_size = self.active_file.tell()
+        _fsync_dir(self.directory)
+
+    def _sync(self):
+        if self.active_file:
+            self.active_file.flush()
+            os.fsync(self.active_file.fileno())
+        self.last_fsync = time.monotonic()
+
+    def _rotate(self):
+        self._sync()
+        self.active_file.close()
+        self.active_file = None
+        self.active_segment += 1
+
+    def _enforce_cap(self):
+        segments = [n for n in self._segments() if n != self.active_segment]
+        while self.total_bytes > self.max_bytes and segments:
+            oldest = segments.pop(0)
+            size = self._segment_size(oldest)
+            os.remove(self._segment_path(oldest))
+            self.total_bytes -= size
+            self.dropped_segments += 1
+            logger.error(f"Spool over {self.max_bytes} bytes, dropped segment {oldest} ({size} bytes)")
+            if self.cursor_segment <= oldest:
+                self.cursor_segment, self.cursor_offset = oldest + 1, 0
+                self._save_cursor()
+
+    # ----------------------------------------------------------------- append
+
+    def append(self, table, rows):
+        """Append one batch of rows for a table"""
+        payload = json.dumps({'table': table, 'rows': rows}, default=str).encode('utf-8')
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self.lock:
+            if self.active_file is None:
+                self._open_active()
+            self.active_file.write(record)
+            self.active_file.flush()
+            self.active_size += len(record)
+            self.total_bytes += len(record)
+            self.records_written += 1
+            self.rows_written += len(rows)
+            self.bytes_written += len(record)
+            if self.active_size >= self.segment_bytes:
+                self._rotate()
+            elif time.monotonic() - self.last_fsync >= self.fsync_interval:
+                self._sync()
+            if self.total_bytes > self.max_bytes:
+                self._enforce_cap()
+
+    def sync(self):
+        """Force buffered records to disk"""
+        with self.lock:
+            self._sync()
+
+    def close(self):
+        with self.lock:
+            if self.active_file:
+                self._sync()
+                self.active_file.close()
+                self.active_file = None
+
+    # ----------------------------------------------------------------- replay
+
+    def has_pending(self):
+        """True while there are records that have not been acknowledged"""
+        with self.lock:
+            segments = self._segments()
+            if not segments:
+                return False
+            if self.cursor_segment < segments[-1]:
+                return True
+            return self.cursor_offset < self._segment_size(segments[-1])
+
+    def read_batch(self, max_records=50):
+        """Return up to max_records unacknowledged records as (position, table, rows).
+
+        Pass the position of the last record handled to ack().
+        """
+        with self.lock:
+            segments = [n for n in self._segments() if n >= self.cursor_segment]
+            active = self.active_segment
+        records = []
+        segment, offset = self.cursor_segment, self.cursor_offset
+        for number in segments:
+            if number != segment:
+                segment, offset = number, 0
+            try:
+                with open(self._segment_path(number), 'rb') as f:
+                    f.seek(offset)
+                    while len(records) < max_records:
+                        header = f.read(RECORD_HEADER.size)
+                        if len(header) < RECORD_HEADER.size:
+                            break
+                        length, crc = RECORD_HEADER.unpack(header)
+                        payload = f.read(length)
+                        if len(payload) < length or zlib.crc32(payload) != crc:
+                            if number != active and number != segments[-1]:
+                                # Torn tail from a crash; the rest of the segment is unusable
+                                self.corrupt_records += 1
+                                logger.error(f"Spool segment {number}: corrupt record at offset {offset}, skipping rest")
+                            break
+                        offset += RECORD_HEADER.size + length
+                        record = json.loads(payload.decode('utf-8'))
+                        records.append(((number, offset), record['table'], record['rows']))
+            except FileNotFoundError:
+                continue
+            if len(records) >= max_records:
+                break
+        return records
+
+    def ack(self, position):
+        """Mark every record up to position as replayed and delete finished segments"""
+        segment, offset = position
+        with self.lock:
+            self.cursor_segment, self.cursor_offset = segment, offset
+            self._save_cursor()
+            for number in self._segments():
+                if number < segment:
+                    self.total_bytes -= self._segment_size(number)
+                    os.remove(self._segment_path(number))
+            # A finished, inactive segment can go as soon as it is fully read
+            if segment != self.active_segment and offset >= self._segment_size(segment):
+                self.total_bytes -= self._segment_size(segment)
+                os.remove(self._segment_path(segment))
+                self.cursor_segment, self.cursor_offset = segment + 1, 0
+                self._save_cursor()
+
+    def record_replay(self, record_count, row_count):
+        """Update replay throughput metrics after a batch has been written"""
+        now = time.monotonic()
+        if self.replay_started is None:
+            self.replay_started = now
+            self.replay_base_rows = self.rows_replayed
+        self.records_replayed += record_count
+        self.rows_replayed += row_count
+        elapsed = now - self.replay_started
+        if elapsed > 0:
+            self.replay_rows_per_sec = (self.rows_replayed - self.replay_base_rows) / elapsed
+
+    def replay_finished(self):
+        if self.replay_started is not None:
+            logger.info(f"Spool replay caught up: {self.rows_replayed} rows, {self.replay_rows_per_sec:.0f} rows/s")
+        self.replay_started = None
+
+    def stats(self):
+        return {
+            'pending_bytes': self.total_bytes,
+            'records_written': self.records_written,
+            'rows_written': self.rows_written,
+            'bytes_written': self.bytes_written,
+            'records_replayed': self.records_replayed,
+            'rows_replayed': self.rows_replayed,
+            'replay_rows_per_sec': self.replay_rows_per_sec,
+            'corrupt_records': self.corrupt_records,
+            'dropped_segments': self.dropped_segments,
+        }
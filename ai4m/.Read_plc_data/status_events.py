@@ -0,0 +1,72 @@
+import datetime
+import time
+
+UNIX_EPOCH = datetime.datetime(1970, 1, 1)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def micros(timestamp):
+    """Microseconds since 1970 of an EpochMicros or a naive datetime, both PLC clock"""
+    us = getattr(timestamp, 'us', None)
+    return (timestamp - UNIX_EPOCH) // ONE_MICROSECOND if us is None else us
+
+
+class StatusEventTracker:
+    """Turns the per-poll MC_Status_Code stream into change events and heartbeats.
+
+    A 'change' event is produced when the code differs from the previous poll
+    and carries the previous code and how long it lasted (PLC time). A
+    'heartbeat' repeats the current state every heartbeat_interval seconds
+    without a change, so consumers can tell a quiet machine from a dead feed.
+    Every event also has the {key: status_code} field of the old per-poll
+    messages so existing consumers keep working.
+    """
+
+    def __init__(self, key, heartbeat_interval=30.0):
+        self.key = key
+        self.heartbeat_interval = heartbeat_interval
+        self.code = None
+        self.since = None
+        self.last_sent = None
+        self.changes = 0
+        self.heartbeats = 0
+        self.polls = 0
+
+    def update(self, code, timestamp, cycle_id, now=None):
+        """Feed one poll; timestamp is an EpochMicros or a datetime (PLC clock).
+        Returns an event dict to publish, or None"""
+        now = time.monotonic() if now is None else now
+        self.polls += 1
+        if code != self.code:
+            event = {
+                self.key: code,
+                'machine': self.key,
+                'event': 'change',
+                'status_code': code,
+                'previous_code': self.code,
+                'timestamp': str(timestamp),
+                'previous_duration_ms': (micros(timestamp) - micros(self.since)) / 1000 if self.since else None,
+                'cycle_id': cycle_id,
+            }
+            self.code = code
+            self.since = timestamp
+            self.last_sent = now
+            self.changes += 1
+            return event
+        if now - self.last_sent >= self.heartbeat_interval:
+            self.last_sent = now
+            self.heartbeats += 1
+            return {
+                self.key: code,
+                'machine': self.key,
+                'event': 'heartbeat',
+                'status_code': code,
+                'since': str(self.since),
+                'timestamp': str(timestamp),
+                'duration_ms': (micros(timestamp) - micros(self.since)) / 1000,
+                'cycle_id': cycle_id,
+            }
+        return None
+
+    def stats(self):
+        return {'polls': self.polls, 'changes': self.changes, 'heartbeats': self.heartbeats}
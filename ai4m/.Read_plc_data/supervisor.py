@@ -0,0 +1,160 @@
+import logging
+import random
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+HEALTHY = 'healthy'
+DEGRADED = 'degraded'
+RECONNECTING = 'reconnecting'
+STATES = (HEALTHY, DEGRADED, RECONNECTING)
+
+COMPONENT_STATE = metrics.gauge('ai4m_component_state', '1 for the current health state of a dependency',
+                                ['component', 'state'])
+RECONNECT_ATTEMPTS = metrics.counter('ai4m_reconnect_attempts_total', 'Failed connection attempts and requests',
+                                     ['component'])
+OUTAGES = metrics.counter('ai4m_outages_total', 'Transitions out of healthy', ['component'])
+RECOVERY_SECONDS = metrics.histogram('ai4m_recovery_seconds', 'Time from first fault to recovery', ['component'],
+                                     buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800))
+
+
+class Backoff:
+    """Exponential backoff with jitter; the first retry is immediate"""
+
+    def __init__(self, initial=0.5, maximum=30.0, multiplier=2.0, jitter=0.2):
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        """Seconds to wait before retry number attempt (1 = first retry)"""
+        if attempt <= 1:
+            return 0.0
+        delay = min(self.maximum, self.initial * self.multiplier ** (attempt - 2))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class ComponentHealth:
+    """Health state machine for one dependency (a PLC session, the database, Kafka).
+
+    healthy -> degraded when an error or timeout is seen, -> reconnecting
+    while connection attempts fail, and back to healthy on the first success.
+    The time from the first fault to recovery is recorded per outage. Each
+    component backs off on its own, so a fault in one never restarts another.
+    """
+
+    def __init__(self, name, backoff=None):
+        self.name = name
+        self.backoff = backoff or Backoff()
+        self.lock = threading.Lock()
+        self.state = HEALTHY
+        self.since = time.monotonic()
+        self.outage_started = None
+        self.last_error = None
+        self.failures = 0
+
+        # Metrics
+        self.outages = 0
+        self.reconnect_attempts = 0
+        self.recoveries = 0
+        self.last_recovery_s = None
+        self.max_recovery_s = 0.0
+        self.total_recovery_s = 0.0
+        for state in STATES:
+            COMPONENT_STATE.labels(name, state).set_function(lambda state=state: int(self.state == state))
+        self.reconnect_metric = RECONNECT_ATTEMPTS.labels(name)
+        self.outage_metric = OUTAGES.labels(name)
+        self.recovery_metric = RECOVERY_SECONDS.labels(name)
+
+    def _set_state(self, state, error=None):
+        now = time.monotonic()
+        if self.state == HEALTHY and state != HEALTHY:
+            self.outage_started = now
+            self.outages += 1
+            self.outage_metric.inc()
+        if state != self.state:
+            logger.warning(f"{self.name}: {self.state} -> {state}" + (f" ({error})" if error else ""))
+            self.state = state
+            self.since = now
+        if error is not None:
+            self.last_error = str(error)
+
+    def degraded(self, error=None):
+        """A fault was seen but no reconnect has been attempted yet"""
+        with self.lock:
+            if self.state == HEALTHY:
+                self._set_state(DEGRADED, error)
+
+    def failed(self, error=None):
+        """A connection attempt or request failed: wait out the backoff before the next try"""
+        with self.lock:
+            self.failures += 1
+            self.reconnect_attempts += 1
+            self.reconnect_metric.inc()
+            self._set_state(RECONNECTING, error)
+            delay = self.backoff.delay(self.failures)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    def healthy(self):
+        if self.state == HEALTHY:
+            return
+        with self.lock:
+            if self.state == HEALTHY:
+                return
+            recovery = time.monotonic() - self.outage_started
+            self.last_recovery_s = recovery
+            self.max_recovery_s = max(self.max_recovery_s, recovery)
+            self.total_recovery_s += recovery
+            self.recoveries += 1
+            self.recovery_metric.observe(recovery)
+            self.failures = 0
+            logger.info(f"{self.name}: recovered after {recovery:.2f} s")
+            self._set_state(HEALTHY)
+
+    @property
+    def is_healthy(self):
+        return self.state == HEALTHY
+
+    def stats(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'state_seconds': time.monotonic() - self.since,
+                'last_error': self.last_error,
+                'consecutive_failures': self.failures,
+                'outages': self.outages,
+                'reconnect_attempts': self.reconnect_attempts,
+                'last_recovery_s': self.last_recovery_s,
+                'max_recovery_s': self.max_recovery_s,
+                'recoveries': self.recoveries,
+                'mean_recovery_s': self.total_recovery_s / self.recoveries if self.recoveries else None,
+            }
+
+
+class Supervisor:
+    """Registry of component health state machines"""
+
+    def __init__(self):
+        self.components = {}
+        self.lock = threading.Lock()
+
+    def component(self, name, **backoff):
+        with self.lock:
+            if name not in self.components:
+                self.components[name] = ComponentHealth(name, Backoff(**backoff) if backoff else None)
+            return self.components[name]
+
+    def unhealthy(self):
+        return [component for component in self.components.values() if not component.is_healthy]
+
+    def summary(self):
+        return ', '.join(f"{name}={component.state}" for name, component in self.components.items())
+
+    def stats(self):
+        return {name: component.stats() for name, component in self.components.items()}
@@ -0,0 +1,254 @@
+"""On-disk cache of controller tag lists and UDT templates for LogixDriver.
+
+Every LogixDriver.open() uploads the whole symbol list of the controller and
+every UDT template it uses: dozens to hundreds of requests, seconds on a busy
+controller, and the loop3 checkpoint scripts used to pay it every 5 s per
+PLC. CachedLogixDriver is a drop-in LogixDriver that keeps the raw upload
+(symbol lists per scope, template attributes and template definitions) in
+one JSON file per PLC address and replays it through pycomm3's own parsing,
+so tags and data types come out exactly as from a live upload.
+
+A cache file is used when it is younger than max_age and its signature
+(controller serial, product code, firmware revision and program name, which
+pycomm3 reads at connect anyway) matches. Before using it, one Get Instance
+Attribute List per scope checks that the last cached symbol is still the
+last one in the controller, which catches tags added or removed by a
+download or online edit; when it fails the symbol lists are uploaded again.
+Template attributes (size, member count and structure handle, a CRC of the
+definition) are always read live, one request per template, and a cached
+template definition is only reused while they are unchanged.
+
+The driver overrides private pycomm3 methods, so it is pinned to the pycomm3
+releases it was checked against (PYCOMM3_VERSIONS); with any other release it
+logs a warning and uploads the tag list like a plain LogixDriver.
+
+    from tag_cache import CachedLogixDriver
+    with CachedLogixDriver('141.141.141.128') as plc:     # was LogixDriver(...)
+        plc.read('HMI_Hor_Sealer_Strk_1')
+
+The ingest daemon and the PLC gateway use it when the "tag_cache" section of
+machines.json is enabled.
+
+Usage: python3 tag_cache.py <plc address> [cache directory]
+       python3 tag_cache.py 141.141.141.128
+"""
+import json
+import logging
+import os
+import re
+import sys
+import time
+from io import BytesIO
+
+from pycomm3 import LogixDriver, __version__ as pycomm3_version
+from pycomm3.cip import ClassCode, DataSegment, LogicalSegment, PADDED_EPATH, Services, STRING, UDINT, UINT
+from pycomm3.const import SUCCESS
+from pycomm3.packets import SendUnitDataRequestPacket
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+DEFAULT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tag_cache')
+DEFAULT_MAX_AGE = 24 * 3600
+CONTROLLER_SCOPE = ''
+PYCOMM3_VERSIONS = ('1.2.14', '1.2.15', '1.2.16')  # releases whose private upload methods this driver overrides
+
+TAG_CACHE_LOADS = metrics.counter('ai4m_tag_cache_loads_total', 'Tag list loads by cache result', ['plc', 'result'])
+
+
+def cache_path(directory, path):
+    """Cache file of one PLC address (IP, IP:port or a full CIP path)"""
+    return os.path.join(directory, re.sub(r'[^0-9A-Za-z.]+', '_', path) + '.json')
+
+
+def load_entry(file_path):
+    try:
+        with open(file_path, 'r') as f:
+            entry = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable tag cache {file_path}: {e}")
+        return None
+    return entry if entry.get('version') == VERSION else None
+
+
+def save_entry(file_path, entry):
+    """Write a cache file atomically (temp file, rename); several processes share the directory"""
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, file_path)
+    except OSError as e:
+        logger.error(f"Failed to write tag cache {file_path}: {e}")
+
+
+def cache_options(config, base_dir='.'):
+    """CachedLogixDriver keyword arguments from the "tag_cache" section of machines.json, None if disabled"""
+    tag_cache = config.get('tag_cache', {})
+    if not tag_cache.get('enabled', False):
+        return None
+    return {
+        'cache_directory': os.path.join(base_dir, tag_cache.get('directory', 'tag_cache')),
+        'max_age': tag_cache.get('max_age_hours', 24) * 3600,
+    }
+
+
+class CachedLogixDriver(LogixDriver):
+    """LogixDriver whose tag list upload is served from the on-disk cache when it is still valid"""
+
+    def __init__(self, path, *args, cache_directory=DEFAULT_DIRECTORY, max_age=DEFAULT_MAX_AGE, **kwargs):
+        super().__init__(path, *args, **kwargs)
+        self.cache_file = cache_path(cache_directory, path)
+        self.max_age = max_age
+        self.cache_result = None  # 'hit', 'partial', 'miss' or 'disabled' after the last upload
+        self.cache_seconds = None
+        self._cached = None  # entry being replayed
+        self._recorded = None  # entry being built from this upload
+        self._uploads = 0
+        self._reused = 0
+
+    def signature(self):
+        info = self._info
+        return {
+            'serial': info.get('serial'),
+            'product_code': info.get('product_code'),
+            'revision': info.get('revision'),
+            'name': info.get('name'),
+        }
+
+    def get_tag_list(self, program=None, cache=True, **kwargs):
+        started = time.perf_counter()
+        if pycomm3_version not in PYCOMM3_VERSIONS:
+            logger.warning(f"{self._cip_path}: tag cache not checked against pycomm3 {pycomm3_version} "
+                           f"(supported: {', '.join(PYCOMM3_VERSIONS)}), uploading the tag list")
+            self._recorded = None  # the upload overrides below pass straight through
+            tags = super().get_tag_list(program, cache, **kwargs)
+            self.cache_result = 'disabled'
+            self.cache_seconds = time.perf_counter() - started
+            return tags
+        self._cached = self._valid_entry()
+        if self._cached:
+            changed = [scope or 'controller' for scope in self._cached['symbols'] if not self._symbols_unchanged(scope)]
+            if changed:
+                logger.info(f"{self._cip_path}: symbols changed in {', '.join(changed)}, uploading the tag list")
+                self._cached['symbols'] = {}
+        self._recorded = {'version': VERSION, 'path': self._cip_path, 'signature': self.signature(),
+                          'saved': time.time(), 'symbols': {}, 'structures': {}, 'templates': {}}
+        self._uploads = 0
+        self._reused = 0
+        try:
+            tags = super().get_tag_list(program, cache, **kwargs)  # tag_namespace_filter on pycomm3 >= 1.2.15
+        finally:
+            self._cached = None
+        if not self._uploads:
+            self.cache_result = 'hit'
+        else:
+            self.cache_result = 'partial' if self._reused else 'miss'
+            save_entry(self.cache_file, self._recorded)
+        self.cache_seconds = time.perf_counter() - started
+        TAG_CACHE_LOADS.labels(self._cip_path, self.cache_result).inc()
+        logger.info(f"{self._cip_path}: tag list {self.cache_result} ({len(tags)} tags, {self._uploads} uploads, "
+                    f"{self.cache_seconds * 1000:.0f} ms)")
+        return tags
+
+    def _valid_entry(self):
+        entry = load_entry(self.cache_file)
+        if entry is None:
+            return None
+        if time.time() - entry.get('saved', 0) > self.max_age:
+            logger.info(f"{self._cip_path}: tag cache older than {self.max_age} s")
+            return None
+        if entry.get('signature') != self.signature():
+            logger.info(f"{self._cip_path}: controller signature changed ({entry.get('signature')} -> "
+                        f"{self.signature()})")
+            return None
+        return entry
+
+    def _symbols_unchanged(self, scope):
+        """Cheap check: the last cached symbol of the scope is still the controller's last one"""
+        symbols = self._cached['symbols'][scope]
+        if not symbols:
+            return False
+        last = symbols[-1]
+        segments = [DataSegment(scope)] if scope else []
+        segments += [
+            LogicalSegment(ClassCode.symbol_object, 'class_id'),
+            LogicalSegment(last['instance_id'], 'instance_id'),
+        ]
+        request = SendUnitDataRequestPacket(self._sequence)
+        request.add(Services.get_instance_attribute_list, PADDED_EPATH.encode(segments, length=True),
+                    UINT.encode(1), b'\x01\x00')  # Attr. 1: symbol name
+        try:
+            response = self.send(request)
+        except Exception as e:
+            logger.warning(f"{self._cip_path}: symbol check of {scope or 'controller'} failed: {e}")
+            return False
+        if not response or response.service_status != SUCCESS:
+            return False
+        stream = BytesIO(response.data)
+        try:
+            records = []
+            while stream.tell() < len(response.data):
+                records.append((UDINT.decode(stream), STRING.decode(stream)))
+        except Exception:
+            return False
+        return records == [(last['instance_id'], last['tag_name'])]
+
+    def _get_instance_attribute_list_service(self, program=None, *args, **kwargs):
+        if self._recorded is None:
+            return super()._get_instance_attribute_list_service(program, *args, **kwargs)
+        scope = program or CONTROLLER_SCOPE
+        if scope and not scope.startswith('Program:'):
+            scope = f"Program:{scope}"
+        if self._cached and scope in self._cached['symbols']:
+            symbols = self._cached['symbols'][scope]
+            self._reused += 1
+        else:
+            symbols = super()._get_instance_attribute_list_service(program, *args, **kwargs)
+            self._uploads += 1
+        self._recorded['symbols'][scope] = symbols
+        return [dict(symbol) for symbol in symbols]
+
+    def _get_structure_makeup(self, instance_id):
+        # Always live (one Get Attribute List); _read_template compares it with the cached makeup
+        makeup = super()._get_structure_makeup(instance_id)
+        if self._recorded is None:
+            return makeup
+        self._recorded['structures'][str(instance_id)] = makeup
+        return makeup
+
+    def _read_template(self, instance_id, object_definition_size):
+        if self._recorded is None:
+            return super()._read_template(instance_id, object_definition_size)
+        key = str(instance_id)
+        data = None
+        if self._cached and key in self._cached['templates']:
+            # Reuse the definition only if the live makeup (size, member count, handle) is unchanged
+            if self._cached['structures'].get(key) == self._cache['id:struct'].get(instance_id):
+                data = bytes.fromhex(self._cached['templates'][key])
+                self._reused += 1
+        if data is None:
+            data = super()._read_template(instance_id, object_definition_size)
+            self._uploads += 1
+        self._recorded['templates'][key] = data.hex()
+        return data
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__.strip().splitlines()[-2])
+        sys.exit(1)
+    directory = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_DIRECTORY
+    with CachedLogixDriver(sys.argv[1], cache_directory=directory) as plc:
+        print(f"{sys.argv[1]}: {plc.info.get('name')}, {len(plc.tags)} tags, {len(plc.data_types)} data types, "
+              f"cache {plc.cache_result} in {plc.cache_seconds * 1000:.0f} ms ({plc.cache_file})")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    main()
@@ -0,0 +1,332 @@
+"""Rate-class scheduling of PLC tags outside the machine UDT.
+
+Besides the UDT polled every period, a machine has tags wanted at other
+rates: the loop3 HMI setpoints every 5 s, the unwinder drive registers
+(Read_Data[n]) every 100 ms, ... Each tag declares its rate class in a JSON
+file; a bare name takes the file's default rate:
+
+    {"rate": "5s",
+     "tags": ["HMI_Hor_Sealer_Strk_1", "Shift_1_Data",
+              {"tag": "Read_Data[1]", "rate": "100ms"}]}
+
+On every acquisition tick the scheduler takes the classes that are due and
+packs their tags into as few multi-service Read Tag requests as the CIP
+connection size allows (first-fit decreasing on the reply size, with
+pycomm3's size model, so that each packet is sent as exactly one request).
+pycomm3's own grouping fills packets in request order and typically needs
+more of them. Plans are cached per combination of due classes; sizes come
+from the tag list uploaded at connect and are recomputed on every reconnect.
+
+Every tick reports packets and request/reply bytes (stats(), and the
+ai4m_tag_read_* metrics). Values are stored one row per (flattened) value:
+
+    CREATE TABLE mc17_tags (
+        "timestamp" timestamp NOT NULL,
+        tag text NOT NULL,
+        value double precision
+    );
+    CREATE INDEX ON mc17_tags (tag, "timestamp");
+"""
+import collections
+import json
+import logging
+import math
+import re
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+TAG_READ_PACKETS = metrics.counter('ai4m_tag_read_packets_total', 'CIP requests sent for rate-class tag reads',
+                                   ['plc'])
+TAG_READ_BYTES = metrics.counter('ai4m_tag_read_bytes_total', 'Estimated CIP bytes of rate-class tag reads',
+                                 ['plc', 'direction'])
+
+ATOMIC_SIZES = {
+    'BOOL': 1, 'SINT': 1, 'USINT': 1, 'BYTE': 1, 'INT': 2, 'UINT': 2, 'WORD': 2,
+    'DINT': 4, 'UDINT': 4, 'DWORD': 4, 'REAL': 4, 'LINT': 8, 'ULINT': 8, 'LWORD': 8, 'LREAL': 8,
+}
+DEFAULT_DATA_SIZE = 4
+DEFAULT_CONNECTION_SIZE = 500
+# pycomm3 groups requests by data + message + 2 per request (its message includes the 2 byte
+# connection sequence count) on top of 10 per Multiple Service Packet
+MULTISERVICE_OVERHEAD = 10
+REQUEST_OVERHEAD = 4
+RATE = re.compile(r'^\s*([0-9.]+)\s*(ms|s|min|h)?\s*$')
+RATE_UNITS = {'ms': 0.001, 's': 1, None: 1, 'min': 60, 'h': 3600}
+ARRAY_INDEX = re.compile(r'\[([0-9, ]+)\]$')
+
+
+def parse_rate(rate):
+    """Seconds from 0.1, '100ms', '5s', '1min' or '1h'"""
+    if isinstance(rate, (int, float)):
+        return float(rate)
+    match = RATE.match(str(rate))
+    if not match:
+        raise ValueError(f"invalid rate {rate!r}")
+    return float(match.group(1)) * RATE_UNITS[match.group(2)]
+
+
+def load_rate_tags(path, default_rate='5s'):
+    """[(tag, period in seconds)] from a rate tag file"""
+    with open(path, 'r') as f:
+        config = json.load(f)
+    file_rate = parse_rate(config.get('rate', default_rate))
+    entries = []
+    seen = set()
+    for entry in config['tags']:
+        tag, rate = (entry, file_rate) if isinstance(entry, str) else (entry['tag'], parse_rate(entry['rate']))
+        if tag not in seen:
+            seen.add(tag)
+            entries.append((tag, rate))
+    return entries
+
+
+def element_segments(index):
+    """Bytes of the member id segments addressing an array element"""
+    return sum(2 if int(i) < 0x100 else 4 for i in index.split(','))
+
+
+def symbolic_size(name):
+    """Bytes of an ANSI extended symbolic segment, plus the segments of a trailing [i]"""
+    match = ARRAY_INDEX.search(name)
+    size = 0
+    if match:
+        name = name[:match.start()]
+        size = element_segments(match.group(1))
+    return size + 2 + len(name) + len(name) % 2
+
+
+def request_size(tag, instance_id=None):
+    """Bytes of one Read Tag request as pycomm3 builds it: service, path size, path and element count.
+    With the symbol instance id from the tag list the base tag costs a class and an instance segment."""
+    base, *members = tag.split('.')
+    if instance_id and not base.startswith('Program:'):
+        match = ARRAY_INDEX.search(base)
+        path = (4 if instance_id < 0x100 else 6) + (element_segments(match.group(1)) if match else 0)
+    else:
+        path = symbolic_size(base)
+    path += sum(symbolic_size(member) for member in members)
+    return 4 + path
+
+
+def data_size(tag_info):
+    """Reply data bytes of one element, from the tag list info of a tag or member"""
+    if not tag_info:
+        return DEFAULT_DATA_SIZE
+    data_type = tag_info.get('data_type')
+    if tag_info.get('tag_type') == 'struct' and isinstance(data_type, dict):
+        return data_type.get('template', {}).get('structure_size', DEFAULT_DATA_SIZE)
+    return ATOMIC_SIZES.get(data_type, DEFAULT_DATA_SIZE)
+
+
+def pack(items, capacity):
+    """First-fit decreasing: [(tag, size)] into bins of at most capacity bytes.
+    Items larger than capacity get a bin of their own (pycomm3 reads them fragmented)."""
+    bins = []  # [free bytes, tags]
+    oversize = []
+    for tag, size in sorted(items, key=lambda item: -item[1]):
+        if size > capacity:
+            oversize.append([tag])
+            continue
+        for entry in bins:
+            if entry[0] >= size:
+                entry[0] -= size
+                entry[1].append(tag)
+                break
+        else:
+            bins.append([capacity - size, [tag]])
+    return [tags for _, tags in bins] + oversize
+
+
+def next_fit_packets(items, capacity):
+    """Requests pycomm3 would send for items in the given order"""
+    packets = 0
+    used = None
+    for _, size in items:
+        if size > capacity:
+            packets += math.ceil(size / capacity)
+            continue
+        if used is None or used + size > capacity:
+            packets += 1
+            used = 0
+        used += size
+    return packets
+
+
+class TagSize(collections.namedtuple('TagSize', 'request data struct')):
+    """Request and reply data bytes of one tag read"""
+
+    @property
+    def packed(self):
+        """Size pycomm3 groups requests by, so planned packets are sent as is"""
+        return self.data + self.request + REQUEST_OVERHEAD
+
+    @property
+    def reply(self):
+        """Reply service header, data type (and structure handle) and data"""
+        return 4 + 2 + (2 if self.struct else 0) + self.data
+
+
+class ReadPlan:
+    """The CIP requests for one set of due tags"""
+
+    def __init__(self, packets, requests, request_bytes, reply_bytes, unpacked_packets):
+        self.packets = packets  # tags per read() call
+        self.requests = requests  # CIP requests, counting every fragment of an oversize tag
+        self.request_bytes = request_bytes
+        self.reply_bytes = reply_bytes
+        self.unpacked_packets = unpacked_packets
+
+    @property
+    def tags(self):
+        return [tag for packet in self.packets for tag in packet]
+
+
+class RateClassScheduler:
+    """Decides which tags are due on each tick and how to pack them into CIP requests"""
+
+    def __init__(self, entries, name='plc'):
+        self.name = name
+        self.classes = {}  # period -> [tags]
+        for tag, period in entries:
+            self.classes.setdefault(period, []).append(tag)
+        self.next_due = {period: 0.0 for period in self.classes}
+        self.connection_size = DEFAULT_CONNECTION_SIZE
+        self.sizes = {}  # tag -> TagSize
+        self.plans = {}
+        self.packets_metric = TAG_READ_PACKETS.labels(name)
+        self.request_bytes_metric = TAG_READ_BYTES.labels(name, 'request')
+        self.reply_bytes_metric = TAG_READ_BYTES.labels(name, 'reply')
+
+        # Metrics
+        self.ticks = 0
+        self.packets = 0
+        self.request_bytes = 0
+        self.reply_bytes = 0
+        self.unpacked_packets = 0
+        self.late_ticks = 0
+        self.last_tick = None
+
+    @property
+    def tags(self):
+        return [tag for tags in self.classes.values() for tag in tags]
+
+    def configure(self, plc):
+        """Size every tag from the PLC's uploaded tag list and connection size (after each connect)"""
+        self.connection_size = getattr(plc, 'connection_size', None) or DEFAULT_CONNECTION_SIZE
+        get_tag_info = getattr(plc, 'get_tag_info', None)
+        base_tags = getattr(plc, 'tags', None) or {}
+        self.sizes = {}
+        unknown = []
+        for tag in self.tags:
+            info = None
+            if get_tag_info:
+                try:
+                    info = get_tag_info(tag)
+                except Exception:
+                    info = None
+            if info is None:
+                unknown.append(tag)
+            base = ARRAY_INDEX.sub('', tag.split('.')[0])
+            instance_id = base_tags.get(base, {}).get('instance_id')
+            struct = bool(info) and info.get('tag_type') == 'struct'
+            self.sizes[tag] = TagSize(request_size(tag, instance_id), data_size(info), struct)
+        self.plans = {}
+        if unknown and base_tags:
+            logger.warning(f"{self.name}: no tag info for {', '.join(unknown[:10])}"
+                           + (f" and {len(unknown) - 10} more" if len(unknown) > 10 else "")
+                           + f", assuming {DEFAULT_DATA_SIZE} bytes")
+
+    def size(self, tag):
+        return self.sizes.get(tag) or TagSize(request_size(tag), DEFAULT_DATA_SIZE, False)
+
+    def plan(self, periods):
+        """ReadPlan for the tags of the given classes (cached)"""
+        key = tuple(sorted(periods))
+        plan = self.plans.get(key)
+        if plan is None:
+            tags = [tag for period in key for tag in self.classes[period]]
+            items = [(tag, self.size(tag).packed) for tag in tags]
+            capacity = self.connection_size - MULTISERVICE_OVERHEAD
+            packets = pack(items, capacity)
+            requests = 0
+            request_bytes = 0
+            reply_bytes = 0
+            for packet in packets:
+                requests += max(1, math.ceil(self.size(packet[0]).packed / capacity)) if len(packet) == 1 else 1
+                sizes = [self.size(tag) for tag in packet]
+                request_bytes += sum(size.request for size in sizes)
+                reply_bytes += sum(size.reply for size in sizes)
+                if len(packet) > 1:
+                    # Multiple Service Packet: service, path to the Message Router, count and one offset per request
+                    request_bytes += 8 + 2 * len(packet)
+                    reply_bytes += 6 + 2 * len(packet)
+            plan = self.plans[key] = ReadPlan(packets, requests, request_bytes, reply_bytes,
+                                                 next_fit_packets(items, capacity))
+        return plan
+
+    def due(self, now=None):
+        """Periods of the classes due at now (monotonic seconds); schedules their next read"""
+        now = time.monotonic() if now is None else now
+        due = []
+        for period, next_due in self.next_due.items():
+            if now >= next_due:
+                due.append(period)
+                following = next_due + period
+                if following <= now:
+                    if next_due:
+                        self.late_ticks += 1
+                    following = (math.floor(now / period) + 1) * period
+                self.next_due[period] = following
+        return due
+
+    def tick(self, plc, now=None):
+        """Read every due tag; returns [(tag, Tag result)], empty when nothing is due"""
+        periods = self.due(now)
+        if not periods:
+            return []
+        plan = self.plan(periods)
+        results = []
+        for packet in plan.packets:
+            values = plc.read(*packet)
+            results.extend(zip(packet, [values] if len(packet) == 1 else values))
+        self.ticks += 1
+        self.packets += plan.requests
+        self.request_bytes += plan.request_bytes
+        self.reply_bytes += plan.reply_bytes
+        self.unpacked_packets += plan.unpacked_packets
+        self.packets_metric.inc(plan.requests)
+        self.request_bytes_metric.inc(plan.request_bytes)
+        self.reply_bytes_metric.inc(plan.reply_bytes)
+        self.last_tick = {'classes': sorted(periods), 'tags': len(plan.tags), 'packets': plan.requests,
+                          'request_bytes': plan.request_bytes, 'reply_bytes': plan.reply_bytes,
+                          'packets_unpacked': plan.unpacked_packets}
+        return results
+
+    def stats(self):
+        return {
+            'classes': {period: len(tags) for period, tags in sorted(self.classes.items())},
+            'connection_size': self.connection_size,
+            'ticks': self.ticks,
+            'packets': self.packets,
+            'packets_per_tick': self.packets / self.ticks if self.ticks else None,
+            'packets_unpacked': self.unpacked_packets,
+            'request_bytes_per_tick': self.request_bytes / self.ticks if self.ticks else None,
+            'reply_bytes_per_tick': self.reply_bytes / self.ticks if self.ticks else None,
+            'late_ticks': self.late_ticks,
+            'last_tick': self.last_tick,
+        }
+
+
+def flatten(tag, value):
+    """(name, float) for every number in a tag value; structures and arrays become tag.member / tag[i]"""
+    if isinstance(value, dict):
+        for member, member_value in value.items():
+            yield from flatten(f"{tag}.{member}", member_value)
+    elif isinstance(value, (list, tuple)):
+        for i, element in enumerate(value):
+            yield from flatten(f"{tag}[{i}]", element)
+    elif isinstance(value, (bool, int, float)):
+        yield tag, float(value)
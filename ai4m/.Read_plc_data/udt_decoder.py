@@ -0,0 +1,230 @@
+"""Fast decoding of the machine UDT (MC17, MC18, ...).
+
+pycomm3's plc.read("MC17") decodes all ~65 members into a nested dict on every
+poll. UdtDecoder instead reads the UDT's raw bytes once per poll and unpacks
+only the members we store with one precompiled struct.Struct, using the member
+offsets from the controller's template. Samples become plain tuples ordered
+like UdtLayout.names, and the PLC clock fields become an EpochMicros value
+instead of a datetime and a str().
+
+DictDecoder produces the same tuples from the regular pycomm3 dict, so callers
+can fall back to it when the fast path is unavailable.
+"""
+import datetime
+import operator
+import struct
+
+from pycomm3 import Services, ClassCode, UINT
+
+# PLC clock members of the UDT
+CLOCK_FIELDS = ('Year', 'Month', 'Day', 'Hour', 'Min', 'Sec', 'Microsecond')
+
+# Logix atomic types -> struct codes (little endian)
+STRUCT_CODES = {
+    'SINT': 'b', 'USINT': 'B',
+    'INT': 'h', 'UINT': 'H',
+    'DINT': 'i', 'UDINT': 'I',
+    'LINT': 'q', 'ULINT': 'Q',
+    'REAL': 'f', 'LREAL': 'd',
+    'BOOL': '?', 'BYTE': 'B', 'WORD': 'H', 'DWORD': 'I', 'LWORD': 'Q',
+}
+
+DAY_MICROS = 86400 * 1000000
+UNIX_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _days_from_civil(year, month, day):
+    """Days since 1970-01-01 for a proleptic Gregorian date (Howard Hinnant's algorithm)"""
+    year -= month <= 2
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+class EpochMicros:
+    """PLC wall-clock time as integer microseconds since 1970-01-01 (no time zone).
+
+    str() gives the same text as str(datetime), so text COPY, JSON spooling
+    and logs are unchanged; the binary COPY encoder uses .us directly.
+    """
+    __slots__ = ('us',)
+
+    def __init__(self, us):
+        self.us = us
+
+    @property
+    def day(self):
+        return self.us // DAY_MICROS
+
+    def seconds(self):
+        return self.us / 1000000.0
+
+    def to_datetime(self):
+        return UNIX_EPOCH + datetime.timedelta(microseconds=self.us)
+
+    def __str__(self):
+        return str(self.to_datetime())
+
+    def __repr__(self):
+        return f"EpochMicros({self.us})"
+
+    def __eq__(self, other):
+        return isinstance(other, EpochMicros) and other.us == self.us
+
+    def __hash__(self):
+        return hash(self.us)
+
+
+def _tuple_getter(indices):
+    """itemgetter that always returns a tuple, even for a single index"""
+    if len(indices) == 1:
+        index = indices[0]
+        return lambda values: (values[index],)
+    if not indices:
+        return lambda values: ()
+    return operator.itemgetter(*indices)
+
+
+class UdtLayout:
+    """The ordered set of UDT members a machine needs, with precomputed accessors"""
+
+    def __init__(self, high_speed_tags, low_speed_tags, extra_tags=()):
+        names = list(CLOCK_FIELDS)
+        for tag in list(extra_tags) + list(high_speed_tags) + list(low_speed_tags):
+            if tag not in names:
+                names.append(tag)
+        self.names = names
+        self.index = {name: i for i, name in enumerate(names)}
+        self.clock = _tuple_getter([self.index[name] for name in CLOCK_FIELDS])
+        self.high_speed = _tuple_getter([self.index[tag] for tag in high_speed_tags])
+        self.low_speed = _tuple_getter([self.index[tag] for tag in low_speed_tags])
+        self.day_cache = {}
+
+    def getter(self, tags):
+        """Function returning the values of tags, in that order, from a decoded sample"""
+        return _tuple_getter([self.index[tag] for tag in tags])
+
+    def timestamp(self, values):
+        """EpochMicros from the clock members of a decoded sample"""
+        year, month, day, hour, minute, second, micro = self.clock(values)
+        key = (year, month, day)
+        days = self.day_cache.get(key)
+        if days is None:
+            days = _days_from_civil(year, month, day)
+            if len(self.day_cache) > 64:
+                self.day_cache.clear()
+            self.day_cache[key] = days
+        return EpochMicros(((days * 86400 + hour * 3600 + minute * 60 + second) * 1000000) + micro)
+
+
+class DictDecoder:
+    """Builds layout-ordered tuples from the dict returned by plc.read()"""
+
+    def __init__(self, layout, udt_tag):
+        self.layout = layout
+        self.udt_tag = udt_tag
+        self.names = layout.names
+
+    def read(self, plc):
+        tag_value = plc.read(self.udt_tag)
+        return tag_value.value if tag_value else None
+
+    def decode(self, data):
+        return tuple([data[name] for name in self.names])
+
+    def field(self, data, name):
+        return data.get(name)
+
+
+class UdtDecoder:
+    """Decodes raw UDT bytes with a single precompiled struct.Struct"""
+
+    def __init__(self, layout, udt_tag, internal_tags, structure_size, instance_id=None):
+        self.layout = layout
+        self.udt_tag = udt_tag
+        self.structure_size = structure_size
+        self.instance_id = instance_id
+        self.field_structs = {}
+
+        fields = []  # (offset, code, layout position)
+        bits = []    # (layout position, byte offset, bit)
+        for position, name in enumerate(layout.names):
+            info = internal_tags.get(name)
+            if info is None:
+                raise KeyError(name)
+            type_name = info.get('data_type_name')
+            if info.get('tag_type') != 'atomic' or info.get('array') or type_name not in STRUCT_CODES:
+                raise ValueError(f"{udt_tag}.{name} ({type_name}) is not supported by the fast decoder")
+            if type_name == 'BOOL' and 'bit' in info:
+                bits.append((position, info['offset'] + info['bit'] // 8, info['bit'] % 8))
+            else:
+                fields.append((info['offset'], STRUCT_CODES[type_name], position))
+        fields.sort()
+
+        fmt = '<'
+        cursor = 0
+        for offset, code, _ in fields:
+            if offset < cursor:
+                raise ValueError(f"{udt_tag}: overlapping members at offset {offset}")
+            if offset > cursor:
+                fmt += f'{offset - cursor}x'
+            fmt += code
+            cursor = offset + struct.calcsize('<' + code)
+        if cursor > structure_size:
+            raise ValueError(f"{udt_tag}: members extend past structure size {structure_size}")
+
+        self.struct = struct.Struct(fmt)
+        self.bits = bits
+        # Unpacked order is (struct fields by offset..., bit members...); map it back to layout order
+        order = [position for _, _, position in fields] + [position for position, _, _ in bits]
+        permutation = [0] * len(order)
+        for unpacked_index, position in enumerate(order):
+            permutation[position] = unpacked_index
+        self.reorder = operator.itemgetter(*permutation)
+        self.offsets = {layout.names[position]: (offset, code) for offset, code, position in fields}
+        self.bit_offsets = {layout.names[position]: (offset, bit) for position, offset, bit in bits}
+
+    @classmethod
+    def from_plc(cls, plc, udt_tag, layout):
+        """Build a decoder from the tag/template info uploaded by LogixDriver.open()"""
+        tag_info = plc.tags[udt_tag]
+        data_type = tag_info['data_type']
+        return cls(layout, udt_tag, data_type['internal_tags'], data_type['template']['structure_size'],
+                   tag_info['instance_id'])
+
+    def read(self, plc):
+        """Read the UDT's raw bytes with one Read Tag request on its symbol instance"""
+        response = plc.generic_message(
+            service=Services.read_tag,
+            class_code=ClassCode.symbol_object,
+            instance=self.instance_id,
+            request_data=UINT.encode(1),
+            name=self.udt_tag,
+        )
+        if not response or response.value is None:
+            return None
+        # Structure replies start with the structure type (0x02A0) and handle
+        raw = response.value[4:]
+        if len(raw) < self.structure_size:
+            return None
+        return raw
+
+    def decode(self, raw):
+        values = self.struct.unpack_from(raw)
+        if self.bits:
+            values += tuple([bool(raw[offset] >> bit & 1) for _, offset, bit in self.bits])
+        return self.reorder(values)
+
+    def field(self, raw, name):
+        """Decode a single member, e.g. the status code on the acquisition thread"""
+        if name in self.bit_offsets:
+            offset, bit = self.bit_offsets[name]
+            return bool(raw[offset] >> bit & 1)
+        packer = self.field_structs.get(name)
+        if packer is None:
+            offset, code = self.offsets[name]
+            packer = self.field_structs[name] = (offset, struct.Struct('<' + code))
+        offset, field_struct = packer
+        return field_struct.unpack_from(raw, offset)[0]
@@ -1,9 +1,20 @@
+import logging
+import os
+import sys
 import psycopg2
-from pycomm3 import LogixDriver
 import time
 
+# metrics.py is shared with the ingest scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '.Read_plc_data'))
+import async_log
+import metrics
+from gateway_client import plc_driver
+
+logger = logging.getLogger(__name__)
+
 PLC_IP = "141.141.141.128"
 TAG_NAME = "MC17_DC_NOTIFICATION"
+METRICS_PORT = 9104
 
 DB_CONFIG = {
     "dbname": "hul",
@@ -14,6 +25,7 @@ DB_CONFIG = {
 }
 
 def get_active_count():
+    started = time.perf_counter()
     try:
         conn = psycopg2.connect(**DB_CONFIG)
         cur = conn.cursor()
@@ -29,6 +41,7 @@ def get_active_count():
 
         cur.close()
         conn.close()
+        metrics.DB_QUERY_SECONDS.labels('active_count').observe(time.perf_counter() - started)
 
         if result is None:
             return None
@@ -38,42 +51,46 @@ def get_active_count():
         return active_val
 
     except Exception as e:
-        print("DB Error:", e)
+        logger.error(f"DB Error: {e}")
+        metrics.DB_ERRORS.labels('active_count').inc()
         return None
 
 
 def main():
 
     last_state = None
+    metrics.start_http_server(METRICS_PORT)
 
-    with LogixDriver(PLC_IP) as plc:
+    with plc_driver(PLC_IP) as plc:
 
         while True:
             active = get_active_count()
 
             if active is None:
-                print("⚠ Could not fetch active count.")
+                logger.warning("Could not fetch active count.")
                 time.sleep(2)
                 continue
 
-            print(f"Active count for MC17: {active}")
+            logger.debug(f"Active count for MC17: {active}")
 
             desired_state = (active > 0)
 
             if desired_state != last_state:
-                print(f"➡ Writing {desired_state} to PLC...")
+                logger.info(f"Active count for MC17: {active}, writing {desired_state} to PLC")
+                started = time.perf_counter()
                 plc.write((TAG_NAME, desired_state))
+                metrics.PLC_WRITE_SECONDS.labels(PLC_IP).observe(time.perf_counter() - started)
 
+                started = time.perf_counter()
                 read_back = plc.read(TAG_NAME).value
-                print(f"🔍 PLC Confirmation: {read_back}")
+                metrics.PLC_READ_SECONDS.labels(PLC_IP).observe(time.perf_counter() - started)
+                logger.info(f"PLC confirmation: {read_back}")
 
                 last_state = desired_state
-            else:
-                print("✓ No change detected")
-
             time.sleep(2)
 
 
 if __name__ == "__main__":
+    async_log.setup_logging()
     main()
 
@@ -1,7 +1,12 @@
 import csv
 import time
 from datetime import datetime
-from pycomm3 import LogixDriver
+import os
+import sys
+
+# gateway_client.py is shared with the ingest scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '.Read_plc_data'))
+from gateway_client import plc_driver
 
 # IP address of your PLC
 PLC_IP = '141.141.141.128'
@@ -24,7 +29,7 @@ CSV_FILE = 'plc_data_log_10_5.csv'
 
 def main():
     # Open PLC connection
-    with LogixDriver(PLC_IP) as plc:
+    with plc_driver(PLC_IP) as plc:
         print("Connected to PLC!")
 
         # Open CSV file for writing
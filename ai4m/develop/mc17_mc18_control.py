@@ -1,15 +1,25 @@
 import asyncio
 import json
+import logging
 import time
 import nats
-from pycomm3 import LogixDriver, CommError
+from pycomm3 import CommError
 import os
+import sys
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import uuid
 from datetime import datetime
 import re
 
+# metrics.py is shared with the ingest scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '.Read_plc_data'))
+import async_log
+import metrics
+from gateway_client import GatewayError, plc_driver
+
+logger = logging.getLogger(__name__)
+
 with open('config.json') as f:
     CONFIG = json.load(f)
 
@@ -28,9 +38,9 @@ class DatabaseManager:
         try:
             conn = self.get_connection()
             conn.commit()
-            print("Database initialized successfully")
+            logger.info("Database initialized successfully")
         except Exception as e:
-            print(f"Database initialization error: {e}")
+            logger.error(f"Database initialization error: {e}")
 
     def insert_event(self, plc_id, tag_name, operation_type, previous_value=None, new_value=None):
         try:
@@ -64,10 +74,10 @@ class DatabaseManager:
             return True
 
         except psycopg2.IntegrityError as e:
-            print(f"Database integrity error: {e}")
+            logger.error(f"Database integrity error: {e}")
             return False
         except Exception as e:
-            print(f"Database error: {e}")
+            logger.error(f"Database error: {e}")
             return False
 
     def get_readable_name_from_tag(self, tag_name):
@@ -98,7 +108,7 @@ class DatabaseManager:
 
             return readable_name
         except Exception as e:
-            print(f"Error converting tag name to readable format: {e}")
+            logger.error(f"Error converting tag name to readable format: {e}")
             return tag_name
 
 class PLC:
@@ -109,11 +119,13 @@ class PLC:
 
     def connect(self):
         try:
-            self.driver = LogixDriver(self.ip)
+            self.driver = plc_driver(self.ip)
             self.driver.open()
+            metrics.PLC_CONNECTS.labels(self.ip, 'ok').inc()
             #print(f"Connected to PLC {self.ip}")
         except Exception as e:
-            print(f"Failed to connect to {self.ip}: {e}")
+            logger.error(f"Failed to connect to {self.ip}: {e}")
+            metrics.PLC_CONNECTS.labels(self.ip, 'error').inc()
             self.driver = None
 
     def read(self, tag):
@@ -122,10 +134,13 @@ class PLC:
 
         if self.driver:
             try:
+                started = time.perf_counter()
                 result = self.driver.read(tag)
+                metrics.PLC_READ_SECONDS.labels(self.ip).observe(time.perf_counter() - started)
                 return result.value if hasattr(result, 'value') else result
             except Exception as e:
-                print(f"Read failed on {self.ip} for tag {tag}: {e}")
+                logger.error(f"Read failed on {self.ip} for tag {tag}: {e}")
+                metrics.PLC_READ_ERRORS.labels(self.ip).inc()
                 return None
         return None
 
@@ -135,22 +150,23 @@ class PLC:
 
         if self.driver:
             try:
+                started = time.perf_counter()
                 self.driver.write(tag, value)
-                print(self.driver.read(tag))
+                metrics.PLC_WRITE_SECONDS.labels(self.ip).observe(time.perf_counter() - started)
                 #print(f"Successfully wrote {value} to {tag} on PLC {self.ip}")
                 return True
-            except CommError as e:
-                print(f"Write failed on {self.ip}: {e}. Reconnecting...")
+            except (CommError, GatewayError) as e:
+                logger.warning(f"Write failed on {self.ip}: {e}. Reconnecting...")
                 self.connect()
                 if self.driver:
                     try:
                         self.driver.write(tag, value)
                         return True
                     except Exception as e:
-                        print(f"Retry failed on {self.ip}: {e}")
+                        logger.error(f"Retry failed on {self.ip}: {e}")
                         return False
             except Exception as e:
-                print(f"Unexpected write error on {self.ip}: {e}")
+                logger.error(f"Unexpected write error on {self.ip}: {e}")
                 return False
         return False
 
@@ -159,6 +175,7 @@ class Server:
         self.plcs = {plc_id: PLC(config['ip']) for plc_id, config in CONFIG['plcs'].items()}
         self.plc_topics = {plc_id: config['topic'] for plc_id, config in CONFIG['plcs'].items()}
         self.db_manager = DatabaseManager()
+        self.metrics_port = CONFIG.get('metrics', {}).get('port')
 
     def get_tag_info(self, plc_id, name):
         if plc_id == "17":
@@ -171,7 +188,19 @@ class Server:
                     return item
         return None
 
+    def command_labels(self, plc_id, command):
+        """Metric labels limited to known PLCs and commands"""
+        plc_label = plc_id if plc_id in self.plcs else 'unknown'
+        command_label = command.upper() if isinstance(command, str) and command.upper() in ("UPDATE", "TOGGLE") else 'unknown'
+        return plc_label, command_label
+
+    def error_response(self, plc_id, command, error):
+        metrics.NATS_COMMAND_ERRORS.labels(*self.command_labels(plc_id, command)).inc()
+        return json.dumps({"error": error}).encode()
+
     async def message_handler(self, msg):
+        started = time.perf_counter()
+        plc_id = command = None
         try:
             req = json.loads(msg.data)
             #print("Request JSON:", req)
@@ -179,34 +208,32 @@ class Server:
             plc = self.plcs.get(plc_id)
 
             if not plc:
-                print(f"Invalid PLC ID: {plc_id}")
-                return await msg.respond(json.dumps({"error": "Invalid PLC ID"}).encode())
+                logger.warning(f"Invalid PLC ID: {plc_id}")
+                return await msg.respond(self.error_response(plc_id, command, "Invalid PLC ID"))
 
             name = req.get("name")
             if not name:
-                print("Missing name in request")
-                return await msg.respond(json.dumps({"error": "Missing name"}).encode())
+                logger.warning("Missing name in request")
+                return await msg.respond(self.error_response(plc_id, command, "Missing name"))
 
             command = req.get("command")
             if not command or command.upper() not in ["UPDATE", "TOGGLE"]:
-                print("Invalid or missing command")
-                return await msg.respond(json.dumps({"error": "Invalid command. Use UPDATE or TOGGLE"}).encode())
+                logger.warning("Invalid or missing command")
+                return await msg.respond(self.error_response(plc_id, command, "Invalid command. Use UPDATE or TOGGLE"))
 
             tag_info = self.get_tag_info(plc_id, name)
             if not tag_info:
-                print(f"Tag not found for name: {name}")
-                return await msg.respond(json.dumps({"error": "Tag not found"}).encode())
+                logger.warning(f"Tag not found for name: {name}")
+                return await msg.respond(self.error_response(plc_id, command, "Tag not found"))
 
             if tag_info["enable"] != 1:
-                print(f"Tag {name} is not enabled for writing")
-                return await msg.respond(json.dumps({"error": "Tag not enabled for writing"}).encode())
+                logger.warning(f"Tag {name} is not enabled for writing")
+                return await msg.respond(self.error_response(plc_id, command, "Tag not enabled for writing"))
 
             if command.upper() == "TOGGLE":
                 if name.lower() not in ["hmi_i_start","hmi_i_stop","hmi_i_reset"]:
-                    print("TOGGLE command can only be used with start/stop/reset")
-                    return await msg.respond(json.dumps({
-                        "error": "TOGGLE command can only be used with start/stop/reset names"
-                    }).encode())
+                    logger.warning("TOGGLE command can only be used with start/stop/reset")
+                    return await msg.respond(self.error_response(plc_id, command, "TOGGLE command can only be used with start/stop/reset names"))
 
                 success1 = plc.write(tag_info["tag"], True)
                 if success1:
@@ -224,19 +251,15 @@ class Server:
                             "message": f"Toggled {name} successfully"
                         }).encode())
                     else:
-                        return await msg.respond(json.dumps({
-                            "error": f"Failed to complete toggle operation for {name}"
-                        }).encode())
+                        return await msg.respond(self.error_response(plc_id, command, f"Failed to complete toggle operation for {name}"))
                 else:
-                    return await msg.respond(json.dumps({
-                        "error": f"Failed to start toggle operation for {name}"
-                    }).encode())
+                    return await msg.respond(self.error_response(plc_id, command, f"Failed to start toggle operation for {name}"))
 
             elif command.upper() == "UPDATE":
                 value = req.get("value")
                 if value is None:
                     #print("Missing value for UPDATE command")
-                    return await msg.respond(json.dumps({"error": "Missing value for UPDATE"}).encode())
+                    return await msg.respond(self.error_response(plc_id, command, "Missing value for UPDATE"))
 
                 is_temp = name in ["HMI_I_Start","HMI_I_Stop","HMI_I_Reset","HMI_Ver_Seal_Front_1", "HMI_Ver_Seal_Front_2", "HMI_Ver_Seal_Front_3", "HMI_Ver_Seal_Front_4", "HMI_Ver_Seal_Front_5", "HMI_Ver_Seal_Front_6", "HMI_Ver_Seal_Front_7", "HMI_Ver_Seal_Front_8", "HMI_Ver_Seal_Front_9", "HMI_Ver_Seal_Front_10", "HMI_Ver_Seal_Front_11", "HMI_Ver_Seal_Front_12", "HMI_Ver_Seal_Front_13", "HMI_Ver_Seal_Rear_14", "HMI_Ver_Seal_Rear_15", "HMI_Ver_Seal_Rear_16", "HMI_Ver_Seal_Rear_17", "HMI_Ver_Seal_Rear_18", "HMI_Ver_Seal_Rear_19", "HMI_Ver_Seal_Rear_20", "HMI_Ver_Seal_Rear_21", "HMI_Ver_Seal_Rear_22", "HMI_Ver_Seal_Rear_23", "HMI_Ver_Seal_Rear_24", "HMI_Ver_Seal_Rear_25", "HMI_Ver_Seal_Rear_26", "HMI_Hor_Seal_Front_27", "HMI_Hor_Seal_Rear_28"]
                 #print(is_temp)
@@ -254,19 +277,21 @@ class Server:
                         "message": f"Updated {name} to {value}"
                     }).encode())
                 else:
-                    return await msg.respond(json.dumps({
-                        "error": f"Failed to update {name}"
-                    }).encode())
+                    return await msg.respond(self.error_response(plc_id, command, f"Failed to update {name}"))
                 is_temp = None
 
         except json.JSONDecodeError as e:
-            print(f"JSON decode error: {e}")
-            await msg.respond(json.dumps({"error": "Invalid JSON format"}).encode())
+            logger.warning(f"JSON decode error: {e}")
+            await msg.respond(self.error_response(plc_id, command, "Invalid JSON format"))
         except Exception as e:
-            print(f"Error processing request: {e}")
-            await msg.respond(json.dumps({"error": str(e)}).encode())
+            logger.error(f"Error processing request: {e}")
+            await msg.respond(self.error_response(plc_id, command, str(e)))
+        finally:
+            metrics.NATS_COMMAND_SECONDS.labels(*self.command_labels(plc_id, command)).observe(time.perf_counter() - started)
 
     async def run(self):
+        if self.metrics_port:
+            metrics.start_http_server(self.metrics_port)
         try:
             nc = await nats.connect(CONFIG['nats']['server'])
 
@@ -277,11 +302,13 @@ class Server:
             await asyncio.Event().wait()
 
         except OSError as e:
-            print(f"Fatal NATS connection error: {e}")
+            logger.critical(f"Fatal NATS connection error: {e}")
+            async_log.stop()
             os._exit(1)
 
         except Exception as e:
-            print(f"NATS connection error: {e}")
+            logger.critical(f"NATS connection error: {e}")
+            async_log.stop()
             os._exit(1)
 
         finally:
@@ -289,9 +316,10 @@ class Server:
                 await sub.unsubscribe()
 
 if __name__ == "__main__":
+    async_log.setup_logging(CONFIG.get('logging'))
     try:
         asyncio.run(Server().run())
     except KeyboardInterrupt:
-        print("Server shutting down...")
+        logger.info("Server shutting down...")
     except Exception as e:
-        print(f"Unexpected error: {e}")
+        logger.critical(f"Unexpected error: {e}")